@@ -0,0 +1,17 @@
+"""
+Celery config for etrade project.
+
+Tasks are autodiscovered from the ``tasks`` module of every installed app.
+``CELERY_BROKER_URL`` is required. Set ``CELERY_TASK_ALWAYS_EAGER`` to run
+tasks in-process instead, the broker is then never contacted.
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'etrade.settings')
+
+app = Celery('etrade')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -0,0 +1,35 @@
+"""
+gunicorn settings, run with ``gunicorn -c etrade/gunicorn.conf.py etrade.wsgi``.
+
+Set PROMETHEUS_MULTIPROC_DIR to an empty directory writable by the workers
+so /metrics reports the samples of every worker, not only the one that
+served the scrape.
+"""
+import glob
+import os
+import sys
+
+from prometheus_client import multiprocess
+
+bind=os.environ.get("GUNICORN_BIND","0.0.0.0:8000")
+workers=int(os.environ.get("GUNICORN_WORKERS","4"))
+
+
+def on_starting(server):
+    # samples left by a previous run would be added to the new ones
+    path=os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        for name in glob.glob(os.path.join(path,"*.db")):
+            os.remove(name)
+
+
+def post_fork(server,worker):
+    # with preload_app the master may have built the Twilio client, a worker must not share its sockets
+    twilio=sys.modules.get("users.sms.backends.twilio")
+    if twilio is not None:
+        twilio.reset_client()
+
+
+def child_exit(server,worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
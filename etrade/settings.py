@@ -1,11 +1,16 @@
+import sys
 from pathlib import Path
 
+from celery.schedules import crontab
 from decouple import Csv,config
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
 SECRET_KEY = config("SECRET_KEY")
 
+# the test runner brings its own broker and cache, everything else needs them configured
+TESTING=sys.argv[1:2]==["test"]
+
 
 DEBUG = True
 
@@ -42,13 +47,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-
+    # outermost, so the time spent in the other middleware is counted too
+    "users.middleware.MetricsMiddleware",
+    "users.middleware.SQLProfilingMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    "django.middleware.cache.UpdateCacheMiddleware",
     'django.middleware.common.CommonMiddleware',
-    "django.middleware.cache.FetchFromCacheMiddleware",
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -91,6 +96,22 @@ REST_AUTH_SERIALIZERS = {
 }
 
 
+PASSWORD_HASHERS=[
+    "users.hashers.PBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
+PASSWORD_PBKDF2_ITERATIONS=config("PASSWORD_PBKDF2_ITERATIONS",default=320000,cast=int)
+
+# pool used by the async login view to check password hashes
+PASSWORD_HASH_EXECUTOR=config("PASSWORD_HASH_EXECUTOR",default="thread")
+PASSWORD_HASH_WORKERS=config("PASSWORD_HASH_WORKERS",default=4,cast=int)
+PASSWORD_HASH_QUEUE_SIZE=config("PASSWORD_HASH_QUEUE_SIZE",default=64,cast=int)
+
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -120,21 +141,54 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_URL="media/"
+MEDIA_ROOT=BASE_DIR/"media"
+# users.views.serve_media, for development. In production the web server serves MEDIA_ROOT
+# at MEDIA_URL, e.g. an nginx location with "expires max" for the content-hashed avatar/ files
+SERVE_MEDIA=config("SERVE_MEDIA",default=DEBUG,cast=bool)
+
+# uploads are streamed to a temporary file as they arrive instead of being held in memory
+FILE_UPLOAD_HANDLERS=["django.core.files.uploadhandler.TemporaryFileUploadHandler"]
+
+AVATAR_MAX_UPLOAD_SIZE=10*1024*1024
+# users.avatars, every size is made in every format
+AVATAR_VARIANTS={
+    "thumbnail":(96,96),
+    "medium":(512,512),
+}
+AVATAR_FORMATS={
+    "webp":{"format":"WEBP","quality":80,"method":4},
+    "jpeg":{"format":"JPEG","quality":82,"optimize":True,"progressive":True},
+}
+# unreferenced avatar files younger than this are kept, they may belong to an upload in progress
+AVATAR_GC_GRACE_SECONDS=24*60*60
+
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ORIGIN_ALLOW_ALL=True
 
 AUTHENTICATION_BACKENDS=[
-    "users.backends.phone_backend.PhoneNumberAuthBackend",
-    "users.backends.email_backend.EmailAuthBackend",
+    "users.backends.identifier_backend.IdentifierAuthBackend",
 ]
 
 REST_FRAMEWORK={
     "DEFAULT_AUTHENTICATION_CLASSES":(
-        "dj_rest_auth.jwt_auth.JWTCookieAuthentication",
+        "users.authentication.CachedJWTCookieAuthentication",
     ),
     "DEFAULT_SCHEMA_CLASS":"drf_spectacular.openapi.AutoSchema",
+    # proxies in front of the app, the client IP throttled by users.throttling is read from
+    # X-Forwarded-For this many hops back. 0 uses REMOTE_ADDR, the header can be forged by anyone
+    "NUM_PROXIES":config("NUM_PROXIES",default=0,cast=int),
+    # read by users.throttling, "<scope>" is per email/phone number and "<scope>_ip" per client IP
+    "DEFAULT_THROTTLE_RATES":{
+        "otp_send":"5/hour",
+        "otp_send_ip":"30/hour",
+        "otp_verify":"10/hour",
+        "otp_verify_ip":"60/hour",
+        "login":"10/min",
+        "login_ip":"60/min",
+    },
 }
 
 SITE_ID=1
@@ -157,21 +211,38 @@ EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST='smtp.gmail.com'
 EMAIL_PORT=587
 EMAIL_USE_TLS=True
+EMAIL_TIMEOUT=10
 EMAIL_HOST_USER=config('EMAIL_USER')
 EMAIL_HOST_PASSWORD=config('EMAIL_PASS')
 EMAIL_HOST_FROM=config('EMAIL_FROM')
 
 PHONENUMBER_DEFAULT_REGION="ET"
+# User.phone_number is the canonical, uniquely indexed lookup key
+PHONENUMBER_DB_FORMAT="E164"
 
 TOKEN_LENGTH=6
 
 TOKEN_EXPIRE_MINUTES=6
 
+# where security codes live, users.otp_store.CacheOTPStore keeps them in the default cache
+OTP_STORE=config("OTP_STORE",default="users.otp_store.DatabaseOTPStore")
+OTP_MAX_ATTEMPTS=5
+# users.otp_store.HMACOTPStore, codes change every step and stay valid for DRIFT_STEPS more
+OTP_HMAC_STEP_SECONDS=60
+OTP_HMAC_DRIFT_STEPS=TOKEN_EXPIRE_MINUTES
+
 
 TWILIO_ACCOUNT_SID=config("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN=config("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER=config("TWILIO_PHONE_NUMBER")
 
+SMS_BACKEND=config("SMS_BACKEND",default="users.sms.backends.twilio.SMSBackend")
+SMS_FILE_PATH=BASE_DIR / "sms-messages"
+SMS_TWILIO_POOL_SIZE=10
+SMS_TWILIO_TIMEOUT=10
+# concurrent provider requests per event loop for async sends
+SMS_TWILIO_ASYNC_MAX_CLIENTS=1000
+
 
 # STRIPE_PUBLISHABLE_KEY=config("STRIPE_PUBLISHABLE_KEY")
 # STRIPE_SECRET_KEY=config("STRIPE_SECRET_KEY")
@@ -183,8 +254,38 @@ TWILIO_PHONE_NUMBER=config("TWILIO_PHONE_NUMBER")
 # PAYMENT_SUCCESS_URL=config("PAYMENT_SUCCESS_URL")
 # PAYMENT_CANCEL_URL=config("PAYMENT_CANCEL_URL")
 
-# CELERY_BROKER_URL=config("CELERY_BROKER_URL")
+# required outside tests, without a broker queued OTPs would never leave the process
+CELERY_BROKER_URL="memory://" if TESTING else config("CELERY_BROKER_URL")
 # CELERY_RESULT_BACKEND=config("CELERY_RESULT_BACKEND")
+CELERY_TASK_IGNORE_RESULT=True
+# tasks run in the calling process only in tests, unless this is set
+CELERY_TASK_ALWAYS_EAGER=config("CELERY_TASK_ALWAYS_EAGER",default=TESTING,cast=bool)
+CELERY_BEAT_SCHEDULE={
+    "drain-otp-outbox":{
+        "task":"users.tasks.drain_otp_outbox",
+        "schedule":30.0,
+    },
+    "purge-stale-users":{
+        "task":"users.tasks.purge_stale_users",
+        # outside business hours
+        "schedule":crontab(hour=3,minute=0),
+    },
+    "gc-avatars":{
+        "task":"users.tasks.gc_avatars",
+        "schedule":crontab(hour=3,minute=30),
+    },
+}
+
+OTP_DISPATCH_BATCH_SIZE=100
+OTP_DISPATCH_MAX_ATTEMPTS=5
+OTP_DISPATCH_LEASE_SECONDS=300
+
+# users.purge, accounts never verified within PURGE_UNVERIFIED_AFTER_DAYS are deleted
+PURGE_UNVERIFIED_AFTER_DAYS=7
+# sent and failed outbox rows are kept this long for troubleshooting
+PURGE_DISPATCHES_AFTER_HOURS=24
+PURGE_CHUNK_SIZE=1000
+PURGE_CHUNK_PAUSE=0.05
 
 
 SPECTACULAR_SETTINGS={
@@ -195,13 +296,35 @@ SPECTACULAR_SETTINGS={
 }
 
 
+# required outside tests, with a per-process cache workers would disagree on
+# throttles, OTP codes and the version keys that invalidate cached users
+REDIS_BACKEND="" if TESTING else config("REDIS_BACKEND")
+
 CACHES={
     "default":{
+        "BACKEND":"django.core.cache.backends.locmem.LocMemCache",
+    } if TESTING else {
         "BACKEND":"django.core.cache.backends.redis.RedisCache",
-        "LOCATION":config("REDIS_BACKEND")
+        "LOCATION":REDIS_BACKEND
     }
 }
 
-CACHE_MIDDLEWARE_ALIAS="default"
-CACHE_MIDDLEWARE_SECONDS=3600
-CACHE_MIDDLEWARE_KEY_PREFIX=""
\ No newline at end of file
+# per-user cache of the user, profile and address read endpoints, see users.cache
+USER_RESPONSE_CACHE_SECONDS=3600
+# snapshots of authenticated users, see users.authentication
+USER_SNAPSHOT_CACHE_SECONDS=300
+
+# users.middleware.SQLProfilingMiddleware, off unless a share of requests is sampled
+SQL_PROFILE_SAMPLE_RATE=config("SQL_PROFILE_SAMPLE_RATE",default=0.0,cast=float)
+SQL_PROFILE_LOG=config("SQL_PROFILE_LOG",default="")
+# the headers expose SQL timings and call sites to any client, keep them to development
+SQL_PROFILE_HEADERS=config("SQL_PROFILE_HEADERS",default=False,cast=bool)
+SQL_PROFILE_SLOWEST=5
+SQL_PROFILE_STACK_DEPTH=8
+
+# /metrics answers scrapes from these addresses, or carrying "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_ALLOWED_IPS=config("METRICS_ALLOWED_IPS",default="127.0.0.1,::1",cast=Csv())
+METRICS_TOKEN=config("METRICS_TOKEN",default="")
+# port a Celery worker serves its own metrics on (OTP sends are timed there), 0 leaves it off.
+# Give the worker the same PROMETHEUS_MULTIPROC_DIR as gunicorn instead and /metrics reports both
+CELERY_METRICS_PORT=config("CELERY_METRICS_PORT",default=0,cast=int)
@@ -1,3 +1,5 @@
+import re
+
 from dj_rest_auth.registration.views import ResendEmailVerificationView,VerifyEmailView
 from dj_rest_auth.views import (
     LogoutView,
@@ -6,18 +8,18 @@ from dj_rest_auth.views import (
     PasswordResetView
 )
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include,path,re_path
 from django.views.generic import TemplateView
 from drf_spectacular.views import SpectacularAPIView,SpectacularSwaggerView
 
-from users.views import GoogleLogin
+from users.views import GoogleLogin, metrics, serve_media
 
 
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics",metrics,name="metrics"),
     path("api/user/",include("users.urls",namespace="users")),
     # path("api/products/",include("products.urls",namespace="products")),
     # path("api/user/orders/",include("orders.urls",namespace="orders")),
@@ -49,7 +51,10 @@ urlpatterns = [
     
 ]
 
-urlpatterns +=static(settings.MEDIA_URL,document_root=settings.MEDIA_ROOT)
+if settings.SERVE_MEDIA:
+    urlpatterns += [
+        re_path(r"^%s(?P<path>.*)$"%re.escape(settings.MEDIA_URL.lstrip("/")),serve_media,name="media"),
+    ]
 
 urlpatterns += [
     path("api/schema/",SpectacularAPIView.as_view(),name="schema"),
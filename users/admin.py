@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import Address,OTP,Profile
+from .models import Address,OTP,OTPDispatch,Profile
 
 admin.site.register(OTP)
+admin.site.register(OTPDispatch)
 admin.site.register(Profile)
 admin.site.register(Address)
@@ -0,0 +1,97 @@
+"""
+Cached user resolution for JWT and session authentication.
+
+A compact snapshot of the user is cached under the user id and a per-user
+auth version. Saving, deactivating or deleting the user and logging out
+bump the version, so the next request reads the user from the database
+again and a revocation is seen straight away.
+"""
+from dj_rest_auth.jwt_auth import JWTCookieAuthentication
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import bump_version,get_version
+from .models import User
+from .phone import parse_phone_number
+
+AUTH_VERSION_KEY="user_auth_version_%s"
+
+SNAPSHOT_FIELDS=(
+    "id",
+    "username",
+    "email",
+    "phone_number",
+    "first_name",
+    "last_name",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "date_joined",
+)
+
+# from_db expects the values in the order of the model's fields
+_SNAPSHOT_ATTNAMES=[field.attname for field in User._meta.concrete_fields if field.attname in SNAPSHOT_FIELDS]
+
+
+def bump_auth_version(user_id):
+    bump_version(user_id,AUTH_VERSION_KEY)
+
+
+def _snapshot_key(user_id,version):
+    return f"user_snapshot_{user_id}_{version}"
+
+
+def _to_snapshot(user):
+    snapshot={name:getattr(user,name) for name in _SNAPSHOT_ATTNAMES}
+    if snapshot["phone_number"]:
+        snapshot["phone_number"]=str(snapshot["phone_number"])
+    snapshot["session_auth_hash"]=user.get_session_auth_hash()
+    return snapshot
+
+
+def _from_snapshot(snapshot):
+    values=[snapshot[name] for name in _SNAPSHOT_ATTNAMES]
+    if snapshot["phone_number"]:
+        values[_SNAPSHOT_ATTNAMES.index("phone_number")]=parse_phone_number(snapshot["phone_number"])
+    # the password is deferred, loading it would cost the query the snapshot saves
+    user=User.from_db(DEFAULT_DB_ALIAS,_SNAPSHOT_ATTNAMES,values)
+    user._session_auth_hash=snapshot["session_auth_hash"]
+    return user
+
+
+def get_cached_user(user_id):
+    """Return the user with user_id, from its cached snapshot when there is one, or None"""
+
+    # read the version first, a snapshot of a user changed meanwhile lands under a stale key
+    key=_snapshot_key(user_id,get_version(user_id,AUTH_VERSION_KEY))
+    snapshot=cache.get(key)
+    if snapshot is not None:
+        return _from_snapshot(snapshot)
+
+    user=User.objects.filter(pk=user_id).only(*SNAPSHOT_FIELDS,"password").first()
+    if user is not None:
+        cache.set(key,_to_snapshot(user),settings.USER_SNAPSHOT_CACHE_SECONDS)
+    return user
+
+
+class CachedJWTCookieAuthentication(JWTCookieAuthentication):
+    """
+    JWTCookieAuthentication that resolves the token's user with get_cached_user
+    """
+
+    def get_user(self,validated_token):
+        try:
+            user_id=validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user=get_cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"),code="user_not_found")
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"),code="user_inactive")
+        return user
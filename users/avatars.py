@@ -0,0 +1,127 @@
+"""
+Resized avatar variants.
+
+Uploads are stored as they come and decoded later by the process_avatar
+task, which writes every size in AVATAR_VARIANTS in every format in
+AVATAR_FORMATS. The paths are kept on Profile.avatar_variants next to the
+name of the upload they were made from, so variants of a replaced avatar
+are never handed out.
+
+Files of replaced avatars stay in storage until collect_avatar_garbage
+finds that no profile references them.
+"""
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .models import Profile
+from .storage import collect_garbage
+
+SOURCE_KEY="source"
+
+
+def get_storage():
+    """Return the storage of Profile.avatar, the variants are kept next to the uploads"""
+
+    return Profile._meta.get_field("avatar").storage
+
+
+def _cover(image,size):
+    """Crop image to the aspect ratio of size around its centre and scale it down to size"""
+
+    width,height=size
+    scale=min(image.width/width,image.height/height)
+    crop_width,crop_height=round(width*scale),round(height*scale)
+    left=(image.width-crop_width)//2
+    top=(image.height-crop_height)//2
+    # reducing_gap halves the image with reduce() before the final resample, much faster on big photos
+    return image.resize(
+        size,
+        Image.Resampling.LANCZOS,
+        box=(left,top,left+crop_width,top+crop_height),
+        reducing_gap=3.0,
+    )
+
+
+def render_variants(file,variants=None,formats=None):
+    """
+    Return {(variant, format): bytes} for the image in file, every variant
+    cropped to its size and encoded in every format
+    """
+    variants=variants or settings.AVATAR_VARIANTS
+    formats=formats or settings.AVATAR_FORMATS
+
+    with Image.open(file) as image:
+        largest=max(variants.values())
+        # JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale when that still covers the largest variant
+        image.draft("RGB",largest)
+        image=ImageOps.exif_transpose(image)
+        if image.mode!="RGB":
+            image=image.convert("RGBA").convert("RGB") if "transparency" in image.info else image.convert("RGB")
+
+        rendered={}
+        for name,size in variants.items():
+            variant=_cover(image,tuple(size))
+            for extension,options in formats.items():
+                buffer=io.BytesIO()
+                variant.save(buffer,**options)
+                rendered[name,extension]=buffer.getvalue()
+    return rendered
+
+
+def variant_path(avatar_name,variant,extension):
+    stem=os.path.splitext(os.path.basename(avatar_name))[0]
+    return f"avatar/variants/{stem}-{variant}.{extension}"
+
+
+def store_variants(avatar_name,rendered,storage=None):
+    """Save rendered variants and return the avatar_variants value pointing at them"""
+
+    storage=storage or get_storage()
+    paths={SOURCE_KEY:avatar_name}
+    for (variant,extension),content in rendered.items():
+        name=storage.save(variant_path(avatar_name,variant,extension),ContentFile(content))
+        paths.setdefault(variant,{})[extension]=name
+    return paths
+
+
+def referenced_files():
+    """Return the name of every avatar and variant file a profile points at"""
+
+    names=set()
+    for avatar,variants in Profile.objects.exclude(avatar="").values_list("avatar","avatar_variants").iterator():
+        names.add(avatar)
+        for variant,paths in (variants or {}).items():
+            if variant!=SOURCE_KEY:
+                names.update(paths.values())
+    return names
+
+
+def collect_avatar_garbage(grace_seconds=None,dry_run=False,storage=None):
+    """Delete avatar files no profile references, see users.storage.collect_garbage"""
+
+    storage=storage or get_storage()
+    if grace_seconds is None:
+        grace_seconds=settings.AVATAR_GC_GRACE_SECONDS
+    if not storage.exists("avatar"):
+        return []
+    # saving a file, new or deduplicated, refreshes its mtime, so one referenced after this read is within the grace period
+    return collect_garbage(storage,referenced_files(),"avatar",grace_seconds,dry_run)
+
+
+def variant_urls(profile,storage=None):
+    """
+    Return {variant: {format: url}} for the current avatar of profile, or
+    None while there is no avatar or its variants are not made yet
+    """
+    storage=storage or get_storage()
+    variants=profile.avatar_variants or {}
+    if not profile.avatar or variants.get(SOURCE_KEY)!=profile.avatar.name:
+        return None
+    return {
+        variant:{extension:storage.url(name) for extension,name in paths.items()}
+        for variant,paths in variants.items() if variant!=SOURCE_KEY
+    }
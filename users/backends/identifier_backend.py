@@ -0,0 +1,71 @@
+from django.contrib.auth.backends import ModelBackend
+from users.authentication import get_cached_user
+from users.models import User
+from users.phone import parse_phone_number
+
+LOGIN_FIELDS=(
+    "id",
+    "password",
+    "email",
+    "phone_number",
+    "first_name",
+    "last_name",
+    "username",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "last_login",
+    "date_joined",
+    "phone__id",
+    "phone__user_id",
+    "phone__is_verified",
+)
+
+
+class IdentifierAuthBackend(ModelBackend):
+    """
+    Custom authentication backend to login users using email address or phone.
+
+    The identifier is classified once and resolved with a single query that
+    also loads the user's OTP verification state.
+    """
+
+    def get_lookup(self,username):
+        """Return the User lookup for username, or None if it is neither an email nor a valid phone number"""
+
+        if "@" in username:
+            return {"email":username}
+        phone_number=parse_phone_number(username)
+        if phone_number is None:
+            return None
+        # a PhoneNumber is only formatted for the query, a string would be parsed again
+        return {"phone_number":phone_number}
+
+    def get_user_by_identifier(self,username):
+        lookup=self.get_lookup(str(username))
+        if lookup is None:
+            return None
+        return (
+            User.objects.select_related("phone")
+            .only(*LOGIN_FIELDS)
+            .filter(**lookup)
+            .first()
+        )
+
+    def authenticate(self,request,username=None,password=None,**kwargs):
+        if username is None or password is None:
+            return
+
+        user=self.get_user_by_identifier(username)
+
+        if user is None:
+            # Run the password hasher anyway so an unknown identifier takes as long as a wrong password
+            User().set_password(password)
+            return
+
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+
+    def get_user(self,user_id):
+        user=get_cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
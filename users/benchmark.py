@@ -0,0 +1,259 @@
+"""
+Load benchmark of the auth flows, run with the bench_auth_flows command.
+
+Two flows are driven through the WSGI handler from concurrent clients:
+
+* signup: register, send the OTP again, verify it
+* returning: login, fetch the user, list the addresses
+
+Every request is timed and its SQL statements counted. The summary can
+be saved as a JSON baseline and later runs compared against it.
+"""
+import queue
+import statistics
+import threading
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+
+from . import sms
+from .middleware import QueryTimer
+from .models import OTP,Address,Profile,User
+
+PASSWORD="Xk2!pQ9#rT"
+
+FLOWS={
+    "signup":("register","send_otp","verify"),
+    "returning":("login","user","addresses"),
+}
+
+
+def seeded_phone(index):
+    return f"+2519110{index:05d}"
+
+
+def signup_identifier(index):
+    # alternate between the SMS and the email path
+    if index%2:
+        return "phone_number",f"+2519220{index:05d}"
+    return "email",f"bench-{index}@etrade.local"
+
+
+def seed(users,addresses_per_user,batch_size=1000):
+    """Insert users with a verified phone, a profile and addresses, all sharing one password hash"""
+
+    password=make_password(PASSWORD)
+    for start in range(0,users,batch_size):
+        with transaction.atomic():
+            batch=User.objects.bulk_create(
+                User(username=seeded_phone(i),phone_number=seeded_phone(i),password=password)
+                for i in range(start,min(start+batch_size,users))
+            )
+            if batch[0].pk is None:
+                batch=list(User.objects.filter(username__in=[user.username for user in batch]))
+            Profile.objects.bulk_create(Profile(user=user) for user in batch)
+            OTP.objects.bulk_create(OTP(user=user,is_verified=True) for user in batch)
+            Address.objects.bulk_create(
+                Address(
+                    user=user,
+                    address_type=Address.SHIPPING,
+                    country="ET",
+                    city="Addis Ababa",
+                    street_address=f"Street {i}",
+                    apartment_address="1",
+                )
+                for user in batch for i in range(addresses_per_user)
+            )
+
+
+class Recorder:
+    """Collect the time and query count of every request, per flow and step"""
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.steps={}
+        self.flows={}
+        self.errors={}
+
+    def request(self,flow,step,send):
+        queries=QueryTimer()
+        start=time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response=send()
+        elapsed=(time.perf_counter()-start)*1000
+        with self.lock:
+            self.steps.setdefault((flow,step),[]).append((elapsed,queries.count))
+        if response.status_code>=400:
+            raise FlowError(f"{step} returned {response.status_code}")
+        return elapsed,queries.count
+
+    def flow_done(self,flow,elapsed,queries):
+        with self.lock:
+            self.flows.setdefault(flow,[]).append((elapsed,queries))
+
+    def flow_failed(self,flow,error):
+        with self.lock:
+            self.errors.setdefault(flow,[]).append(str(error))
+
+
+class FlowError(Exception):
+    pass
+
+
+def _latest_code(field,recipient):
+    """Read the last code sent to recipient from the outbox of the local SMS or mail backend"""
+
+    if field=="phone_number":
+        bodies=[message.body for message in sms.outbox if message.to==recipient]
+    else:
+        bodies=[message.body for message in mail.outbox if recipient in message.to]
+    return bodies[-1][-6:]
+
+
+def run_signup(recorder,client,index):
+    field,identifier=signup_identifier(index)
+    if field=="phone_number":
+        send_url,verify_url=reverse("users:send_resend_sms"),reverse("users:verify_phone_number")
+    else:
+        send_url,verify_url=reverse("users:send_resend_email"),reverse("users:verify_otp")
+
+    steps=[
+        ("register",lambda:client.post(
+            reverse("users:user_register"),
+            {field:identifier,"password1":PASSWORD,"password2":PASSWORD},
+            content_type="application/json",
+        )),
+        ("send_otp",lambda:client.post(send_url,{field:identifier},content_type="application/json")),
+        ("verify",lambda:client.post(
+            verify_url,
+            {field:identifier,"otp":_latest_code(field,identifier)},
+            content_type="application/json",
+        )),
+    ]
+    return _run("signup",recorder,steps)
+
+
+def run_returning(recorder,client,index):
+    steps=[
+        ("login",lambda:client.post(
+            reverse("users:user_login"),
+            {"phone_number":seeded_phone(index),"password":PASSWORD},
+            content_type="application/json",
+        )),
+        ("user",lambda:client.get(reverse("users:user_detail"))),
+        ("addresses",lambda:client.get(reverse("users:address-list"))),
+    ]
+    return _run("returning",recorder,steps)
+
+
+def _run(flow,recorder,steps):
+    total=0.0
+    queries=0
+    try:
+        for step,send in steps:
+            elapsed,count=recorder.request(flow,step,send)
+            total+=elapsed
+            queries+=count
+    except FlowError as e:
+        recorder.flow_failed(flow,e)
+        return
+    recorder.flow_done(flow,total,queries)
+
+
+def run(flows,concurrency):
+    """
+    Run every (runner, index) in flows on concurrency client threads and
+    return the recorder and the wall time in seconds
+    """
+    recorder=Recorder()
+    pending=queue.Queue()
+    for item in flows:
+        pending.put(item)
+
+    def worker():
+        try:
+            while True:
+                try:
+                    runner,index=pending.get_nowait()
+                except queue.Empty:
+                    return
+                runner(recorder,Client(raise_request_exception=False),index)
+        finally:
+            # a test database cannot be dropped while workers are connected
+            connection.close()
+
+    threads=[threading.Thread(target=worker) for _ in range(concurrency)]
+    start=time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder,time.perf_counter()-start
+
+
+def percentiles(timings):
+    if len(timings)<2:
+        value=timings[0] if timings else 0.0
+        return value,value,value
+    cuts=statistics.quantiles(timings,n=100,method="inclusive")
+    return cuts[49],cuts[94],cuts[98]
+
+
+def _stats(samples):
+    p50,p95,p99=percentiles([elapsed for elapsed,_ in samples])
+    return {
+        "count":len(samples),
+        "p50_ms":round(p50,2),
+        "p95_ms":round(p95,2),
+        "p99_ms":round(p99,2),
+        "queries":max((queries for _,queries in samples),default=0),
+    }
+
+
+def summarize(recorder,elapsed,config):
+    """Return the JSON serializable results of a run"""
+
+    flows={}
+    for flow,steps in FLOWS.items():
+        samples=recorder.flows.get(flow,[])
+        flows[flow]={
+            **_stats(samples),
+            "errors":len(recorder.errors.get(flow,[])),
+            "throughput":round(len(samples)/elapsed,2) if elapsed else 0.0,
+            "steps":{step:_stats(recorder.steps.get((flow,step),[])) for step in steps},
+        }
+    return {"config":config,"elapsed_s":round(elapsed,3),"flows":flows}
+
+
+def compare(baseline,current,threshold):
+    """
+    Return a message for every regression of current against baseline:
+    p95 latency up or throughput down by more than threshold (a fraction),
+    or any statement more per flow or step
+    """
+    regressions=[]
+    for flow,base in baseline["flows"].items():
+        now=current["flows"].get(flow)
+        if now is None:
+            regressions.append(f"{flow}: missing from this run")
+            continue
+        if now["errors"]>base["errors"]:
+            regressions.append(f"{flow}: {now['errors']} failed flows, baseline {base['errors']}")
+        if now["throughput"]<base["throughput"]*(1-threshold):
+            regressions.append(f"{flow}: throughput {now['throughput']}/s, baseline {base['throughput']}/s")
+
+        for name,base_stats,now_stats in [(flow,base,now)]+[
+            (f"{flow}.{step}",stats,now["steps"].get(step,{})) for step,stats in base["steps"].items()
+        ]:
+            if not now_stats:
+                regressions.append(f"{name}: missing from this run")
+                continue
+            if now_stats["p95_ms"]>base_stats["p95_ms"]*(1+threshold):
+                regressions.append(f"{name}: p95 {now_stats['p95_ms']}ms, baseline {base_stats['p95_ms']}ms")
+            if now_stats["queries"]>base_stats["queries"]:
+                regressions.append(f"{name}: {now_stats['queries']} queries, baseline {base_stats['queries']}")
+    return regressions
@@ -0,0 +1,63 @@
+"""
+Per-user response cache for the authenticated read endpoints.
+
+Cached responses are keyed by the user id and a per-user version number.
+Any save or delete of the user, their profile or their addresses bumps the
+version, which makes every response cached for that user unreachable.
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+VERSION_KEY="user_response_version_%s"
+
+
+def get_version(user_id,key_format=VERSION_KEY):
+    key=key_format%user_id
+    version=cache.get(key)
+    if version is None:
+        # start from the clock so a version evicted from the cache never comes back with an old value
+        cache.add(key,int(time.time()*1000),None)
+        version=cache.get(key)
+    return version
+
+
+def bump_version(user_id,key_format=VERSION_KEY):
+    key=key_format%user_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key,int(time.time()*1000),None)
+
+
+def response_cache_key(user_id,request):
+    path=hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f"user_response_{user_id}_{get_version(user_id)}_{path}"
+
+
+def cache_per_user(view_method):
+    """
+    Cache the data of successful responses of a DRF handler for the
+    authenticated user, anonymous requests are not cached
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self,request,*args,**kwargs):
+        if not request.user.is_authenticated:
+            return view_method(self,request,*args,**kwargs)
+
+        key=response_cache_key(request.user.pk,request)
+        data=cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        response=view_method(self,request,*args,**kwargs)
+        if response.status_code==200:
+            cache.set(key,response.data,settings.USER_RESPONSE_CACHE_SECONDS)
+        return response
+
+    return wrapper
@@ -0,0 +1,148 @@
+"""
+Streaming export of users with their profile and addresses.
+
+Users and addresses are read with two ``iterator()`` cursors ordered by
+user id and merged as they go, so nothing but the current user's
+addresses is held in memory. The output is produced as byte chunks that
+can be written to a file or handed to a ``StreamingHttpResponse``.
+"""
+import csv
+import datetime
+import json
+import zlib
+
+from .models import Address,User
+
+USER_FIELDS=(
+    "id",
+    "username",
+    "email",
+    "phone_number",
+    "first_name",
+    "last_name",
+    "is_active",
+    "date_joined",
+    "last_login",
+)
+PROFILE_FIELDS=("avatar","bio")
+ADDRESS_FIELDS=(
+    "id",
+    "address_type",
+    "default",
+    "country",
+    "city",
+    "street_address",
+    "apartment_address",
+    "postal_code",
+    "created_at",
+)
+
+FORMATS={
+    "ndjson":"application/x-ndjson",
+    "csv":"text/csv",
+}
+
+CHUNK_BYTES=64*1024
+
+
+def _value(value):
+    if value is None or isinstance(value,(bool,int,str)):
+        return value
+    if isinstance(value,(datetime.date,datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def iter_users(chunk_size=2000):
+    """
+    Yield one dict per user with its profile and the list of its addresses
+    """
+    users=(
+        User.objects.order_by("id")
+        .values_list(*USER_FIELDS,*(f"profile__{name}" for name in PROFILE_FIELDS))
+        .iterator(chunk_size=chunk_size)
+    )
+    addresses=(
+        Address.objects.order_by("user_id","id")
+        .values_list("user_id",*ADDRESS_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+
+    address=next(addresses,None)
+    for row in users:
+        record={name:_value(value) for name,value in zip(USER_FIELDS,row)}
+        record["profile"]={name:_value(value) for name,value in zip(PROFILE_FIELDS,row[len(USER_FIELDS):])}
+        record["addresses"]=[]
+
+        # both cursors are ordered by user id, skip addresses of users deleted meanwhile
+        while address is not None and address[0]<record["id"]:
+            address=next(addresses,None)
+        while address is not None and address[0]==record["id"]:
+            record["addresses"].append({name:_value(value) for name,value in zip(ADDRESS_FIELDS,address[1:])})
+            address=next(addresses,None)
+        yield record
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record,separators=(",",":")).encode()+b"\n"
+
+
+class _Echo:
+    """File-like object for csv.writer that hands back the line instead of storing it"""
+
+    def write(self,value):
+        return value
+
+
+def csv_lines(records):
+    """One line per address, users without addresses get a single line with blank address columns"""
+
+    columns=(
+        list(USER_FIELDS)
+        +[f"profile_{name}" for name in PROFILE_FIELDS]
+        +[f"address_{name}" for name in ADDRESS_FIELDS]
+    )
+    writer=csv.writer(_Echo())
+    yield writer.writerow(columns).encode()
+
+    blank={name:None for name in ADDRESS_FIELDS}
+    for record in records:
+        user=[record[name] for name in USER_FIELDS]+[record["profile"][name] for name in PROFILE_FIELDS]
+        for address in record["addresses"] or [blank]:
+            yield writer.writerow(user+[address[name] for name in ADDRESS_FIELDS]).encode()
+
+
+def buffered(chunks,size=CHUNK_BYTES):
+    """Join small chunks into pieces of about size bytes"""
+
+    buffer=[]
+    length=0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length+=len(chunk)
+        if length>=size:
+            yield b"".join(buffer)
+            buffer=[]
+            length=0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzipped(chunks):
+    """Compress chunks into a gzip stream on the fly"""
+
+    compressor=zlib.compressobj(wbits=zlib.MAX_WBITS|16)
+    for chunk in chunks:
+        data=compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_users(format="ndjson",compress=False,chunk_size=2000):
+    """Return an iterator of byte chunks with every user in format"""
+
+    lines=ndjson_lines if format=="ndjson" else csv_lines
+    chunks=buffered(lines(iter_users(chunk_size)))
+    return gzipped(chunks) if compress else chunks
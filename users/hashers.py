@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher as BasePBKDF2PasswordHasher
+
+from .metrics import PASSWORD_HASH_SECONDS
+
+# a list while hashing in a pool process, see users.hashing, whose parent records the timings
+collected=None
+
+
+class PBKDF2PasswordHasher(BasePBKDF2PasswordHasher):
+    """
+    PBKDF2 hasher whose work factor comes from PASSWORD_PBKDF2_ITERATIONS.
+
+    Stored hashes keep working when the setting changes, they are upgraded
+    to the new cost the next time the user logs in.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings,"PASSWORD_PBKDF2_ITERATIONS",BasePBKDF2PasswordHasher.iterations)
+
+    def encode(self,password,salt,iterations=None):
+        # checks encode too, so logins are timed as well as new passwords
+        start=time.perf_counter()
+        try:
+            return super().encode(password,salt,iterations)
+        finally:
+            elapsed=time.perf_counter()-start
+            if collected is None:
+                PASSWORD_HASH_SECONDS.labels(self.algorithm).observe(elapsed)
+            else:
+                collected.append((self.algorithm,elapsed))
@@ -0,0 +1,130 @@
+"""
+Password hash checks off the event loop.
+
+Verifications run on a bounded thread or process pool. When every worker
+is busy and the wait queue is full, new checks are refused with
+HashQueueFull instead of piling up behind the pool.
+
+Hashes timed in a pool process are handed back with the result and
+recorded by the parent, the metrics of the child process are never
+scraped.
+"""
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import hashers
+from .metrics import PASSWORD_HASH_SECONDS
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+_lock=threading.Lock()
+_executor=None
+_pending=0
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                workers=settings.PASSWORD_HASH_WORKERS
+                if settings.PASSWORD_HASH_EXECUTOR=="process":
+                    _executor=ProcessPoolExecutor(max_workers=workers)
+                else:
+                    _executor=ThreadPoolExecutor(max_workers=workers,thread_name_prefix="password-hash")
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+
+    with _lock:
+        executor,_executor=_executor,None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+@receiver(setting_changed)
+def reset_executor(setting,**kwargs):
+    if setting.startswith("PASSWORD_HASH"):
+        shutdown_executor()
+
+
+def _acquire():
+    global _pending
+
+    limit=settings.PASSWORD_HASH_WORKERS+settings.PASSWORD_HASH_QUEUE_SIZE
+    with _lock:
+        if _pending>=limit:
+            raise HashQueueFull()
+        _pending+=1
+
+
+def _release():
+    global _pending
+
+    with _lock:
+        _pending-=1
+
+
+def verify_password(password,encoded):
+    """
+    Return (is_valid, must_update) for password against encoded, or
+    hash password once and return (False, False) if there is no encoded
+    password so unknown users cost the same as known ones
+    """
+    if encoded is None:
+        make_password(password)
+        return False,False
+
+    valid=check_password(password,encoded)
+    must_update=valid and identify_hasher(encoded).must_update(encoded)
+    return valid,must_update
+
+
+def _collecting(func,*args):
+    """Run func in a pool process and return its result with the hash timings it made"""
+
+    hashers.collected=[]
+    try:
+        return func(*args),hashers.collected
+    finally:
+        hashers.collected=None
+
+
+async def _run(func,*args):
+    _acquire()
+    try:
+        loop=asyncio.get_running_loop()
+        executor=get_executor()
+        if not isinstance(executor,ProcessPoolExecutor):
+            return await loop.run_in_executor(executor,func,*args)
+
+        result,timings=await loop.run_in_executor(executor,_collecting,func,*args)
+        for algorithm,elapsed in timings:
+            PASSWORD_HASH_SECONDS.labels(algorithm).observe(elapsed)
+        return result
+    finally:
+        _release()
+
+
+async def averify_password(password,encoded):
+    """Run verify_password on the hashing pool"""
+
+    return await _run(verify_password,password,encoded)
+
+
+async def amake_password(password):
+    """Run make_password on the hashing pool"""
+
+    return await _run(make_password,password)
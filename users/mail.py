@@ -0,0 +1,101 @@
+"""
+Long-lived mail connections for OTP emails.
+
+Every worker thread keeps one open connection to the mail server and
+reuses it for all the messages it sends, so STARTTLS and login are paid
+once per worker instead of once per email.
+"""
+import smtplib
+import threading
+
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+RECONNECT_ERRORS=(smtplib.SMTPServerDisconnected,ConnectionError,TimeoutError)
+
+
+class BatchInterrupted(Exception):
+    """A batch stopped part way, the first sent messages were delivered"""
+
+    def __init__(self,sent,error):
+        super().__init__(str(error))
+        self.sent=sent
+        self.error=error
+
+
+class PersistentMailer:
+    """
+    Keep a mail backend connection open between sends and reconnect once
+    if the server dropped it
+    """
+
+    def __init__(self,backend=None,**kwargs):
+        self.backend=backend
+        self.kwargs=kwargs
+        self.connection=None
+
+    def open(self):
+        if self.connection is None:
+            connection=get_connection(self.backend,**self.kwargs)
+            connection.open()
+            self.connection=connection
+        return self.connection
+
+    def close(self):
+        connection,self.connection=self.connection,None
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            # the socket is already gone, nothing left to clean up
+            pass
+
+    def send_messages(self,messages):
+        """
+        Send messages in order over one connection and return the number sent.
+
+        After a dropped connection the batch resumes at the message that
+        failed, the ones before it are not sent twice. Any other error, or a
+        second drop, raises BatchInterrupted with the count of messages
+        handed over before it.
+        """
+        sent=0
+        index=0
+        reconnected=False
+        while index<len(messages):
+            try:
+                sent+=self.open().send_messages(messages[index:index+1])
+            except RECONNECT_ERRORS as e:
+                self.close()
+                if reconnected:
+                    raise BatchInterrupted(index,e) from e
+                reconnected=True
+                continue
+            except Exception as e:
+                raise BatchInterrupted(index,e) from e
+            index+=1
+        return sent
+
+
+_local=threading.local()
+
+
+def get_mailer():
+    """Return the mailer owned by the current worker thread"""
+
+    mailer=getattr(_local,"mailer",None)
+    if mailer is None:
+        mailer=_local.mailer=PersistentMailer()
+    return mailer
+
+
+@receiver(setting_changed)
+def reset_mailer(setting,**kwargs):
+    if setting.startswith("EMAIL_"):
+        get_mailer().close()
+
+
+def send_otp_emails(messages):
+    return get_mailer().send_messages(messages)
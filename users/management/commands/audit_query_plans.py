@@ -0,0 +1,137 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from users.backends.identifier_backend import LOGIN_FIELDS
+from users.models import Address,OTP,OTPDispatch,User
+from users.purge import expired_otps,finished_dispatches
+
+# a plan line is a full table scan when it matches one of these, per database vendor
+TABLE_SCAN_PATTERNS={
+    "sqlite":re.compile(r"\bSCAN (?!.*\bUSING\b)(\w+)"),
+    "postgresql":re.compile(r"Seq Scan on (\w+)"),
+}
+
+EMAIL="seed-%d@etrade.local"
+PHONE="+2519%08d"
+
+
+def canonical_queries(sample):
+    """
+    Return (name, queryset, vendors) for every lookup the users app runs on
+    a hot path, vendors is None when the query applies to every database
+    """
+    user_id,email,phone=sample["user_id"],sample["email"],sample["phone"]
+
+    return [
+        ("user by email",User.objects.filter(email=email),None),
+        ("user by email, case-insensitive",User.objects.filter(email__iexact=email),("postgresql",)),
+        ("user by phone number",User.objects.filter(phone_number=phone),None),
+        ("login lookup",User.objects.select_related("phone").only(*LOGIN_FIELDS).filter(email=email),None),
+        ("otp by user email",OTP.objects.filter(user__email=email),None),
+        ("otp by user phone number",OTP.objects.filter(user__phone_number=phone),None),
+        ("unverified otp of user",OTP.objects.filter(user_id=user_id,is_verified=False),None),
+        # users.purge deletes in primary key ranges
+        ("expired unverified otps",expired_otps().filter(pk__gte=user_id,pk__lt=user_id+1000).order_by(),None),
+        ("finished otp dispatches",finished_dispatches().filter(pk__gte=1,pk__lt=1000).order_by(),None),
+        ("address page",Address.objects.filter(user_id=user_id).order_by("-created_at","id")[:21],None),
+        (
+            "pending otp dispatches",
+            OTPDispatch.objects.filter(status=OTPDispatch.PENDING,id__gt=0).order_by("id")[:100],
+            None,
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help=(
+        "Run EXPLAIN on every canonical users query and fail if any of them "
+        "needs a full table scan. With --seed, the tables are first filled "
+        "with generated users, OTPs and addresses inside a transaction that "
+        "is rolled back afterwards."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--seed",type=int,default=0,metavar="USERS",help="Users to generate, e.g. 1000000")
+        parser.add_argument("--batch-size",type=int,default=10000)
+        parser.add_argument("--verbose-plans",action="store_true",help="Print the full plan of every query")
+
+    def handle(self,*args,**options):
+        vendor=connection.vendor
+        if vendor not in TABLE_SCAN_PATTERNS:
+            raise CommandError(f"Query plan audit is not supported on {vendor}.")
+
+        with transaction.atomic():
+            if options["seed"]:
+                self._seed(options["seed"],options["batch_size"])
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE")
+            failures=self._audit(vendor,options["verbose_plans"])
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f"{len(failures)} quer{'y' if len(failures)==1 else 'ies'} fell back to a table scan: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Every canonical query uses an index."))
+
+    def _sample(self):
+        user=User.objects.exclude(email=None).exclude(phone_number=None).order_by("-pk").first()
+        if user is None:
+            raise CommandError("No user with both an email and a phone number to query for, pass --seed.")
+        return {"user_id":user.pk,"email":user.email,"phone":str(user.phone_number)}
+
+    def _audit(self,vendor,verbose):
+        pattern=TABLE_SCAN_PATTERNS[vendor]
+        failures=[]
+
+        for name,queryset,vendors in canonical_queries(self._sample()):
+            if vendors and vendor not in vendors:
+                continue
+            plan=queryset.explain()
+            scans=pattern.findall(plan)
+            if scans:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f"SCAN  {name}: {', '.join(sorted(set(scans)))}"))
+            else:
+                self.stdout.write(f"ok    {name}")
+            if verbose or scans:
+                self.stdout.write("      "+plan.replace("\n","\n      "))
+        return failures
+
+    def _seed(self,count,batch_size):
+        """Insert count users, one OTP each (5% unverified) and addresses for one user in 100"""
+
+        start_pk=(User.objects.order_by("-pk").values_list("pk",flat=True).first() or 0)+1
+        now=timezone.now()
+
+        for offset in range(0,count,batch_size):
+            numbers=range(start_pk+offset,start_pk+min(offset+batch_size,count))
+            users=User.objects.bulk_create(
+                User(
+                    username=EMAIL%n,
+                    email=EMAIL%n,
+                    phone_number=PHONE%n,
+                    password="!",
+                )
+                for n in numbers
+            )
+            users=User.objects.filter(username__in=[user.username for user in users]).only("id")
+            OTP.objects.bulk_create(
+                OTP(user=user,security_code="000000",is_verified=user.pk%20!=0,sent=now)
+                for user in users
+            )
+            Address.objects.bulk_create(
+                Address(
+                    user=user,
+                    address_type=Address.SHIPPING,
+                    country="ET",
+                    city="Addis Ababa",
+                    street_address=f"Street {i}",
+                    apartment_address="1",
+                )
+                for user in users if user.pk%100==0
+                for i in range(20)
+            )
+            self.stdout.write(f"seeded {min(offset+batch_size,count)}/{count} users",ending="\r")
+        self.stdout.write("")
@@ -0,0 +1,86 @@
+import statistics
+import time
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.pagination import Cursor, LimitOffsetPagination
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from users.models import Address,User
+from users.pagination import AddressCursorPagination
+
+
+class Command(BaseCommand):
+    help=(
+        "Time address page fetches at increasing depths with offset and with "
+        "cursor pagination. Seeds one user in a transaction that is rolled back."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--addresses",type=int,default=100000)
+        parser.add_argument("--page-size",type=int,default=20)
+        parser.add_argument("--repeat",type=int,default=20)
+
+    def handle(self,*args,**options):
+        count=options["addresses"]
+        page_size=options["page_size"]
+        factory=APIRequestFactory(SERVER_NAME="localhost")
+
+        with transaction.atomic():
+            user=self._seed(count)
+            queryset=Address.objects.filter(user=user).select_related("user")
+            ordered_ids=list(queryset.order_by("-created_at","id").values_list("id",flat=True))
+
+            self.stdout.write(f"{'depth':>8} {'offset ms':>10} {'cursor ms':>10}")
+            for depth in sorted({0,count//100,count//10,count//2,max(count-page_size,0)}):
+                offset_ms=self._time(
+                    lambda:LimitOffsetPagination().paginate_queryset(
+                        queryset,Request(factory.get("/",{"limit":page_size,"offset":depth})),
+                    ),
+                    options["repeat"],
+                )
+                cursor=self._cursor_for(ordered_ids[depth-1]) if depth else None
+                params={"page_size":page_size,**({"cursor":cursor} if cursor else {})}
+                cursor_ms=self._time(
+                    lambda:AddressCursorPagination().paginate_queryset(
+                        queryset,Request(factory.get("/",params)),
+                    ),
+                    options["repeat"],
+                )
+                self.stdout.write(f"{depth:>8} {offset_ms:>10.2f} {cursor_ms:>10.2f}")
+
+            transaction.set_rollback(True)
+
+    def _seed(self,count):
+        user=User.objects.create(username="bench-addresses@etrade.local",email="bench-addresses@etrade.local")
+        batch=5000
+        for start in range(0,count,batch):
+            Address.objects.bulk_create(
+                Address(
+                    user=user,
+                    address_type=Address.SHIPPING,
+                    country="ET",
+                    city="Addis Ababa",
+                    street_address=f"Street {i}",
+                    apartment_address="1",
+                )
+                for i in range(start,min(start+batch,count))
+            )
+        return user
+
+    def _cursor_for(self,address_id):
+        paginator=AddressCursorPagination()
+        paginator.base_url="http://testserver/"
+        position=paginator._get_position_from_instance(Address.objects.get(pk=address_id),paginator.ordering)
+        url=paginator.encode_cursor(Cursor(offset=0,reverse=False,position=position))
+        return parse_qs(urlparse(url).query)["cursor"][0]
+
+    def _time(self,fetch,repeat):
+        timings=[]
+        for _ in range(repeat):
+            start=time.perf_counter()
+            fetch()
+            timings.append((time.perf_counter()-start)*1000)
+        return statistics.median(timings)
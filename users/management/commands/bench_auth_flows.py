@@ -0,0 +1,109 @@
+import json
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from etrade.celery import app as celery_app
+from users import sms
+from users.benchmark import FLOWS, compare, run, run_returning, run_signup, seed, summarize
+
+
+class Command(BaseCommand):
+    help=(
+        "Drive the signup (register, send OTP, verify) and returning (login, user, "
+        "addresses) flows concurrently through the WSGI handler and report "
+        "throughput, p50/p95/p99 latency and SQL statements per flow. Runs on a "
+        "throwaway test database with local SMS and mail backends. Run it on "
+        "PostgreSQL, SQLite serializes the concurrent writes."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--users",type=int,default=1000,help="Users seeded with addresses")
+        parser.add_argument("--addresses",type=int,default=5,help="Addresses per seeded user")
+        parser.add_argument("--flows",type=int,default=200,help="Runs of each flow")
+        parser.add_argument("--concurrency",type=int,default=8)
+        parser.add_argument("--pbkdf2-iterations",type=int,default=None,help="Defaults to PASSWORD_PBKDF2_ITERATIONS")
+        parser.add_argument("--save-baseline",metavar="PATH",help="Write the results to PATH")
+        parser.add_argument("--baseline",metavar="PATH",help="Fail if the results regress against PATH")
+        parser.add_argument("--threshold",type=float,default=0.2,help="Allowed latency and throughput change, as a fraction")
+        parser.add_argument("--noinput","--no-input",action="store_false",dest="interactive")
+
+    def handle(self,*args,**options):
+        if options["flows"]>options["users"]:
+            raise CommandError("--flows cannot exceed --users, every returning flow logs in a different seeded user")
+
+        baseline=None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline=json.load(f)
+
+        config={
+            "users":options["users"],
+            "addresses":options["addresses"],
+            "flows":options["flows"],
+            "concurrency":options["concurrency"],
+            "pbkdf2_iterations":options["pbkdf2_iterations"] or settings.PASSWORD_PBKDF2_ITERATIONS,
+            "database":connection.vendor,
+        }
+
+        old_name=connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0,autoclobber=not options["interactive"],serialize=False)
+        always_eager=celery_app.conf.task_always_eager
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS,"testserver"],
+                SMS_BACKEND="users.sms.backends.locmem.SMSBackend",
+                EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+                PASSWORD_PBKDF2_ITERATIONS=config["pbkdf2_iterations"],
+                REST_FRAMEWORK={**settings.REST_FRAMEWORK,"DEFAULT_THROTTLE_RATES":{}},
+            ):
+                # OTPs are delivered in the request, so the code can be read from the local outbox
+                celery_app.conf.task_always_eager=True
+                sms.outbox=[]
+                mail.outbox=[]
+
+                seed(options["users"],options["addresses"])
+                flows=[]
+                for index in range(options["flows"]):
+                    flows.append((run_signup,index))
+                    flows.append((run_returning,index))
+                recorder,elapsed=run(flows,options["concurrency"])
+        finally:
+            celery_app.conf.task_always_eager=always_eager
+            connection.creation.destroy_test_db(old_name,verbosity=0)
+
+        results=summarize(recorder,elapsed,config)
+        self._report(results,recorder)
+
+        if options["save_baseline"]:
+            with open(options["save_baseline"],"w") as f:
+                json.dump(results,f,indent=2)
+                f.write("\n")
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+
+        if baseline is not None:
+            if baseline["config"]!=config:
+                self.stderr.write("The baseline was recorded with a different configuration, results may not compare")
+            regressions=compare(baseline,results,options["threshold"])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n  "+"\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def _report(self,results,recorder):
+        self.stdout.write(f"{'flow':<22} {'runs':>6} {'errors':>6} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>7}")
+        for flow,steps in FLOWS.items():
+            stats=results["flows"][flow]
+            self._row(flow,stats,stats["errors"],stats["throughput"])
+            for step in steps:
+                self._row(f"  {step}",stats["steps"][step],"","")
+            for error in sorted(set(recorder.errors.get(flow,[]))):
+                self.stderr.write(f"  {flow} failed: {error}")
+
+    def _row(self,label,stats,errors,throughput):
+        self.stdout.write(
+            f"{label:<22} {stats['count']:>6} {errors:>6} {throughput:>8} "
+            f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['queries']:>7}"
+        )
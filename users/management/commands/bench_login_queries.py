@@ -0,0 +1,94 @@
+import time
+
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from users.models import OTP,User
+from users.phone import parse_phone_number
+
+BACKENDS=[
+    "users.backends.identifier_backend.IdentifierAuthBackend",
+]
+
+EMAIL="bench-login@etrade.local"
+PHONE="+251911000001"
+PASSWORD="Xk2!pQ9#rT"
+
+
+def legacy_authenticate(username,password):
+    """
+    The lookups of the phone and email backends IdentifierAuthBackend
+    replaced, kept as the baseline: the phone backend queries any username
+    that parses as a number, the email backend then queries every username
+    still unresolved, and the OTP is loaded on its own
+    """
+    phone_number=parse_phone_number(username)
+    if phone_number is not None:
+        user=User.objects.filter(phone_number=phone_number).first()
+        if user is not None and user.check_password(password):
+            return user
+    user=User.objects.filter(email=username).first()
+    if user is not None and user.check_password(password):
+        return user
+    return None
+
+
+class Command(BaseCommand):
+    help=(
+        "Compare the SQL statements and time of a login with the old "
+        "phone/email backend chain and with IdentifierAuthBackend, including "
+        "the OTP check. Runs in a transaction that is rolled back."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--repeat",type=int,default=5,help="Logins timed per case")
+
+    def handle(self,*args,**options):
+        cases=[
+            ("email, right password",EMAIL,PASSWORD),
+            ("phone, right password",PHONE,PASSWORD),
+            ("email, wrong password",EMAIL,"wrong"),
+            ("unknown email",f"missing-{EMAIL}",PASSWORD),
+            ("unknown phone","+251911999999",PASSWORD),
+        ]
+
+        with transaction.atomic():
+            self._seed()
+            self.stdout.write(f"{'case':<24} {'backends':<12} {'queries':>7} {'ms':>8}")
+            for label,username,password in cases:
+                for name,login in (("legacy",self._legacy),("identifier",self._authenticate)):
+                    queries,elapsed=self._login(login,username,password,options["repeat"])
+                    self.stdout.write(f"{label:<24} {name:<12} {queries:>7} {elapsed*1000:>8.1f}")
+            transaction.set_rollback(True)
+
+    def _seed(self):
+        for username,email,phone in ((EMAIL,EMAIL,None),(PHONE,None,PHONE)):
+            user=User(username=username,email=email,phone_number=phone)
+            user.set_password(PASSWORD)
+            user.save()
+            OTP.objects.create(user=user,is_verified=True)
+
+    def _login(self,login,username,password,repeat):
+        """Return the queries of one login and its mean time, including the OTP check"""
+
+        with override_settings(AUTHENTICATION_BACKENDS=BACKENDS):
+            with CaptureQueriesContext(connection) as ctx:
+                login(username,password)
+            start=time.perf_counter()
+            for _ in range(repeat):
+                login(username,password)
+            elapsed=(time.perf_counter()-start)/repeat
+        return len(ctx.captured_queries),elapsed
+
+    def _authenticate(self,username,password):
+        user=authenticate(username=username,password=password)
+        if user is not None:
+            # the backend selects the OTP with the user, this must not query
+            getattr(user,"phone",None)
+
+    def _legacy(self,username,password):
+        user=legacy_authenticate(username,password)
+        if user is not None:
+            OTP.objects.filter(user=user).first()
@@ -0,0 +1,61 @@
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+
+from users.mail import PersistentMailer
+
+SMTP_BACKEND="django.core.mail.backends.smtp.EmailBackend"
+
+
+class Command(BaseCommand):
+    help=(
+        "Measure OTP email throughput against a local debugging SMTP server, "
+        "e.g. `python -m aiosmtpd -n -l localhost:1025`. Compares one connection "
+        "per email with the persistent batched connection used by the workers."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--host",default="localhost")
+        parser.add_argument("--port",type=int,default=1025)
+        parser.add_argument("--count",type=int,default=500,help="Emails sent per mode")
+        parser.add_argument("--batch-size",type=int,default=50)
+        parser.add_argument("--use-tls",action="store_true")
+        parser.add_argument("--username",default="")
+        parser.add_argument("--password",default="")
+
+    def handle(self,*args,**options):
+        connection_kwargs={
+            "host":options["host"],
+            "port":options["port"],
+            "use_tls":options["use_tls"],
+            "username":options["username"],
+            "password":options["password"],
+        }
+        count=options["count"]
+        batch_size=options["batch_size"]
+        messages=[
+            EmailMessage(
+                subject="Email Verification",
+                body=f"Your OTP code is : {i:06d}",
+                from_email="bench@etrade.local",
+                to=[f"user{i}@etrade.local"],
+            )
+            for i in range(count)
+        ]
+
+        start=time.perf_counter()
+        for message in messages:
+            message.connection=get_connection(SMTP_BACKEND,**connection_kwargs)
+            message.send()
+        self._report("connection per email",count,time.perf_counter()-start)
+
+        mailer=PersistentMailer(SMTP_BACKEND,**connection_kwargs)
+        start=time.perf_counter()
+        for i in range(0,count,batch_size):
+            mailer.send_messages(messages[i:i+batch_size])
+        mailer.close()
+        self._report(f"persistent, batches of {batch_size}",count,time.perf_counter()-start)
+
+    def _report(self,label,count,elapsed):
+        self.stdout.write(f"{label:<32} {count} emails in {elapsed:.2f}s ({count/elapsed:.1f}/s)")
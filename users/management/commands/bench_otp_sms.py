@@ -0,0 +1,160 @@
+import asyncio
+import queue
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from etrade.celery import app as celery_app
+from users.benchmark import percentiles
+from users.models import User
+from users.sms.backends.base import BaseSMSBackend
+
+LATENCY_BACKEND="users.management.commands.bench_otp_sms.LatencySMSBackend"
+
+
+class LatencySMSBackend(BaseSMSBackend):
+    """Backend that waits latency seconds per message instead of calling the provider"""
+
+    latency=0.2
+
+    def send_messages(self,messages):
+        for message in messages:
+            time.sleep(self.latency)
+        return len(messages)
+
+    async def asend_messages(self,messages):
+        for message in messages:
+            await asyncio.sleep(self.latency)
+        return len(messages)
+
+
+def phone(index):
+    return f"+2519330{index:05d}"
+
+
+def seed(count):
+    User.objects.bulk_create(User(username=phone(i),phone_number=phone(i)) for i in range(count))
+
+
+def _post(client,url,phone_number):
+    return client.post(url,{"phone_number":phone_number},content_type="application/json")
+
+
+def run_wsgi(phone_numbers,concurrency):
+    """
+    POST every number to send-sms/ through the WSGI handler from
+    concurrency threads and return the (seconds, status) of each request
+    and the wall time
+    """
+    url=reverse("users:send_resend_sms")
+    pending=queue.Queue()
+    for phone_number in phone_numbers:
+        pending.put(phone_number)
+    results=[]
+
+    def worker():
+        client=Client(raise_request_exception=False)
+        try:
+            while True:
+                try:
+                    phone_number=pending.get_nowait()
+                except queue.Empty:
+                    return
+                start=time.perf_counter()
+                response=_post(client,url,phone_number)
+                results.append((time.perf_counter()-start,response.status_code))
+        finally:
+            # a test database cannot be dropped while workers are connected
+            connection.close()
+
+    threads=[threading.Thread(target=worker) for _ in range(concurrency)]
+    start=time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results,time.perf_counter()-start
+
+
+async def run_asgi(phone_numbers,concurrency):
+    """
+    POST every number to send-sms/async/ through the ASGI handler with
+    up to concurrency requests in flight, see run_wsgi
+    """
+    url=reverse("users:send_resend_sms_async")
+    client=AsyncClient(raise_request_exception=False)
+    slots=asyncio.Semaphore(concurrency)
+    results=[]
+
+    async def send(phone_number):
+        async with slots:
+            start=time.perf_counter()
+            response=await _post(client,url,phone_number)
+            results.append((time.perf_counter()-start,response.status_code))
+
+    start=time.perf_counter()
+    await asyncio.gather(*(send(phone_number) for phone_number in phone_numbers))
+    elapsed=time.perf_counter()-start
+    # the ORM work of the async views ran on the sync_to_async thread, close its connection there
+    await sync_to_async(lambda:connection.close())()
+    return results,elapsed
+
+
+class Command(BaseCommand):
+    help=(
+        "Compare the OTP SMS send path deployed under WSGI (send-sms/ on worker "
+        "threads, delivered by the eager Celery task) and under ASGI "
+        "(send-sms/async/, delivered in the view with asend_messages), with a "
+        "provider of simulated latency as SMS_BACKEND. Both run through the "
+        "full handler and middleware on a throwaway test database. Run it on "
+        "PostgreSQL, SQLite serializes the concurrent writes."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--requests",type=int,default=500,help="Requests sent per deployment")
+        parser.add_argument("--concurrency",type=int,default=32,help="WSGI worker threads, and ASGI requests in flight")
+        parser.add_argument("--latency",type=float,default=0.2,help="Seconds the provider takes per message")
+        parser.add_argument("--noinput","--no-input",action="store_false",dest="interactive")
+
+    def handle(self,*args,**options):
+        count=options["requests"]
+        concurrency=options["concurrency"]
+        LatencySMSBackend.latency=options["latency"]
+
+        old_name=connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0,autoclobber=not options["interactive"],serialize=False)
+        always_eager=celery_app.conf.task_always_eager
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS,"testserver"],
+                SMS_BACKEND=LATENCY_BACKEND,
+                REST_FRAMEWORK={**settings.REST_FRAMEWORK,"DEFAULT_THROTTLE_RATES":{}},
+            ):
+                # the WSGI view hands the message to Celery, delivered in the request like the async view does
+                celery_app.conf.task_always_eager=True
+                seed(2*count)
+                # every request goes to a different user, so the two runs never share OTP rows
+                wsgi=run_wsgi([phone(i) for i in range(count)],concurrency)
+                asgi=asyncio.run(run_asgi([phone(i) for i in range(count,2*count)],concurrency))
+        finally:
+            celery_app.conf.task_always_eager=always_eager
+            connection.creation.destroy_test_db(old_name,verbosity=0)
+
+        self.stdout.write(f"{'deployment':<12} {'requests':>8} {'errors':>6} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        self._report("wsgi",*wsgi)
+        self._report("asgi",*asgi)
+
+    def _report(self,label,results,elapsed):
+        p50,p95,p99=percentiles([seconds*1000 for seconds,_ in results])
+        errors=sum(1 for _,status in results if status!=200)
+        self.stdout.write(
+            f"{label:<12} {len(results):>8} {errors:>6} {len(results)/elapsed if elapsed else 0:>8.1f} "
+            f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f}"
+        )
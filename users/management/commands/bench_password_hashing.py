@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from users import hashing
+
+PASSWORD="Xk2!pQ9#rT"
+
+
+class Command(BaseCommand):
+    help=(
+        "Report password checks per second, overall and per core, for each "
+        "hasher cost and executor used by the async login view."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            nargs="+",
+            default=[settings.PASSWORD_PBKDF2_ITERATIONS,100000],
+            help="PBKDF2 iteration counts to compare",
+        )
+        parser.add_argument("--executors",nargs="+",default=["thread","process"],choices=["thread","process"])
+        parser.add_argument("--workers",type=int,default=os.cpu_count())
+        parser.add_argument("--logins",type=int,default=200,help="Checks per configuration")
+
+    def handle(self,*args,**options):
+        workers=options["workers"]
+        self.stdout.write(f"{'iterations':>10} {'executor':<8} {'workers':>7} {'logins/s':>9} {'per core':>9}")
+
+        for iterations in options["iterations"]:
+            with override_settings(PASSWORD_PBKDF2_ITERATIONS=iterations):
+                encoded=make_password(PASSWORD)
+                for executor in options["executors"]:
+                    with override_settings(
+                        PASSWORD_HASH_EXECUTOR=executor,
+                        PASSWORD_HASH_WORKERS=workers,
+                        PASSWORD_HASH_QUEUE_SIZE=options["logins"],
+                    ):
+                        rate=asyncio.run(self._run(encoded,options["logins"]))
+                        hashing.shutdown_executor()
+                    self.stdout.write(
+                        f"{iterations:>10} {executor:<8} {workers:>7} {rate:>9.1f} {rate/workers:>9.1f}"
+                    )
+
+    async def _run(self,encoded,logins):
+        # warm the pool up so worker start-up is not measured
+        await asyncio.gather(*(hashing.averify_password("warm-up",encoded) for _ in range(settings.PASSWORD_HASH_WORKERS)))
+
+        start=time.perf_counter()
+        await asyncio.gather(*(hashing.averify_password(PASSWORD,encoded) for _ in range(logins)))
+        return logins/(time.perf_counter()-start)
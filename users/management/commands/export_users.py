@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.export import FORMATS,export_users
+
+
+class Command(BaseCommand):
+    help=(
+        "Stream every user with their profile and addresses as NDJSON or CSV, "
+        "optionally gzipped, at constant memory."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--format",choices=sorted(FORMATS),default="ndjson")
+        parser.add_argument("--gzip",action="store_true")
+        parser.add_argument("--output",default="-",help="File to write, - for stdout")
+        parser.add_argument("--chunk-size",type=int,default=2000,help="Rows fetched from the database at a time")
+
+    def handle(self,*args,**options):
+        chunks=export_users(options["format"],compress=options["gzip"],chunk_size=options["chunk_size"])
+        try:
+            output=sys.stdout.buffer if options["output"]=="-" else open(options["output"],"wb")
+        except OSError as e:
+            raise CommandError(e)
+
+        with output:
+            for chunk in chunks:
+                output.write(chunk)
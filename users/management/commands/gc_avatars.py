@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.avatars import collect_avatar_garbage
+
+
+class Command(BaseCommand):
+    help=(
+        "Delete avatar and variant files that no profile references anymore. "
+        "Files written within --grace seconds are kept, they may belong to an "
+        "upload that is not saved on its profile yet."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--grace",type=int,default=settings.AVATAR_GC_GRACE_SECONDS)
+        parser.add_argument("--dry-run",action="store_true",help="List the files instead of deleting them")
+
+    def handle(self,*args,**options):
+        deleted=collect_avatar_garbage(options["grace"],dry_run=options["dry_run"])
+        if options["dry_run"]:
+            for name in deleted:
+                self.stdout.write(name)
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would delete' if options['dry_run'] else 'Deleted'} {len(deleted)} unreferenced files"
+        ))
@@ -0,0 +1,233 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from allauth.account.models import EmailAddress
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import BaseUserManager
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from users.models import OTP,Profile,User
+from users.phone import to_e164
+
+
+def read_csv(stream):
+    for line,row in enumerate(csv.DictReader(stream),start=2):
+        yield line,row
+
+
+def read_jsonl(stream):
+    for line,text in enumerate(stream,start=1):
+        if not text.strip():
+            continue
+        try:
+            row=json.loads(text)
+        except ValueError as e:
+            yield line,{"_error":f"invalid JSON: {e}","_raw":text.rstrip("\n")}
+            continue
+        if not isinstance(row,dict):
+            row={"_error":"not an object","_raw":text.rstrip("\n")}
+        yield line,row
+
+
+READERS={"csv":read_csv,"jsonl":read_jsonl}
+
+
+def clean_row(row):
+    """Return (user fields, errors) for one input row"""
+
+    if "_error" in row:
+        return None,[row["_error"]]
+
+    def text(key,max_length=None):
+        value=row.get(key)
+        return str(value).strip()[:max_length] if value is not None else ""
+
+    errors=[]
+    email=text("email") or None
+    phone_number=text("phone_number") or None
+
+    if email:
+        email=BaseUserManager.normalize_email(email)
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors.append("invalid email")
+    if phone_number:
+        phone_number=to_e164(phone_number)
+        if phone_number is None:
+            errors.append("invalid phone number")
+    if not (email or phone_number or errors):
+        errors.append("email or phone number required")
+
+    return {
+        "email":email,
+        "phone_number":phone_number,
+        "first_name":text("first_name",150),
+        "last_name":text("last_name",150),
+        "password":row.get("password") or None,
+        "bio":text("bio",200),
+    },errors
+
+
+class Command(BaseCommand):
+    help=(
+        "Import users from a CSV or JSONL file with email, phone_number, "
+        "first_name, last_name, password and bio columns. Rows are streamed, "
+        "passwords are hashed on a process pool while the previous batch is "
+        "inserted, and rejected rows are written to a side file."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("path",help="Input file, - for stdin")
+        parser.add_argument("--format",choices=sorted(READERS),help="Defaults to the file extension")
+        parser.add_argument("--batch-size",type=int,default=1000)
+        parser.add_argument("--workers",type=int,default=os.cpu_count())
+        parser.add_argument("--rejects",help="Where to write rejected rows as JSONL, defaults to <path>.rejects.jsonl")
+        parser.add_argument(
+            "--unverified",
+            action="store_false",
+            dest="verified",
+            help=(
+                "Leave imported accounts unverified. Like signups, those that never "
+                "verify or log in are deleted by purge_stale_users after "
+                "PURGE_UNVERIFIED_AFTER_DAYS."
+            ),
+        )
+
+    def handle(self,*args,**options):
+        path=options["path"]
+        format=options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in READERS:
+            raise CommandError("Pass --format, it cannot be told from the file name.")
+        rejects_path=options["rejects"] or ("import.rejects.jsonl" if path=="-" else f"{path}.rejects.jsonl")
+        self.verified=options["verified"]
+
+        self.imported=0
+        self.rejected=0
+        self.seen=set()
+        started=time.monotonic()
+
+        stream=sys.stdin if path=="-" else open(path,newline="",encoding="utf-8")
+        try:
+            with stream,open(rejects_path,"w",encoding="utf-8") as rejects,ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                self.rejects=rejects
+                rows=READERS[format](stream)
+                pending=None
+                while True:
+                    batch=self._clean_batch(islice(rows,options["batch_size"]))
+                    if batch is None:
+                        break
+                    # hash this batch on the pool while the previous one is inserted
+                    hashes=executor.map(make_password,[fields["password"] for _,_,fields in batch],chunksize=64)
+                    if pending:
+                        self._insert(*pending)
+                        self._report(started)
+                    pending=(batch,hashes)
+                if pending:
+                    self._insert(*pending)
+        except OSError as e:
+            raise CommandError(e)
+
+        elapsed=time.monotonic()-started
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.imported} users in {elapsed:.1f}s "
+            f"({self.imported/elapsed if elapsed else 0:.0f} users/s), rejected {self.rejected}."
+        ))
+        if self.rejected:
+            self.stdout.write(f"Rejected rows are in {rejects_path}")
+
+    def _reject(self,line,row,errors):
+        self.rejected+=1
+        row={key:value for key,value in row.items() if key!="password"}
+        self.rejects.write(json.dumps({"line":line,"row":row,"errors":errors})+"\n")
+
+    def _clean_batch(self,rows):
+        """Return the valid (line, row, fields) of rows, or None at the end of the input"""
+
+        rows=list(rows)
+        if not rows:
+            return None
+
+        batch=[]
+        for line,row in rows:
+            fields,errors=clean_row(row)
+            identifiers={value for value in (fields["email"],fields["phone_number"]) if value} if fields else set()
+            if not errors and identifiers&self.seen:
+                errors=["duplicate in file"]
+            if errors:
+                self._reject(line,row,errors)
+                continue
+            self.seen|=identifiers
+            batch.append((line,row,fields))
+
+        existing=set()
+        emails=[fields["email"] for _,_,fields in batch if fields["email"]]
+        phone_numbers=[fields["phone_number"] for _,_,fields in batch if fields["phone_number"]]
+        for email,phone_number in User.objects.filter(Q(email__in=emails)|Q(phone_number__in=phone_numbers)).values_list("email","phone_number"):
+            existing.update(str(value) for value in (email,phone_number) if value)
+
+        kept=[]
+        for line,row,fields in batch:
+            if {fields["email"],fields["phone_number"]}&existing:
+                self._reject(line,row,["already registered"])
+            else:
+                kept.append((line,row,fields))
+        return kept
+
+    def _insert(self,batch,hashes):
+        users=[]
+        for (_,_,fields),password in zip(batch,hashes):
+            users.append(User(
+                username=fields["phone_number"] or fields["email"],
+                email=fields["email"],
+                phone_number=fields["phone_number"],
+                first_name=fields["first_name"],
+                last_name=fields["last_name"],
+                password=password,
+            ))
+        if not users:
+            return
+
+        try:
+            with transaction.atomic():
+                # bulk_create skips post_save, so the rows create_profile would add are inserted here
+                User.objects.bulk_create(users)
+                if users[0].pk is None:
+                    ids=dict(User.objects.filter(username__in=[user.username for user in users]).values_list("username","id"))
+                    for user in users:
+                        user.pk=ids[user.username]
+
+                Profile.objects.bulk_create(
+                    Profile(user=user,bio=fields["bio"]) for user,(_,_,fields) in zip(users,batch)
+                )
+                EmailAddress.objects.bulk_create(
+                    EmailAddress(user=user,email=user.email,primary=True,verified=self.verified)
+                    for user in users if user.email
+                )
+                if self.verified:
+                    OTP.objects.bulk_create(OTP(user=user,is_verified=True) for user in users)
+        except IntegrityError as e:
+            # registered concurrently since the batch was checked
+            for line,row,_ in batch:
+                self._reject(line,row,[f"batch failed: {e}"])
+            return
+
+        self.imported+=len(users)
+
+    def _report(self,started):
+        elapsed=time.monotonic()-started
+        self.stdout.write(
+            f"{self.imported} imported, {self.rejected} rejected, {self.imported/elapsed if elapsed else 0:.0f} users/s",
+            ending="\r",
+        )
+        self.stdout.flush()
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from users.avatars import SOURCE_KEY
+from users.models import Profile
+from users.storage import content_digest
+from users.tasks import process_avatar
+
+
+class Command(BaseCommand):
+    help=(
+        "Make the resized variants of avatars that do not have them yet, e.g. "
+        "uploaded before variants existed or after AVATAR_VARIANTS changed."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--queue",action="store_true",help="Queue a task per avatar instead of rendering here")
+        parser.add_argument("--all",action="store_true",help="Render every avatar again, e.g. after AVATAR_VARIANTS changed")
+        parser.add_argument(
+            "--rehash",
+            action="store_true",
+            help="Store avatars uploaded under their file name again under their content hash",
+        )
+
+    def handle(self,*args,**options):
+        profiles=Profile.objects.exclude(Q(avatar="")|Q(avatar=None)).only("id","avatar","avatar_variants")
+        done=0
+        for profile in profiles.iterator():
+            if options["rehash"] and content_digest(profile.avatar.name) is None:
+                # the old file is left to gc_avatars
+                with profile.avatar.open("rb") as f:
+                    profile.avatar.name=profile.avatar.storage.save(profile.avatar.name,f)
+                Profile.objects.filter(pk=profile.pk).update(avatar=profile.avatar.name)
+            if not options["all"] and profile.avatar_variants.get(SOURCE_KEY)==profile.avatar.name:
+                continue
+            if options["all"]:
+                # forget the source so the task does not take the variants as up to date
+                Profile.objects.filter(pk=profile.pk).update(
+                    avatar_variants={name:paths for name,paths in profile.avatar_variants.items() if name!=SOURCE_KEY}
+                )
+            if options["queue"]:
+                process_avatar.delay(profile.pk)
+            else:
+                process_avatar(profile.pk)
+            done+=1
+        self.stdout.write(self.style.SUCCESS(f"{'Queued' if options['queue'] else 'Processed'} {done} avatars"))
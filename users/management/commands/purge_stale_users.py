@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.purge import expired_otps,finished_dispatches,purge_in_chunks,stale_accounts
+
+
+class Command(BaseCommand):
+    help=(
+        "Delete expired unverified OTPs, sent and failed OTP dispatches and "
+        "accounts that were never verified "
+        "within --days, in primary key chunks with one short transaction each. "
+        "An interrupted run resumes from its last chunk."
+    )
+
+    def add_arguments(self,parser):
+        parser.add_argument("--days",type=int,default=settings.PURGE_UNVERIFIED_AFTER_DAYS)
+        parser.add_argument("--chunk-size",type=int,default=settings.PURGE_CHUNK_SIZE)
+        parser.add_argument("--pause",type=float,default=settings.PURGE_CHUNK_PAUSE,help="Seconds to sleep between chunks")
+        parser.add_argument("--restart",action="store_true",help="Ignore the checkpoint of an interrupted run")
+
+    def handle(self,*args,**options):
+        now=timezone.now()
+        for name,queryset in (
+            ("otps",expired_otps(now)),
+            ("dispatches",finished_dispatches(now)),
+            ("users",stale_accounts(options["days"],now)),
+        ):
+            deleted=purge_in_chunks(
+                name,
+                queryset,
+                chunk_size=options["chunk_size"],
+                pause=options["pause"],
+                restart=options["restart"],
+                report=self.report,
+            )
+            self.stdout.write(self.style.SUCCESS(f"{name}: deleted {deleted} rows"))
+
+    def report(self,name,last_pk,deleted,elapsed):
+        rate=deleted/elapsed if elapsed else 0
+        self.stdout.write(f"{name}: up to pk {last_pk}, {deleted} rows deleted, {rate:.0f} rows/s",ending="\r")
+        self.stdout.flush()
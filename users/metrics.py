@@ -0,0 +1,89 @@
+"""
+Prometheus metrics for the users app.
+
+Requests are timed per URL name by users.middleware.MetricsMiddleware,
+together with the number of SQL queries they ran and the time spent in
+them. OTP sends and password hashing are timed where they happen, so a
+slow request can be put down to the database, PBKDF2 or the provider.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to a directory shared by the
+workers (see etrade/gunicorn.conf.py), every worker writes its samples
+there and the metrics view adds them up.
+
+OTP messages are sent by the Celery worker, so OTP_SEND_SECONDS is only
+seen by the web processes when the worker runs with the same
+PROMETHEUS_MULTIPROC_DIR. Where it cannot share the directory, set
+CELERY_METRICS_PORT and scrape the worker on that port.
+"""
+import os
+
+from celery.signals import worker_init, worker_process_shutdown
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram,
+                               generate_latest, multiprocess, start_http_server)
+
+QUERY_BUCKETS=(0,1,2,3,5,8,13,21,34,55,89,144,float("inf"))
+
+REQUEST_SECONDS=Histogram(
+    "etrade_request_duration_seconds",
+    "Time to produce a response, by URL name",
+    ["view","method","status"],
+)
+REQUEST_QUERIES=Histogram(
+    "etrade_request_db_queries",
+    "SQL queries run by a request, by URL name",
+    ["view"],
+    buckets=QUERY_BUCKETS,
+)
+REQUEST_DB_SECONDS=Histogram(
+    "etrade_request_db_duration_seconds",
+    "Time a request spent in SQL queries, by URL name",
+    ["view"],
+)
+OTP_SEND_SECONDS=Histogram(
+    "etrade_otp_send_duration_seconds",
+    "Time to hand an OTP message batch to the SMS or email provider",
+    ["channel"],
+)
+PASSWORD_HASH_SECONDS=Histogram(
+    "etrade_password_hash_duration_seconds",
+    "Time to hash a password, by algorithm",
+    ["algorithm"],
+)
+
+
+def get_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry=CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render():
+    """Return the exposition of every metric and its content type"""
+
+    return generate_latest(get_registry()),CONTENT_TYPE_LATEST
+
+
+def scrape_allowed(request):
+    """Return whether request comes from METRICS_ALLOWED_IPS or carries METRICS_TOKEN"""
+
+    if request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS:
+        return True
+    token=settings.METRICS_TOKEN
+    return bool(token) and constant_time_compare(request.headers.get("Authorization",""),f"Bearer {token}")
+
+
+@worker_init.connect
+def start_worker_exporter(**kwargs):
+    if settings.CELERY_METRICS_PORT:
+        start_http_server(settings.CELERY_METRICS_PORT,registry=get_registry())
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None,**kwargs):
+    # what child_exit in etrade/gunicorn.conf.py does for gunicorn workers, for prefork children
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+from .metrics import REQUEST_DB_SECONDS, REQUEST_QUERIES, REQUEST_SECONDS
+
+
+class QueryTimer:
+    """execute_wrapper that counts the queries it sees and adds up their time"""
+
+    def __init__(self):
+        self.count=0
+        self.seconds=0.0
+
+    def __call__(self,execute,sql,params,many,context):
+        start=time.perf_counter()
+        try:
+            return execute(sql,params,many,context)
+        finally:
+            self.count+=1
+            self.seconds+=time.perf_counter()-start
+
+
+_observers=contextvars.ContextVar("query_observers",default=())
+
+
+@contextmanager
+def observe_queries(wrapper):
+    """
+    Pass the queries run in this context through the execute_wrapper
+    wrapper, on whichever connection they use.
+
+    connection.execute_wrapper() only covers the connection of the calling
+    thread, the ORM calls of an async view run on the connection of a
+    sync_to_async thread. The context is copied into that thread.
+    """
+    token=_observers.set((*_observers.get(),wrapper))
+    try:
+        yield
+    finally:
+        _observers.reset(token)
+
+
+def run_observers(execute,sql,params,many,context):
+    """execute_wrapper installed on every connection, see users.signals"""
+
+    # the first installed wraps the others, as with connection.execute_wrapper()
+    for wrapper in reversed(_observers.get()):
+        execute=functools.partial(wrapper,execute)
+    return execute(sql,params,many,context)
+
+
+class AsyncCapable:
+    """
+    Base of the middlewares that run in whichever mode the chain below them
+    is in, so async views under ASGI are not pushed onto a thread
+    """
+
+    def __init__(self,get_response):
+        self.get_response=get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # how MiddlewareMixin tells Django that __call__ returns a coroutine
+            self._is_coroutine=asyncio.coroutines._is_coroutine
+
+    def __call__(self,request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+# any other method is labelled "other", clients can send made-up ones
+METHODS=frozenset(("GET","HEAD","POST","PUT","PATCH","DELETE","OPTIONS"))
+
+
+@sync_and_async_middleware
+class MetricsMiddleware(AsyncCapable):
+    """
+    Record the latency, SQL query count and SQL time of every request,
+    labelled with the name of the URL it matched
+    """
+
+    def handle(self,request):
+        queries=QueryTimer()
+        start=time.perf_counter()
+        with observe_queries(queries):
+            response=self.get_response(request)
+        return self.record(request,response,time.perf_counter()-start,queries)
+
+    async def __acall__(self,request):
+        queries=QueryTimer()
+        start=time.perf_counter()
+        with observe_queries(queries):
+            response=await self.get_response(request)
+        return self.record(request,response,time.perf_counter()-start,queries)
+
+    def record(self,request,response,elapsed,queries):
+        match=request.resolver_match
+        # unmatched paths share one label so scanners cannot blow up the series count
+        view=match.view_name if match is not None else "unmatched"
+        method=request.method if request.method in METHODS else "other"
+        REQUEST_SECONDS.labels(view,method,response.status_code).observe(elapsed)
+        REQUEST_QUERIES.labels(view).observe(queries.count)
+        REQUEST_DB_SECONDS.labels(view).observe(queries.seconds)
+        return response
+
+
+_IN_LIST=re.compile(r"IN \((?:%s, )*%s\)")
+_VALUES=re.compile(r"VALUES (\([^)]*\))(?:, \([^)]*\))+")
+_ORDER_LIMIT=re.compile(r"( ORDER BY [^()]*?)?( LIMIT \d+)?( OFFSET \d+)?$")
+
+
+def normalize_sql(sql):
+    """
+    Return sql with IN lists and multi-row VALUES collapsed and a trailing
+    ORDER BY/LIMIT dropped, so .get() and .first() of the same rows match
+    """
+    sql=_IN_LIST.sub("IN (...)",sql)
+    sql=_VALUES.sub(r"VALUES \1, ...",sql)
+    return _ORDER_LIMIT.sub("",sql,count=1)
+
+
+class SQLRecorder:
+    """execute_wrapper that keeps every statement with its time and Python call site"""
+
+    def __init__(self,root,depth):
+        self.root=root
+        self.depth=depth
+        self.statements=[]
+
+    def __call__(self,execute,sql,params,many,context):
+        start=time.perf_counter()
+        try:
+            return execute(sql,params,many,context)
+        finally:
+            elapsed=time.perf_counter()-start
+            self.statements.append((sql,params,elapsed,self.call_site()))
+
+    def call_site(self):
+        """Return the project frames above the query, innermost first"""
+
+        frames=[]
+        frame=sys._getframe(2)
+        while frame is not None and len(frames)<self.depth:
+            filename=frame.f_code.co_filename
+            if filename.startswith(self.root) and "site-packages" not in filename and filename!=__file__:
+                frames.append(f"{os.path.relpath(filename,self.root)}:{frame.f_lineno} in {frame.f_code.co_name}")
+            frame=frame.f_back
+        return frames
+
+    def report(self,slowest):
+        """Return the duplicated statement groups and the slowest statements"""
+
+        groups={}
+        for sql,params,elapsed,stack in self.statements:
+            groups.setdefault((normalize_sql(sql),repr(params)),[]).append(stack[0] if stack else None)
+        duplicates=[
+            {"sql":sql,"count":len(sites),"call_sites":sorted(Counter(sites).items(),key=lambda item:-item[1])}
+            for (sql,_),sites in groups.items() if len(sites)>1
+        ]
+        duplicates.sort(key=lambda group:-group["count"])
+
+        slow=sorted(self.statements,key=lambda statement:-statement[2])[:slowest]
+        return duplicates,[
+            {"sql":sql,"time_ms":round(elapsed*1000,3),"stack":stack}
+            for sql,_,elapsed,stack in slow
+        ]
+
+
+_log_lock=threading.Lock()
+
+
+@sync_and_async_middleware
+class SQLProfilingMiddleware(AsyncCapable):
+    """
+    Record every SQL statement of a sample of requests and report the
+    duplicated ones and the slowest ones with their call sites.
+
+    SQL_PROFILE_SAMPLE_RATE is the share of requests profiled, the
+    middleware removes itself when it is 0. Results are appended as one
+    JSON line per request to SQL_PROFILE_LOG and, with SQL_PROFILE_HEADERS,
+    summed up in X-SQL-* response headers. Requests left out of the sample
+    cost one random() call.
+    """
+
+    def __init__(self,get_response):
+        if not settings.SQL_PROFILE_SAMPLE_RATE:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.root=str(settings.BASE_DIR)+os.sep
+
+    def handle(self,request):
+        if random.random()>=settings.SQL_PROFILE_SAMPLE_RATE:
+            return self.get_response(request)
+
+        recorder=SQLRecorder(self.root,settings.SQL_PROFILE_STACK_DEPTH)
+        with observe_queries(recorder):
+            response=self.get_response(request)
+        return self.finish(request,response,recorder)
+
+    async def __acall__(self,request):
+        if random.random()>=settings.SQL_PROFILE_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        recorder=SQLRecorder(self.root,settings.SQL_PROFILE_STACK_DEPTH)
+        with observe_queries(recorder):
+            response=await self.get_response(request)
+        return self.finish(request,response,recorder)
+
+    def finish(self,request,response,recorder):
+        duplicates,slowest=recorder.report(settings.SQL_PROFILE_SLOWEST)
+        total_ms=sum(statement[2] for statement in recorder.statements)*1000
+        if settings.SQL_PROFILE_HEADERS:
+            response["X-SQL-Queries"]=str(len(recorder.statements))
+            response["X-SQL-Time-Ms"]=f"{total_ms:.2f}"
+            response["X-SQL-Duplicates"]=str(sum(group["count"]-1 for group in duplicates))
+
+        if settings.SQL_PROFILE_LOG:
+            match=request.resolver_match
+            self.write({
+                "time":time.time(),
+                "method":request.method,
+                "path":request.path,
+                "view":match.view_name if match is not None else None,
+                "status":response.status_code,
+                "queries":len(recorder.statements),
+                "time_ms":round(total_ms,3),
+                "duplicates":duplicates,
+                "slowest":slowest,
+            })
+        return response
+
+    def write(self,record):
+        line=json.dumps(record,default=str)+"\n"
+        with _log_lock:
+            with open(settings.SQL_PROFILE_LOG,"a") as f:
+                f.write(line)
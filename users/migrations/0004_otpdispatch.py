@@ -0,0 +1,37 @@
+# Generated by Django 4.0.4 on 2026-10-18 04:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_alter_user_phone_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OTPDispatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel', models.CharField(choices=[('S', 'sms'), ('E', 'email')], max_length=1)),
+                ('recipient', models.CharField(max_length=255)),
+                ('body', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('P', 'pending'), ('I', 'sending'), ('S', 'sent'), ('F', 'failed')], default='P', max_length=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('otp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dispatches', to='users.otp')),
+            ],
+            options={
+                'ordering': ('created_at',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='otpdispatch',
+            index=models.Index(fields=['status', 'id'], name='users_otpdispatch_status_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_otpdispatch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', '-created_at', 'id'], name='users_address_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+import phonenumbers
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+BATCH_SIZE=1000
+
+
+def to_e164(value):
+    try:
+        number=phonenumbers.parse(value,settings.PHONENUMBER_DEFAULT_REGION)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(number):
+        return None
+    return phonenumbers.format_number(number,phonenumbers.PhoneNumberFormat.E164)
+
+
+def backfill_e164(apps,schema_editor):
+    """
+    Rewrite phone numbers stored in any other format as E.164, so lookups
+    by the canonical key find every user. Numbers that cannot be parsed, or
+    whose E.164 form is already taken, are left as they are.
+    """
+    User=apps.get_model("users","User")
+
+    # read the stored text as is, the model field would parse it
+    rows=(
+        User.objects.exclude(phone_number=None)
+        .annotate(raw=Cast("phone_number",models.CharField()))
+        .order_by("pk")
+        .values_list("pk","raw")
+    )
+    last_pk=0
+    while True:
+        batch=list(rows.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            return
+        last_pk=batch[-1][0]
+
+        for pk,raw in batch:
+            e164=to_e164(raw) if raw else None
+            if e164 is None or e164==raw:
+                continue
+            if User.objects.filter(phone_number=e164).exists():
+                continue
+            User.objects.filter(pk=pk).update(phone_number=e164)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_e164,migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.4 on 2026-10-18 05:08
+
+from django.db import migrations, models
+import users.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_profile_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='avatar',
+            field=models.ImageField(blank=True, storage=users.storage.ContentAddressedStorage(), upload_to='avatar'),
+        ),
+    ]
@@ -4,19 +4,25 @@ from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.utils import timezone
 from django.utils.crypto import get_random_string
+from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 from django_countries.fields import CountryField
 from phonenumber_field.modelfields import PhoneNumberField
 from rest_framework.exceptions import NotAcceptable
-from twilio.base.exceptions import TwilioRestException
-from twilio.rest import Client
 from django.core.mail import EmailMessage
 from decouple import config
 from django.core.mail import send_mail
 
+from .mail import send_otp_emails
+from .otp_store import get_otp_store
+from .phone import to_e164
+from .sms import send_sms
+from .storage import ContentAddressedStorage
+
 
 def phone_number_validator(value):
     phone_regex = r'^\+?1?\d{9,15}$'
@@ -29,14 +35,26 @@ class User(AbstractUser):
     email=models.EmailField(unique=True,blank=True,null=True)
     phone_number=PhoneNumberField(unique=True,blank=True,null=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes=[
+            # case-insensitive email lookups (email__iexact, used by allauth)
+            models.Index(Upper("email"),name="users_user_email_upper_idx"),
+        ]
+
     @property
     def identifier(self):
-        return self.email or self.phone_number.as_e164
+        return self.email or to_e164(self.phone_number)
 
 
     def __str__(self):
         return self.identifier
 
+    def get_session_auth_hash(self):
+        # users resolved from a users.authentication snapshot carry the hash instead of the password
+        if "password" not in self.__dict__ and getattr(self,"_session_auth_hash",None):
+            return self._session_auth_hash
+        return super().get_session_auth_hash()
+
     
     
     USERNAME_FIELD='username'
@@ -54,6 +72,10 @@ class CreatedModified(models.Model):
         abstract=True
 
 class OTP(CreatedModified):
+    # what a code is for, HMAC codes of one purpose do not verify the other
+    VERIFICATION="verification"
+    PASSWORD="password"
+
     user=models.OneToOneField(User,related_name="phone",on_delete=models.CASCADE)
     security_code=models.CharField(max_length=120)
     is_verified=models.BooleanField(default=False)
@@ -61,6 +83,14 @@ class OTP(CreatedModified):
     
     class Meta:
         ordering=("-created_at",)
+        indexes=[
+            # sweeps for expired codes only ever look at unverified rows
+            models.Index(
+                fields=["sent"],
+                condition=models.Q(is_verified=False),
+                name="users_otp_unverified_sent_idx",
+            ),
+        ]
     
     
     def __str__(self):
@@ -78,56 +108,58 @@ class OTP(CreatedModified):
         return expiration_date<=timezone.now()
     
     
-    def send_confirmation(self):#override twilio
-        twilio_account_sid=settings.TWILIO_ACCOUNT_SID
-        twilio_auth_token=settings.TWILIO_AUTH_TOKEN
-        twilio_phone_number=settings.TWILIO_PHONE_NUMBER
+    def _issue(self,channel,recipient,body,is_otp_for_password=False,enqueue=True):
+        """
+        Issue a new code and return the OTPDispatch that delivers it, unsaved
+        for stores without an outbox. It is also kept on self.dispatch.
+        """
+        store=get_otp_store()
+        purpose=self.PASSWORD if is_otp_for_password else self.VERIFICATION
+        security_code=store.generate(self,channel,purpose)
 
-        self.security_code=self.generate_security_code()
+        with transaction.atomic(savepoint=False):
+            store.issue(self,security_code)
+            if store.outbox:
+                # the row keeps the template, the code is filled in from the store when it is sent
+                self.dispatch=OTPDispatch.queue(
+                    otp=self,
+                    channel=channel,
+                    recipient=recipient,
+                    body=body,
+                    enqueue=enqueue,
+                )
+            else:
+                self.dispatch=OTPDispatch.derived(self,channel,recipient,body,purpose,store,enqueue)
+        return self.dispatch
 
-        if not all([twilio_account_sid,twilio_auth_token,twilio_phone_number]):
-            raise ValueError("Twilio credentials are not set.")
-        try:
-            user_instance = User.objects.get(id=self.user_id)
-            phone_number = user_instance.phone_number
-        except User.DoesNotExist:
-            raise  
-        
-        try:
-            twilio_client=Client(twilio_account_sid,twilio_auth_token)
-            twilio_client.messages.create(
-                body=f"Your activation code is {self.security_code}",
-                to=str(phone_number),
-                from_=twilio_phone_number,
-            )
-            self.sent=timezone.now()
-            self.save()
-            return True
-        except TwilioRestException as e:
-            raise ValueError(e)
-
-    def send_email_OTP(self,reciever_email):
-        self.security_code=self.generate_security_code()
-        self.sent=timezone.now()
-        try:
-            email=EmailMessage(
-                subject='Email Verification',
-                body=f"Your OTP code is : {self.security_code}",
-                from_email=config("EMAIL_USER"),
-                to=[reciever_email],
-                
-            )
-            
-            email.send()
-        
-        except Exception as e:
-            raise 
-        self.save()
+    def send_confirmation(self,is_otp_for_password=False,enqueue=True):
+        """Generate a new code and queue it for delivery by SMS"""
+
+        self._issue(
+            OTPDispatch.SMS,
+            str(self.user.phone_number),
+            "Your activation code is {security_code}",
+            is_otp_for_password,
+            enqueue,
+        )
+        return True
+
+    def send_email_OTP(self,reciever_email,is_otp_for_password=False,enqueue=True):
+        """Generate a new code and queue it for delivery by email"""
+
+        self._issue(
+            OTPDispatch.EMAIL,
+            reciever_email,
+            "Your OTP code is : {security_code}",
+            is_otp_for_password,
+            enqueue,
+        )
         
 
-    def check_verification(self,security_code,is_otp_for_password=False):
+    def check_verification(self,security_code,is_otp_for_password=False,channel=None):
+        store=get_otp_store()
         if is_otp_for_password:
-            if (self.is_security_code_expired() or security_code!=self.security_code ):
+            if not store.verify(self,security_code,channel,self.PASSWORD):
                 raise NotAcceptable(
                     _(
                         "Your security code is wrong or expired."
@@ -136,7 +168,7 @@ class OTP(CreatedModified):
             return True
             
             
-        if (self.is_security_code_expired() or security_code!=self.security_code or self.is_verified):
+        if (self.is_verified or not store.verify(self,security_code,channel,self.VERIFICATION)):
             raise NotAcceptable(
                 _(
                     "Your security code is wrong,expired, or this account is already verified."
@@ -144,22 +176,152 @@ class OTP(CreatedModified):
             )
             
         self.is_verified=True
-        self.save()
+        self.save(update_fields=["is_verified","updated_at"])
         return self.is_verified
 
 
 
+class OTPDispatch(CreatedModified):
+    """
+    Outbox row for an OTP message that still has to be handed to the provider.
+
+    Rows are written in the same transaction as the OTP they belong to and
+    drained in batches by the ``users.tasks`` workers. body is a template,
+    the code is read from the OTP store when the message is sent and never
+    written to the row.
+    """
+
+    SMS="S"
+    EMAIL="E"
+
+    CHANNEL_CHOICES=((SMS,_("sms")),(EMAIL,_("email")))
+
+    PENDING="P"
+    SENDING="I"
+    SENT="S"
+    FAILED="F"
+
+    STATUS_CHOICES=(
+        (PENDING,_("pending")),
+        (SENDING,_("sending")),
+        (SENT,_("sent")),
+        (FAILED,_("failed")),
+    )
+
+    EMAIL_SUBJECT="Email Verification"
+
+    otp=models.ForeignKey(OTP,related_name="dispatches",on_delete=models.CASCADE)
+    channel=models.CharField(max_length=1,choices=CHANNEL_CHOICES)
+    recipient=models.CharField(max_length=255)
+    body=models.CharField(max_length=255)
+    status=models.CharField(max_length=1,choices=STATUS_CHOICES,default=PENDING)
+    attempts=models.PositiveSmallIntegerField(default=0)
+    last_error=models.TextField(blank=True)
+    sent_at=models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        ordering=("created_at",)
+        indexes=[
+            models.Index(fields=["status","id"],name="users_otpdispatch_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.get_channel_display()} to {self.recipient}"
+
+    @classmethod
+    def queue(cls,otp,channel,recipient,body,enqueue=True):
+        """
+        Write an outbox row and hand it to a worker once the surrounding
+        transaction commits. Pass enqueue=False when the caller delivers
+        the row itself, e.g. with users.tasks.adeliver_pending.
+        """
+        from .tasks import deliver_otp_dispatch
+
+        dispatch=cls.objects.create(otp=otp,channel=channel,recipient=recipient,body=body)
+        if enqueue:
+            transaction.on_commit(lambda:deliver_otp_dispatch.delay(dispatch.pk))
+        return dispatch
+
+    @classmethod
+    def derived(cls,otp,channel,recipient,body,purpose,store,enqueue=True):
+        """
+        Return an unsaved dispatch for a store that derives codes, see
+        BaseOTPStore.outbox, and hand it to a worker once the surrounding
+        transaction commits. The code never goes through the broker, the
+        worker gets its time step and derives it again, task_args holds
+        what it is sent.
+        """
+        from .tasks import send_derived_otp
+
+        step=store.time_step()
+        dispatch=cls(otp=otp,channel=channel,recipient=recipient,body=body)
+        dispatch.text=body.format(security_code=store.derive(otp,channel,purpose,step))
+        dispatch.task_args=(otp.user_id,channel,recipient,body,purpose,step)
+        if enqueue:
+            transaction.on_commit(lambda:send_derived_otp.delay(*dispatch.task_args))
+        return dispatch
+
+    @cached_property
+    def text(self):
+        """The message with the current code of the OTP, or None once it expired or was used"""
+
+        security_code=get_otp_store().current_code(self.otp)
+        return None if security_code is None else self.body.format(security_code=security_code)
+
+    def deliver(self,sms_connection=None):
+        if self.channel==self.SMS:
+            self._send_sms(connection=sms_connection)
+        else:
+            send_otp_emails([self.email_message()])
+
+    def _send_sms(self,connection=None):
+        send_sms(self.text,self.recipient,connection=connection)
+
+    def email_message(self):
+        return EmailMessage(
+            subject=self.EMAIL_SUBJECT,
+            body=self.text,
+            from_email=config("EMAIL_USER"),
+            to=[self.recipient],
+        )
+
+
 class Profile(CreatedModified):
     user=models.OneToOneField(User,related_name="profile",on_delete=models.CASCADE)
-    avatar=models.ImageField(upload_to="avatar",blank=True)
+    # named by content hash, see users.storage
+    avatar=models.ImageField(upload_to="avatar",storage=ContentAddressedStorage(),blank=True)
+    # resized copies of avatar, see users.avatars
+    avatar_variants=models.JSONField(default=dict,blank=True)
     bio=models.CharField(max_length=200,blank=True)
 
     
+    TRACKED_FIELDS=("avatar","bio")
+
     class Meta:
         ordering=("-created_at",)
     
     def __str__(self):
         return self.user.get_full_name()
+
+    @classmethod
+    def from_db(cls,db,field_names,values):
+        instance=super().from_db(db,field_names,values)
+        instance._loaded_values=instance._tracked_values()
+        return instance
+
+    def _tracked_values(self):
+        return {
+            name:self._meta.get_field(name).value_to_string(self)
+            for name in self.TRACKED_FIELDS if name in self.__dict__
+        }
+
+    def has_changed(self):
+        """Return True if the profile differs from what was loaded from the database"""
+
+        loaded_values=getattr(self,"_loaded_values",None)
+        if loaded_values is None:
+            return True
+        return self._tracked_values()!=loaded_values
     
     
 
@@ -180,6 +342,10 @@ class Address(CreatedModified):
 
     class Meta:
         ordering=("-created_at",)
+        indexes=[
+            # keyset pagination of a user's addresses, see AddressCursorPagination
+            models.Index(fields=["user","-created_at","id"],name="users_address_user_created_idx"),
+        ]
     
     
     def __str__(self):
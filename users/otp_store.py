@@ -0,0 +1,207 @@
+"""
+Storage for OTP security codes.
+
+The store is picked with the ``OTP_STORE`` setting. The database store
+keeps the code on the ``OTP`` row as before. The cache store keeps it in
+the default cache with a native TTL, so a resend only updates ``OTP.sent``
+and failed verifications never write to the database. The
+HMAC store keeps nothing at all and derives codes from the time instead.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare,salted_hmac
+from django.utils.module_loading import import_string
+
+
+def mark_sent(otp):
+    """Record on the row that a code was just issued, creating it if needed"""
+
+    otp.sent=timezone.now()
+    if otp.pk is None:
+        otp.save()
+    else:
+        otp.save(update_fields=["sent","updated_at"])
+
+
+class BaseOTPStore:
+    """
+    Base class for OTP stores. Subclasses must override issue() and verify().
+
+    channel is one of the OTPDispatch channels and purpose one of
+    OTP.VERIFICATION or OTP.PASSWORD, stores that do not tie codes to
+    them ignore both.
+
+    Codes are delivered through the OTPDispatch outbox. A store that can
+    produce a code again in a worker sets outbox to False and implements
+    time_step() and derive(), its codes are then sent without an outbox
+    row, see users.tasks.send_derived_otp.
+    """
+
+    outbox=True
+
+    def generate(self,otp,channel,purpose):
+        """Return a new security code for otp"""
+        return otp.generate_security_code()
+
+    def issue(self,otp,security_code):
+        """Remember security_code as the current code of otp"""
+        raise NotImplementedError("subclasses of BaseOTPStore must override issue() method")
+
+    def verify(self,otp,security_code,channel=None,purpose=None):
+        """Return True if security_code is the current, unexpired code of otp"""
+        raise NotImplementedError("subclasses of BaseOTPStore must override verify() method")
+
+    def current_code(self,otp):
+        """
+        Return the code the outbox sends for otp, or None once it expired or
+        was used. Only stores with an outbox need it.
+        """
+        raise NotImplementedError("subclasses of BaseOTPStore must override current_code() method")
+
+
+class DatabaseOTPStore(BaseOTPStore):
+    """
+    Keep the code and the time it was sent on the OTP row
+    """
+
+    def issue(self,otp,security_code):
+        otp.security_code=security_code
+        otp.sent=timezone.now()
+        otp.save()
+
+    def verify(self,otp,security_code,channel=None,purpose=None):
+        if otp.sent is None or otp.is_security_code_expired():
+            return False
+        return constant_time_compare(security_code,otp.security_code)
+
+    def current_code(self,otp):
+        if otp.sent is None or otp.is_security_code_expired():
+            return None
+        return otp.security_code
+
+
+class CacheOTPStore(BaseOTPStore):
+    """
+    Keep the code in the default cache for TOKEN_EXPIRE_MINUTES.
+
+    Every verification counts against OTP_MAX_ATTEMPTS and the code is
+    dropped once they run out. A matching code is consumed with a cache
+    delete, so of two concurrent verifications only one succeeds.
+    """
+
+    key_prefix="otp"
+    outbox=False
+
+    def code_key(self,otp):
+        return f"{self.key_prefix}:{otp.user_id}:code"
+
+    def attempts_key(self,otp):
+        return f"{self.key_prefix}:{otp.user_id}:attempts"
+
+    @property
+    def timeout(self):
+        return int(datetime.timedelta(minutes=settings.TOKEN_EXPIRE_MINUTES).total_seconds())
+
+    def issue(self,otp,security_code):
+        # the code stays out of the row, sent only tells the purge the OTP is in use
+        mark_sent(otp)
+        cache.set_many({self.code_key(otp):security_code,self.attempts_key(otp):0},self.timeout)
+
+    def _count_attempt(self,otp):
+        key=self.attempts_key(otp)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # no code was issued, or it expired
+            return None
+
+    def verify(self,otp,security_code,channel=None,purpose=None):
+        attempts=self._count_attempt(otp)
+        if attempts is None:
+            return False
+        if attempts>settings.OTP_MAX_ATTEMPTS:
+            cache.delete(self.code_key(otp))
+            return False
+
+        stored_code=cache.get(self.code_key(otp))
+        if stored_code is None or not constant_time_compare(security_code,stored_code):
+            return False
+        if not cache.delete(self.code_key(otp)):
+            # consumed by a concurrent verification
+            return False
+        cache.delete(self.attempts_key(otp))
+        return True
+
+    def current_code(self,otp):
+        return cache.get(self.code_key(otp))
+
+    def time_step(self):
+        # codes are read back from the cache, they are not tied to a time step
+        return None
+
+    def derive(self,otp,channel,purpose,step):
+        """
+        Return the current code of otp, or None once it expired or was used.
+        A resend before the worker runs means the newer code is sent twice.
+        """
+        return self.current_code(otp)
+
+
+class HMACOTPStore(BaseOTPStore):
+    """
+    Derive codes like TOTP from an HMAC over the user, channel, purpose and
+    the current time step, keyed with SECRET_KEY.
+
+    Nothing is stored when a code is sent, so any worker can verify it by
+    recomputing the codes of the last OTP_HMAC_DRIFT_STEPS steps (and the
+    next one, for clock skew between servers). A code can therefore be
+    used more than once until it drifts out of the window.
+    """
+
+    key_salt="users.otp_store.HMACOTPStore"
+    outbox=False
+
+    def time_step(self):
+        return int(time.time())//settings.OTP_HMAC_STEP_SECONDS
+
+    def code_at(self,otp,channel,purpose,step):
+        digest=salted_hmac(
+            self.key_salt,
+            f"{otp.user_id}:{channel}:{purpose}:{step}",
+            algorithm="sha256",
+        ).digest()
+        # dynamic truncation from RFC 4226
+        offset=digest[-1]&0x0F
+        value=int.from_bytes(digest[offset:offset+4],"big")&0x7FFFFFFF
+        token_length=getattr(settings,"TOKEN_LENGTH",6)
+        return str(value%10**token_length).zfill(token_length)
+
+    def generate(self,otp,channel,purpose):
+        return self.code_at(otp,channel,purpose,self.time_step())
+
+    def issue(self,otp,security_code):
+        mark_sent(otp)
+
+    def derive(self,otp,channel,purpose,step):
+        """Return the code of step, or None once it no longer verifies"""
+
+        if self.time_step()-step>settings.OTP_HMAC_DRIFT_STEPS:
+            return None
+        return self.code_at(otp,channel,purpose,step)
+
+    def verify(self,otp,security_code,channel=None,purpose=None):
+        step=self.time_step()
+        steps=range(step-settings.OTP_HMAC_DRIFT_STEPS,step+2)
+        # compare against every step so the time taken does not depend on which one matched
+        matches=[constant_time_compare(security_code,self.code_at(otp,channel,purpose,s)) for s in steps]
+        return any(matches)
+
+
+def get_otp_store(store=None):
+    """Load an OTP store and return an instance of it"""
+
+    return import_string(store or settings.OTP_STORE)()
@@ -0,0 +1,94 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class AddressCursorPagination(CursorPagination):
+    """
+    Keyset pagination of addresses on (created_at, id)
+
+    The cursor holds the created_at and id of the last row seen, and the
+    next page is read by seeking past it on the (user, -created_at, id)
+    index. Every page costs the same however deep it is, and rows that
+    share a created_at (e.g. from bulk imports) are never skipped.
+    """
+
+    page_size=20
+    page_size_query_param="page_size"
+    max_page_size=100
+    ordering=("-created_at","id")
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.page_size=self.get_page_size(request)
+        self.base_url=request.build_absolute_uri()
+        self.cursor=self.decode_cursor(request)
+
+        reverse=bool(self.cursor and self.cursor.reverse)
+        position=self.decode_position(self.cursor.position) if self.cursor else None
+
+        if reverse:
+            queryset=queryset.order_by("created_at","-id")
+        else:
+            queryset=queryset.order_by(*self.ordering)
+
+        if position is not None:
+            queryset=queryset.filter(self.seek(position,reverse))
+
+        results=list(queryset[:self.page_size+1])
+        self.page=results[:self.page_size]
+        has_more=len(results)>self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_next=True
+            self.has_previous=has_more
+        else:
+            self.has_next=has_more
+            self.has_previous=position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls=True
+
+        return self.page
+
+    def seek(self,position,reverse):
+        """Return the filter for the rows after position in the requested direction"""
+
+        created_at,pk=position
+        if reverse:
+            # the created_at bound alone lets the database seek on the index
+            return Q(created_at__gte=created_at) & (Q(created_at__gt=created_at) | Q(id__lt=pk))
+        return Q(created_at__lte=created_at) & (Q(created_at__lt=created_at) | Q(id__gt=pk))
+
+    def decode_position(self,position):
+        try:
+            created_at,pk=position.rsplit("|",1)
+            created_at=parse_datetime(created_at)
+            pk=int(pk)
+        except (AttributeError,TypeError,ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at,pk
+
+    def _get_position_from_instance(self,instance,ordering):
+        return f"{instance.created_at.isoformat()}|{instance.pk}"
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position=self._get_position_from_instance(self.page[-1],self.ordering)
+        else:
+            position=self.cursor.position
+        return self.encode_cursor(Cursor(offset=0,reverse=False,position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position=self._get_position_from_instance(self.page[0],self.ordering)
+        else:
+            position=self.cursor.position
+        return self.encode_cursor(Cursor(offset=0,reverse=True,position=position))
@@ -0,0 +1,59 @@
+"""
+Memoized phone number parsing.
+
+Every login, OTP request and serializer used to parse the same numbers
+again. Parses are kept in a bounded LRU cache keyed by the submitted
+string, so repeated numbers cost a dict lookup. The cached PhoneNumber
+objects are shared, treat them as read-only.
+"""
+from functools import lru_cache
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from phonenumber_field.phonenumber import PhoneNumber
+from phonenumbers.phonenumberutil import NumberParseException
+
+CACHE_SIZE=4096
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse(value):
+    try:
+        number=PhoneNumber.from_string(value)
+    except NumberParseException:
+        return None
+    return number if number.is_valid() else None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _to_e164(value):
+    number=_parse(value)
+    return number.as_e164 if number is not None else None
+
+
+def _key(value):
+    if isinstance(value,PhoneNumber):
+        # loaded from the database, raw_input is the stored E.164 string
+        return value.raw_input or value.as_e164
+    return str(value).strip()
+
+
+def parse_phone_number(value):
+    """
+    Return value as a PhoneNumber, read in PHONENUMBER_DEFAULT_REGION when
+    it has no country code, or None if it is not a valid number
+    """
+    return _parse(_key(value))
+
+
+def to_e164(value):
+    """Return value as an E.164 string, or None if it is not a valid number"""
+
+    return _to_e164(_key(value))
+
+
+@receiver(setting_changed)
+def clear_cache(setting,**kwargs):
+    if setting=="PHONENUMBER_DEFAULT_REGION":
+        _parse.cache_clear()
+        _to_e164.cache_clear()
@@ -0,0 +1,100 @@
+"""
+Batched deletion of expired OTPs, delivered outbox rows and abandoned signups.
+
+Rows are deleted in primary key ranges, one short transaction per range,
+so locks are only ever held on a chunk of rows at a time. The last range
+finished is checkpointed in the default cache, so a run that is stopped
+picks up where it left off the next time.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from .models import OTP,OTPDispatch,User
+
+CHECKPOINT_TIMEOUT=7*24*60*60
+
+
+def expired_otps(now=None):
+    """
+    Unverified OTPs whose last code expired, verified rows are kept for login.
+
+    Every store sets sent when it issues a code, rows that never had one
+    count from created_at.
+    """
+    cutoff=(now or timezone.now())-datetime.timedelta(minutes=settings.TOKEN_EXPIRE_MINUTES)
+    return OTP.objects.filter(
+        Q(sent__lt=cutoff)|Q(sent=None,created_at__lt=cutoff),
+        is_verified=False,
+    )
+
+
+def finished_dispatches(now=None):
+    """Outbox rows that were sent or gave up more than PURGE_DISPATCHES_AFTER_HOURS ago"""
+
+    cutoff=(now or timezone.now())-datetime.timedelta(hours=settings.PURGE_DISPATCHES_AFTER_HOURS)
+    return OTPDispatch.objects.filter(
+        status__in=(OTPDispatch.SENT,OTPDispatch.FAILED),
+        updated_at__lt=cutoff,
+    )
+
+
+def stale_accounts(days,now=None):
+    """
+    Accounts older than days that were never verified and never logged in,
+    social logins set last_login so they are never picked up
+    """
+    cutoff=(now or timezone.now())-datetime.timedelta(days=days)
+    return User.objects.filter(
+        date_joined__lt=cutoff,
+        last_login=None,
+        is_staff=False,
+        is_superuser=False,
+    ).exclude(phone__is_verified=True)
+
+
+def purge_in_chunks(name,queryset,chunk_size=None,pause=None,restart=False,report=None):
+    """
+    Delete the rows of queryset chunk_size primary keys at a time and return
+    the number of rows deleted, related rows removed by cascades excluded.
+
+    report is called after every chunk with (name, last pk, rows deleted,
+    seconds elapsed). The checkpoint is kept under name, pass restart to
+    ignore it.
+    """
+    chunk_size=chunk_size or settings.PURGE_CHUNK_SIZE
+    pause=settings.PURGE_CHUNK_PAUSE if pause is None else pause
+    model=queryset.model
+    key=f"users:purge:{name}"
+
+    if restart:
+        cache.delete(key)
+
+    # bounds of the whole table, the filtered queryset is only applied per chunk
+    bounds=model.objects.aggregate(low=Min("pk"),high=Max("pk"))
+    if bounds["high"] is None:
+        return 0
+
+    start=max(bounds["low"],cache.get(key,0)+1)
+    deleted=0
+    started=time.monotonic()
+
+    for low in range(start,bounds["high"]+1,chunk_size):
+        high=low+chunk_size-1
+        with transaction.atomic():
+            _,counts=queryset.filter(pk__gte=low,pk__lte=high).delete()
+        deleted+=counts.get(model._meta.label,0)
+        cache.set(key,high,CHECKPOINT_TIMEOUT)
+
+        if report:
+            report(name,high,deleted,time.monotonic()-started)
+        if pause:
+            time.sleep(pause)
+
+    cache.delete(key)
+    return deleted
@@ -1,10 +1,15 @@
+from allauth.account.adapter import get_adapter
+from allauth.account.models import EmailAddress
 from dj_rest_auth.registration.serializers import RegisterSerializer
 from django.conf import settings
 from django.contrib.auth import authenticate,get_user_model
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 from django.utils.translation import gettext as _
 from django_countries.serializers import CountryFieldMixin
-from phonenumber_field.serializerfields import PhoneNumberField
+from phonenumber_field.serializerfields import PhoneNumberField as BasePhoneNumberField
 from rest_framework import serializers
+from rest_framework.exceptions import NotAcceptable
 from rest_framework.validators import UniqueValidator
 
 from .exceptions import (
@@ -13,7 +18,23 @@ from .exceptions import (
     InvalidCredentialsException,
     AccountNotVerifiedException
 )
-from .models import Address,OTP, Profile,User
+from .avatars import variant_urls
+from .models import Address,OTP,OTPDispatch,Profile,User
+from .phone import parse_phone_number
+from .tasks import process_avatar
+
+
+class PhoneNumberField(BasePhoneNumberField):
+    """
+    Phone number field that parses through the memoized users.phone cache
+    """
+
+    def to_internal_value(self,data):
+        phone_number=parse_phone_number(data)
+        if phone_number is None:
+            self.fail("invalid")
+        return phone_number
+
 
 class UserRegistrationSerializer(RegisterSerializer):
     """
@@ -52,27 +73,42 @@ class UserRegistrationSerializer(RegisterSerializer):
         
         return validated_data
     
-    def get_cleaned_data_extra(self):
-        return {
-            "phone_number":self.validated_data.get("phone_number",""),
-            "first_name":self.validated_data.get("first_name",""),
-            "last_name":self.validated_data.get("last_name","")
-        }
-        
-    def create_extra(self,user,validated_data):
-        user.first_name=self.validated_data.get("first_name")
-        user.last_name=self.validated_data.get("last_name")
-        user.phone_number=self.validated_data.get("phone_number")
-        user.save()        
-
-    def custom_signup(self,request,user):
-        self.create_extra(user,self.get_cleaned_data_extra())
-    
-    def save(self, request):
-        user = super().save(request)
-        user.phone_number = self.validated_data.get('phone_number', '')
-        user.username=self.validated_data.get('phone_number', '') or self.validated_data.get('email', '')
-        user.save()
+    def build_user(self,request):
+        """Return the new user with every field set, not saved yet"""
+
+        email=self.validated_data.get("email") or None
+        phone_number=self.validated_data.get("phone_number") or None
+        password=self.validated_data["password1"]
+
+        user=get_adapter().new_user(request)
+        user.email=email
+        user.phone_number=phone_number
+        user.username=str(phone_number) if phone_number else email
+        user.first_name=self.validated_data.get("first_name","")
+        user.last_name=self.validated_data.get("last_name","")
+
+        try:
+            get_adapter().clean_password(password,user=user)
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(
+                detail=serializers.as_serializer_error(exc)
+            )
+        user.set_password(password)
+        return user
+
+    def save(self,request):
+        """
+        Insert the user once, the create_profile signal adds its Profile
+        in the same transaction
+        """
+        user=self.build_user(request)
+
+        with transaction.atomic(savepoint=False):
+            user.save()
+            if user.email:
+                # a brand new user has no addresses yet, skip setup_user_email's lookups
+                EmailAddress.objects.create(user=user,email=user.email,primary=True,verified=False)
+        return user
 
 
 class UserLoginSerializer(serializers.Serializer):
@@ -113,9 +149,10 @@ class UserLoginSerializer(serializers.Serializer):
         
         user=self._validate_phone_email(phone_number,email,password)
         
-        user_otp=OTP.objects.filter(user=user).first()
+        # loaded with the user by IdentifierAuthBackend, no extra query
+        user_otp=getattr(user,"phone",None)
         
-        if not user_otp.is_verified:
+        if user_otp is None or not user_otp.is_verified:
             raise AccountNotVerifiedException()
         
         if not user:
@@ -212,9 +249,13 @@ class VerifyEmailSerializer(serializers.Serializer):
         otp=validated_data.get("otp")
         is_otp_for_password=validated_data.get("is_otp_for_password",False)
 
-        email_qs=OTP.objects.get(user__email=email)
+        try:
+            email_qs=OTP.objects.get(user__email=email)
+        except OTP.DoesNotExist:
+            # purged once the code expired, see users.purge
+            raise NotAcceptable(_("Your security code is wrong or expired."))
         
-        email_qs.check_verification(security_code=otp,is_otp_for_password=is_otp_for_password)        
+        email_qs.check_verification(security_code=otp,is_otp_for_password=is_otp_for_password,channel=OTPDispatch.EMAIL)        
         
         return validated_data  
 class VerifyPhoneNumberSerializer(serializers.Serializer):
@@ -240,9 +281,13 @@ class VerifyPhoneNumberSerializer(serializers.Serializer):
 
     
 
-        phone_number_qs=OTP.objects.get(user__phone_number=phone_number)
+        try:
+            phone_number_qs=OTP.objects.get(user__phone_number=phone_number)
+        except OTP.DoesNotExist:
+            # purged once the code expired, see users.purge
+            raise NotAcceptable(_("Your security code is wrong or expired."))
         
-        phone_number_qs.check_verification(security_code=otp)        
+        phone_number_qs.check_verification(security_code=otp,channel=OTPDispatch.SMS)        
         
         return validated_data    
 
@@ -250,16 +295,51 @@ class VerifyPhoneNumberSerializer(serializers.Serializer):
 class ProfileSerializer(serializers.ModelSerializer):
     """
     Serializer class to serialize the user Profile Model
+
+    The uploaded avatar is write only, clients get the resized variants,
+    null until the process_avatar task has made them.
     """
-    
+
+    avatar_variants=serializers.SerializerMethodField()
+
     class Meta:
         model=Profile
         fields=(
             "avatar",
+            "avatar_variants",
             "bio",
             "created_at",
             "updated_at"
         )
+        extra_kwargs={"avatar":{"write_only":True}}
+
+    def get_avatar_variants(self,profile):
+        urls=variant_urls(profile)
+        request=self.context.get("request")
+        if urls is None or request is None:
+            return urls
+        return {
+            variant:{extension:request.build_absolute_uri(url) for extension,url in formats.items()}
+            for variant,formats in urls.items()
+        }
+
+    def validate_avatar(self,value):
+        if value and value.size>settings.AVATAR_MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                _("The avatar cannot be larger than %(size)s MB.")%{"size":settings.AVATAR_MAX_UPLOAD_SIZE//(1024*1024)}
+            )
+        return value
+
+    def update(self,instance,validated_data):
+        for name,value in validated_data.items():
+            setattr(instance,name,value)
+        # leave avatar_variants alone, process_avatar may be writing it
+        instance.save(update_fields=[*validated_data,"updated_at"])
+
+        if validated_data.get("avatar"):
+            # decoding and resizing happen on a worker, not in the request
+            transaction.on_commit(lambda:process_avatar.delay(instance.pk))
+        return instance
         
     
 class AddressReadOnlySerializer(CountryFieldMixin,serializers.ModelSerializer):
@@ -0,0 +1,27 @@
+from .models import OTP,OTPDispatch
+
+
+def issue_otp(user,channel,is_otp_for_password=False,created=False,enqueue=True):
+    """
+    Generate a new OTP for user and queue it on the given channel.
+
+    Pass created=True for a user saved in the current request, it cannot
+    have an OTP yet so the lookup is skipped. With enqueue=False no Celery
+    task is queued, the caller delivers the outbox row itself.
+    """
+
+    otp=None
+    if not created:
+        otp_qs=OTP.objects.filter(user=user)
+        if not is_otp_for_password:
+            otp_qs=otp_qs.filter(is_verified=False)
+        otp=otp_qs.first()
+
+    if otp is None:
+        otp=OTP(user=user)
+
+    if channel==OTPDispatch.SMS:
+        otp.send_confirmation(is_otp_for_password=is_otp_for_password,enqueue=enqueue)
+    else:
+        otp.send_email_OTP(reciever_email=user.email,is_otp_for_password=is_otp_for_password,enqueue=enqueue)
+    return otp
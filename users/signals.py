@@ -1,8 +1,21 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from .models import Profile,User
+from .authentication import bump_auth_version
+from .cache import bump_version
+from .middleware import run_observers
+from .models import Address,Profile,User
+
+
+@receiver(connection_created)
+def install_query_observers(sender,connection,**kwargs):
+    # execute_wrappers outlive the database connection, a reconnect must not add the observers twice
+    if run_observers not in connection.execute_wrappers:
+        connection.execute_wrappers.append(run_observers)
 
 
 @receiver(post_save,sender=User)
@@ -12,5 +25,44 @@ def create_profile(sender,instance,created,**kwargs):
 
 
 @receiver(post_save,sender=User)
-def save_profile(sender,instance,**kwargs):
-    instance.profile.save()    
+def save_profile(sender,instance,created,**kwargs):
+    if created:
+        return
+
+    # only a profile already loaded on this user can carry unsaved edits
+    if User.profile.is_cached(instance) and instance.profile.has_changed():
+        instance.profile.save()
+
+
+@receiver(post_save,sender=User)
+@receiver(post_delete,sender=User)
+def invalidate_user_responses(sender,instance,**kwargs):
+    # bumped once the change is visible, a request reading the old row before the commit
+    # would otherwise cache it under the new version
+    user_id=instance.pk
+    transaction.on_commit(lambda:bump_version(user_id))
+
+
+@receiver(post_save,sender=User)
+@receiver(post_delete,sender=User)
+def invalidate_auth_snapshot(sender,instance,update_fields=None,**kwargs):
+    # last_login is not part of the snapshot, it changes on every login
+    if update_fields is not None and set(update_fields)<={"last_login"}:
+        return
+    user_id=instance.pk
+    transaction.on_commit(lambda:bump_auth_version(user_id))
+
+
+@receiver(user_logged_out)
+def invalidate_auth_snapshot_on_logout(sender,user,**kwargs):
+    if user is not None:
+        bump_auth_version(user.pk)
+
+
+@receiver(post_save,sender=Profile)
+@receiver(post_delete,sender=Profile)
+@receiver(post_save,sender=Address)
+@receiver(post_delete,sender=Address)
+def invalidate_related_responses(sender,instance,**kwargs):
+    user_id=instance.user_id
+    transaction.on_commit(lambda:bump_version(user_id))
@@ -0,0 +1,42 @@
+"""
+Tools for sending SMS messages, modelled on ``django.core.mail``.
+
+The backend is picked with the ``SMS_BACKEND`` setting the same way
+``EMAIL_BACKEND`` picks the mail backend.
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .message import SMSMessage
+
+__all__=[
+    "SMSMessage",
+    "get_connection",
+    "send_sms",
+    "send_mass_sms",
+]
+
+
+def get_connection(backend=None,fail_silently=False,**kwds):
+    """Load an SMS backend and return an instance of it"""
+
+    klass=import_string(backend or settings.SMS_BACKEND)
+    return klass(fail_silently=fail_silently,**kwds)
+
+
+def send_sms(body,to,from_=None,fail_silently=False,connection=None):
+    """
+    Send a single SMS and return the number of messages sent (0 or 1)
+    """
+    connection=connection or get_connection(fail_silently=fail_silently)
+    return connection.send_messages([SMSMessage(body,to,from_)])
+
+
+def send_mass_sms(datatuple,fail_silently=False,connection=None):
+    """
+    Send every (body, to, from_) tuple in datatuple over a single connection
+    and return the number of messages sent
+    """
+    connection=connection or get_connection(fail_silently=fail_silently)
+    messages=[SMSMessage(body,to,from_) for body,to,from_ in datatuple]
+    return connection.send_messages(messages)
@@ -0,0 +1,47 @@
+from asgiref.sync import sync_to_async
+
+
+class BaseSMSBackend:
+    """
+    Base class for SMS backend implementations.
+
+    Subclasses must override send_messages(). open() and close() can be
+    overridden by backends that hold a connection to the provider, and
+    asend_messages() by backends with a non-blocking client.
+    """
+
+    def __init__(self,fail_silently=False,**kwargs):
+        self.fail_silently=fail_silently
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        try:
+            self.open()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def send_messages(self,sms_messages):
+        """
+        Send one or more SMSMessage objects and return the number of
+        messages sent
+        """
+        raise NotImplementedError(
+            "subclasses of BaseSMSBackend must override send_messages() method"
+        )
+
+    async def asend_messages(self,sms_messages):
+        """
+        Send messages from async code, by default send_messages() runs on a
+        worker thread
+        """
+        return await sync_to_async(self.send_messages,thread_sensitive=False)(sms_messages)
@@ -0,0 +1,41 @@
+"""SMS backend that writes messages to a file."""
+import datetime
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .base import BaseSMSBackend
+
+
+class SMSBackend(BaseSMSBackend):
+    """
+    Append every message to a log file in ``SMS_FILE_PATH``, one file per
+    backend instance
+    """
+
+    def __init__(self,*args,file_path=None,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.file_path=str(file_path or getattr(settings,"SMS_FILE_PATH",""))
+        if not self.file_path:
+            raise ImproperlyConfigured("SMS_FILE_PATH must be set to use the file based SMS backend.")
+        os.makedirs(self.file_path,exist_ok=True)
+        self._fname=None
+        self._lock=threading.RLock()
+
+    def _get_filename(self):
+        if self._fname is None:
+            timestamp=datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            self._fname=os.path.join(self.file_path,f"{timestamp}-{abs(id(self))}.log")
+        return self._fname
+
+    def send_messages(self,messages):
+        if not messages:
+            return 0
+        with self._lock, open(self._get_filename(),"a") as stream:
+            for message in messages:
+                stream.write(f"From: {message.from_}\nTo: {message.to}\n\n{message.body}\n")
+                stream.write("-"*79)
+                stream.write("\n")
+        return len(messages)
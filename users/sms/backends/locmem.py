@@ -0,0 +1,27 @@
+"""
+Backend for test environment.
+"""
+from users import sms
+
+from .base import BaseSMSBackend
+
+
+class SMSBackend(BaseSMSBackend):
+    """
+    An SMS backend for use during test sessions and offline load tests.
+
+    Sent messages are appended to ``users.sms.outbox`` instead of being
+    handed to a provider.
+    """
+
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        if not hasattr(sms,"outbox"):
+            sms.outbox=[]
+
+    def send_messages(self,messages):
+        sms.outbox.extend(messages)
+        return len(messages)
+
+    async def asend_messages(self,messages):
+        return self.send_messages(messages)
@@ -0,0 +1,154 @@
+"""Twilio SMS backend class."""
+import threading
+from urllib.parse import urlencode
+
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from .base import BaseSMSBackend
+
+_client=None
+_client_lock=threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide Twilio client.
+
+    The client is built once and keeps its HTTP session, so every send after
+    the first reuses a pooled keep-alive connection instead of paying for a
+    new TLS handshake.
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                account_sid=settings.TWILIO_ACCOUNT_SID
+                auth_token=settings.TWILIO_AUTH_TOKEN
+
+                if not all([account_sid,auth_token,settings.TWILIO_PHONE_NUMBER]):
+                    raise ImproperlyConfigured("Twilio credentials are not set.")
+
+                http_client=TwilioHttpClient(
+                    pool_connections=True,
+                    timeout=settings.SMS_TWILIO_TIMEOUT,
+                )
+                http_client.session.mount(
+                    "https://",
+                    HTTPAdapter(pool_maxsize=settings.SMS_TWILIO_POOL_SIZE),
+                )
+                _client=Client(account_sid,auth_token,http_client=http_client)
+    return _client
+
+
+MESSAGES_URL="https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json"
+
+_async_client_configured=False
+
+
+def get_async_client():
+    """
+    Return the non-blocking HTTP client of the running event loop.
+
+    Tornado keeps one client per loop, it multiplexes up to
+    SMS_TWILIO_ASYNC_MAX_CLIENTS requests over its own sockets without
+    taking a thread per request.
+    """
+    global _async_client_configured
+
+    if not _async_client_configured:
+        AsyncHTTPClient.configure(None,max_clients=settings.SMS_TWILIO_ASYNC_MAX_CLIENTS)
+        _async_client_configured=True
+    return AsyncHTTPClient()
+
+
+def reset_client():
+    """Drop the cached client, e.g. after a fork or a credentials change"""
+
+    global _client
+
+    with _client_lock:
+        _client=None
+
+
+@worker_process_init.connect
+def reset_client_after_fork(**kwargs):
+    # a Celery child must not share the parent's pooled sockets, gunicorn does the same in post_fork
+    reset_client()
+
+
+@receiver(setting_changed)
+def reset_client_on_setting_change(setting,**kwargs):
+    if setting.startswith(("TWILIO_","SMS_TWILIO_")):
+        reset_client()
+
+
+class SMSBackend(BaseSMSBackend):
+    """
+    Send messages through the Twilio REST API over the shared client
+    """
+
+    def send_messages(self,messages):
+        if not messages:
+            return 0
+
+        try:
+            client=get_client()
+        except ImproperlyConfigured:
+            if not self.fail_silently:
+                raise
+            return 0
+
+        num_sent=0
+        for message in messages:
+            try:
+                client.messages.create(
+                    body=message.body,
+                    to=message.to,
+                    from_=message.from_,
+                )
+            except TwilioRestException:
+                if not self.fail_silently:
+                    raise
+                continue
+            num_sent+=1
+        return num_sent
+
+    async def asend_messages(self,messages):
+        if not messages:
+            return 0
+
+        account_sid=settings.TWILIO_ACCOUNT_SID
+        auth_token=settings.TWILIO_AUTH_TOKEN
+        if not all([account_sid,auth_token,settings.TWILIO_PHONE_NUMBER]):
+            if not self.fail_silently:
+                raise ImproperlyConfigured("Twilio credentials are not set.")
+            return 0
+
+        client=get_async_client()
+        num_sent=0
+        for message in messages:
+            try:
+                await client.fetch(
+                    MESSAGES_URL%account_sid,
+                    method="POST",
+                    body=urlencode({"Body":message.body,"To":message.to,"From":message.from_}),
+                    auth_username=account_sid,
+                    auth_password=auth_token,
+                    request_timeout=settings.SMS_TWILIO_TIMEOUT,
+                )
+            except HTTPClientError:
+                if not self.fail_silently:
+                    raise
+                continue
+            num_sent+=1
+        return num_sent
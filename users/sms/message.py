@@ -0,0 +1,15 @@
+from django.conf import settings
+
+
+class SMSMessage:
+    """
+    A single text message
+    """
+
+    def __init__(self,body,to,from_=None):
+        self.body=body
+        self.to=str(to)
+        self.from_=from_ or settings.TWILIO_PHONE_NUMBER
+
+    def __repr__(self):
+        return f"<SMSMessage to={self.to}>"
@@ -0,0 +1,102 @@
+"""
+Content-addressed file storage.
+
+Files are named after the SHA-256 of their content, under the directory
+they were uploaded to: ``avatar/3f/3f9a...c2.jpg``. Identical uploads
+share one file, and a name never points at different bytes, so it can be
+served with a strong ETag and cached forever.
+
+Files are never deleted when a profile stops using them, another profile
+may hold the same content. collect_garbage() removes the ones nothing
+references anymore.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+HASHED_NAME=re.compile(r"(?:^|/)[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(?:\.[a-z0-9]+)?$")
+
+
+def content_digest(name):
+    """Return the SHA-256 a content-addressed name was made from, or None for other names"""
+
+    match=HASHED_NAME.search(name)
+    return match.group("digest") if match else None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names files by the SHA-256 of their content"""
+
+    def hashed_name(self,name,digest):
+        directory,basename=os.path.split(name)
+        extension=os.path.splitext(basename)[1].lower()
+        return os.path.join(directory,digest[:2],digest+extension).replace("\\","/")
+
+    def save(self,name,content,max_length=None):
+        if name is None:
+            name=content.name
+        if not hasattr(content,"chunks"):
+            content=File(content,name)
+
+        digest=hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        return self._save(self.hashed_name(name,digest.hexdigest()),content)
+
+    def _save(self,name,content):
+        path=self.path(name)
+        if os.path.exists(path):
+            # a fresh mtime keeps collect_garbage off a file about to be referenced again
+            os.utime(path)
+            return name
+
+        directory=os.path.dirname(path)
+        os.makedirs(directory,exist_ok=True)
+        fd,temporary=tempfile.mkstemp(dir=directory,prefix=".upload-")
+        try:
+            with os.fdopen(fd,"wb") as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary,self.file_permissions_mode)
+            # concurrent saves of the same content write the same bytes, the last rename wins harmlessly
+            os.replace(temporary,path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return name
+
+    def get_available_name(self,name,max_length=None):
+        return name
+
+    def walk(self,directory=""):
+        """Yield the name of every file under directory"""
+
+        directories,files=self.listdir(directory)
+        for name in files:
+            yield os.path.join(directory,name).replace("\\","/")
+        for name in directories:
+            yield from self.walk(os.path.join(directory,name))
+
+
+def collect_garbage(storage,referenced,directory,grace_seconds,dry_run=False):
+    """
+    Delete the files under directory whose name is not in referenced and
+    that were not written in the last grace_seconds, and return their names
+    """
+    cutoff=time.time()-grace_seconds
+    deleted=[]
+    for name in storage.walk(directory):
+        if name in referenced or os.path.getmtime(storage.path(name))>cutoff:
+            continue
+        if not dry_run:
+            storage.delete(name)
+        deleted.append(name)
+    return deleted
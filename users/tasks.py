@@ -0,0 +1,292 @@
+import asyncio
+import datetime
+import logging
+
+from asgiref.sync import sync_to_async
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from . import sms
+from .avatars import SOURCE_KEY,collect_avatar_garbage,render_variants,store_variants
+from .mail import BatchInterrupted,send_otp_emails
+from .metrics import OTP_SEND_SECONDS
+from .models import OTP,OTPDispatch,Profile
+from .otp_store import get_otp_store
+from .purge import expired_otps,finished_dispatches,purge_in_chunks,stale_accounts
+
+logger=logging.getLogger(__name__)
+
+
+def claim_dispatches(batch_size,queryset=None):
+    """
+    Mark up to batch_size pending outbox rows as sending and return them.
+
+    Rows are locked with SKIP LOCKED where the database supports it so
+    concurrent workers never pick up the same row.
+    """
+    if queryset is None:
+        queryset=OTPDispatch.objects.all()
+
+    with transaction.atomic():
+        ids=list(
+            queryset.select_for_update(skip_locked=True)
+            .filter(status=OTPDispatch.PENDING)
+            .order_by("id")
+            .values_list("id",flat=True)[:batch_size]
+        )
+        if ids:
+            OTPDispatch.objects.filter(pk__in=ids).update(
+                status=OTPDispatch.SENDING,
+                attempts=F("attempts")+1,
+                updated_at=timezone.now(),
+            )
+    return list(OTPDispatch.objects.filter(pk__in=ids).select_related("otp").order_by("id"))
+
+
+def _record_failure(dispatch,error):
+    dispatch.last_error=str(error)
+    dispatch.status=(
+        OTPDispatch.FAILED
+        if dispatch.attempts>=settings.OTP_DISPATCH_MAX_ATTEMPTS
+        else OTPDispatch.PENDING
+    )
+    dispatch.save(update_fields=["status","last_error","updated_at"])
+
+
+def _drop_expired(dispatches):
+    """Fail the rows whose code expired or was used before they were sent and return the others"""
+
+    expired=[dispatch.pk for dispatch in dispatches if dispatch.text is None]
+    if expired:
+        OTPDispatch.objects.filter(pk__in=expired).update(
+            status=OTPDispatch.FAILED,
+            last_error="The code expired before it was sent.",
+            updated_at=timezone.now(),
+        )
+    return [dispatch for dispatch in dispatches if dispatch.text is not None]
+
+
+def _record_sent(dispatches):
+    OTPDispatch.objects.filter(pk__in=[dispatch.pk for dispatch in dispatches]).update(
+        status=OTPDispatch.SENT,
+        sent_at=timezone.now(),
+        updated_at=timezone.now(),
+    )
+
+
+def deliver_dispatches(dispatches):
+    """
+    Hand claimed rows to the provider and record the outcome of each.
+
+    SMS rows share one SMS connection. Email rows are coalesced into a
+    single send_messages call over the worker's persistent mail connection.
+    """
+
+    dispatches=_drop_expired(dispatches)
+    sms_dispatches=[dispatch for dispatch in dispatches if dispatch.channel==OTPDispatch.SMS]
+    email_dispatches=[dispatch for dispatch in dispatches if dispatch.channel==OTPDispatch.EMAIL]
+    delivered=[]
+
+    sms_connection=sms.get_connection()
+    for dispatch in sms_dispatches:
+        try:
+            with OTP_SEND_SECONDS.labels("sms").time():
+                dispatch.deliver(sms_connection=sms_connection)
+        except Exception as e:
+            _record_failure(dispatch,e)
+        else:
+            delivered.append(dispatch)
+
+    if email_dispatches:
+        try:
+            with OTP_SEND_SECONDS.labels("email").time():
+                send_otp_emails([dispatch.email_message() for dispatch in email_dispatches])
+        except BatchInterrupted as e:
+            # the rows before the one that failed were sent, only the rest go back to the outbox
+            delivered.extend(email_dispatches[:e.sent])
+            for dispatch in email_dispatches[e.sent:]:
+                _record_failure(dispatch,e.error)
+        else:
+            delivered.extend(email_dispatches)
+
+    _record_sent(delivered)
+    return len(delivered)
+
+
+async def _asend(dispatch,sms_connection):
+    if dispatch.channel==OTPDispatch.SMS:
+        with OTP_SEND_SECONDS.labels("sms").time():
+            await sms_connection.asend_messages([sms.SMSMessage(dispatch.text,dispatch.recipient)])
+    else:
+        with OTP_SEND_SECONDS.labels("email").time():
+            await sync_to_async(send_otp_emails,thread_sensitive=False)([dispatch.email_message()])
+
+
+async def _adeliver(dispatch,sms_connection):
+    try:
+        await _asend(dispatch,sms_connection)
+    except Exception as e:
+        await sync_to_async(_record_failure)(dispatch,e)
+        return None
+    return dispatch
+
+
+async def adeliver_pending(queryset):
+    """
+    Claim the pending rows of queryset and deliver them from async code.
+
+    SMS rows go through the backend's asend_messages(), so waiting on the
+    provider does not hold a thread. Rows that fail go back to the outbox
+    for drain_otp_outbox.
+    """
+    dispatches=await sync_to_async(claim_dispatches)(settings.OTP_DISPATCH_BATCH_SIZE,queryset)
+    dispatches=await sync_to_async(_drop_expired)(dispatches)
+    if not dispatches:
+        return 0
+
+    sms_connection=sms.get_connection()
+    results=await asyncio.gather(*(_adeliver(dispatch,sms_connection) for dispatch in dispatches))
+    delivered=[dispatch for dispatch in results if dispatch is not None]
+    await sync_to_async(_record_sent)(delivered)
+    return len(delivered)
+
+
+async def adeliver_derived(dispatch):
+    """
+    Deliver an unsaved dispatch of a store without an outbox from async
+    code, a failed send is handed to send_derived_otp to retry
+    """
+    try:
+        await _asend(dispatch,sms.get_connection())
+    except Exception:
+        logger.warning("OTP delivery to %s failed, queued for a retry",dispatch.recipient,exc_info=True)
+        await sync_to_async(send_derived_otp.delay)(*dispatch.task_args)
+        return 0
+    return 1
+
+
+def release_expired_leases():
+    """Put rows back in the queue whose worker died while sending them"""
+
+    lease=datetime.timedelta(seconds=settings.OTP_DISPATCH_LEASE_SECONDS)
+    return OTPDispatch.objects.filter(
+        status=OTPDispatch.SENDING,
+        updated_at__lt=timezone.now()-lease,
+    ).update(status=OTPDispatch.PENDING)
+
+
+@shared_task
+def deliver_otp_dispatch(dispatch_id):
+    """
+    Deliver the row dispatch_id with the rows queued before it that were
+    not tried yet, in one batch. During a burst the first task to run
+    takes the rows of the tasks behind it, which then find nothing left.
+    Rows that failed are left to drain_otp_outbox.
+    """
+    dispatches=claim_dispatches(
+        settings.OTP_DISPATCH_BATCH_SIZE,
+        OTPDispatch.objects.filter(pk__lte=dispatch_id,attempts=0),
+    )
+    return deliver_dispatches(dispatches)
+
+
+@shared_task(bind=True)
+def send_derived_otp(self,user_id,channel,recipient,body,purpose,step):
+    """
+    Deliver a code of a store without an outbox, HMACOTPStore or
+    CacheOTPStore.
+
+    Only the time step of the code goes through the broker, the code is
+    derived again here, or read back from the cache. Failed sends are retried until OTP_DISPATCH_MAX_ATTEMPTS
+    or until the code expires.
+    """
+    security_code=get_otp_store().derive(OTP(user_id=user_id),channel,purpose,step)
+    if security_code is None:
+        logger.warning("OTP to %s expired before it was sent",recipient)
+        return 0
+
+    dispatch=OTPDispatch(channel=channel,recipient=recipient,body=body)
+    dispatch.text=body.format(security_code=security_code)
+    try:
+        with OTP_SEND_SECONDS.labels("sms" if channel==OTPDispatch.SMS else "email").time():
+            dispatch.deliver()
+    except Exception as e:
+        if self.request.retries+1>=settings.OTP_DISPATCH_MAX_ATTEMPTS:
+            logger.warning("OTP to %s failed, giving up",recipient,exc_info=True)
+            return 0
+        raise self.retry(exc=e,countdown=2**self.request.retries)
+    return 1
+
+
+@shared_task
+def drain_otp_outbox(batch_size=None):
+    batch_size=batch_size or settings.OTP_DISPATCH_BATCH_SIZE
+
+    release_expired_leases()
+
+    sent=0
+    last_id=0
+    while True:
+        # rows that failed in this run go back to pending, only retry them on the next run
+        dispatches=claim_dispatches(batch_size,OTPDispatch.objects.filter(pk__gt=last_id))
+        if not dispatches:
+            return sent
+        last_id=dispatches[-1].pk
+        sent+=deliver_dispatches(dispatches)
+
+
+def _log_purge(name,last_pk,deleted,elapsed):
+    logger.info("purge %s: up to pk %s, %s rows deleted, %.0f rows/s",name,last_pk,deleted,deleted/elapsed if elapsed else 0)
+
+
+@shared_task
+def purge_stale_users(days=None):
+    now=timezone.now()
+    return {
+        "otps":purge_in_chunks("otps",expired_otps(now),report=_log_purge),
+        "dispatches":purge_in_chunks("dispatches",finished_dispatches(now),report=_log_purge),
+        "users":purge_in_chunks(
+            "users",
+            stale_accounts(days or settings.PURGE_UNVERIFIED_AFTER_DAYS,now),
+            report=_log_purge,
+        ),
+    }
+
+
+@shared_task
+def process_avatar(profile_id):
+    """Render and store the variants of the profile's current avatar"""
+
+    profile=Profile.objects.filter(pk=profile_id).first()
+    if profile is None or not profile.avatar:
+        return None
+    if (profile.avatar_variants or {}).get(SOURCE_KEY)==profile.avatar.name:
+        return profile.avatar_variants
+
+    try:
+        with profile.avatar.open("rb") as f:
+            rendered=render_variants(f)
+    except (UnidentifiedImageError,Image.DecompressionBombError,OSError) as e:
+        logger.warning("avatar of profile %s could not be processed: %s",profile_id,e)
+        return None
+    variants=store_variants(profile.avatar.name,rendered)
+
+    with transaction.atomic():
+        current=Profile.objects.select_for_update().filter(pk=profile_id).first()
+        if current is None or current.avatar.name!=profile.avatar.name:
+            # replaced meanwhile, the task queued for the new upload renders it
+            return None
+        current.avatar_variants=variants
+        current.save(update_fields=["avatar_variants","updated_at"])
+    return variants
+
+
+@shared_task
+def gc_avatars():
+    deleted=collect_avatar_garbage()
+    logger.info("avatar gc: %s unreferenced files deleted",len(deleted))
+    return len(deleted)
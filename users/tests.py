@@ -0,0 +1,1392 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock
+
+from celery.signals import worker_init,worker_process_init
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.signals import user_logged_out
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from phonenumber_field.phonenumber import PhoneNumber
+from PIL import Image
+from prometheus_client import REGISTRY
+from rest_framework import status
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users import phone,sms
+from users.sms.backends import twilio
+from users.authentication import get_cached_user
+from users.avatars import collect_avatar_garbage,get_storage
+from users.backends.identifier_backend import IdentifierAuthBackend
+from users.benchmark import compare,percentiles
+from users.mail import BatchInterrupted,PersistentMailer
+from users.management.commands import audit_query_plans,bench_otp_sms
+from users.middleware import MetricsMiddleware,SQLProfilingMiddleware,normalize_sql
+from users.models import Address,OTP,OTPDispatch,Profile,User
+from users.purge import expired_otps,purge_in_chunks,stale_accounts
+from users.services import issue_otp
+from users.tasks import (
+    claim_dispatches,
+    deliver_dispatches,
+    deliver_otp_dispatch,
+    drain_otp_outbox,
+    release_expired_leases,
+    send_derived_otp,
+)
+from users.throttling import IdentifierRateThrottle
+
+LOCMEM_CACHES={
+    "default":{
+        "BACKEND":"django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+
+@override_settings(SMS_BACKEND="users.sms.backends.locmem.SMSBackend")
+class UserRegistrationQueryCountTest(APITestCase):
+    """
+    Registration issues the OTP directly instead of re-dispatching the
+    send views, so its SQL cost is fixed
+    """
+
+    url=reverse("users:user_register")
+    password="Xk2!pQ9#rT"
+
+    def setUp(self):
+        sms.outbox=[]
+
+    def register(self,queries,**data):
+        """Post the registration and run the deliveries queued on commit afterwards"""
+
+        data.update(password1=self.password,password2=self.password)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertNumQueries(queries):
+                response=self.client.post(self.url,data,format="json")
+        for callback in callbacks:
+            callback()
+        return response
+
+    def test_register_with_email_query_count(self):
+        response=self.register(10,email="jane@example.com")
+
+        self.assertEqual(response.status_code,status.HTTP_201_CREATED)
+        self.assertEqual(response.data,{"detail":"Verification e-mail sent."})
+        self.assertEqual(len(mail.outbox),1)
+        self.assertIn(OTP.objects.get().security_code,mail.outbox[0].body)
+
+        user=User.objects.get()
+        self.assertEqual(user.username,"jane@example.com")
+        self.assertIsNone(user.phone_number)
+        self.assertTrue(Profile.objects.filter(user=user).exists())
+
+    def test_register_with_phone_number_query_count(self):
+        response=self.register(7,phone_number="+251911223344")
+
+        self.assertEqual(response.status_code,status.HTTP_201_CREATED)
+        self.assertEqual(response.data,{"detail":"Verification SMS sent."})
+        self.assertEqual(len(sms.outbox),1)
+        self.assertEqual(sms.outbox[0].to,"+251911223344")
+        self.assertEqual(OTPDispatch.objects.get().status,OTPDispatch.SENT)
+
+
+@override_settings(SMS_BACKEND="users.sms.backends.locmem.SMSBackend")
+class OTPOutboxTest(APITestCase):
+    def setUp(self):
+        sms.outbox=[]
+        mail.outbox=[]
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344",email="jane@example.com")
+        self.otp=OTP.objects.create(user=self.user,security_code="123456",sent=timezone.now())
+
+    def queue(self,channel=OTPDispatch.SMS,**kwargs):
+        recipient=self.user.email if channel==OTPDispatch.EMAIL else str(self.user.phone_number)
+        return OTPDispatch.objects.create(otp=self.otp,channel=channel,recipient=recipient,body="Your code is {security_code}",**kwargs)
+
+    def test_task_delivers_earlier_rows_in_one_batch(self):
+        retried=self.queue(attempts=1)
+        dispatches=[self.queue(),self.queue(OTPDispatch.EMAIL),self.queue(OTPDispatch.EMAIL)]
+        later=self.queue()
+
+        self.assertEqual(deliver_otp_dispatch(dispatches[-1].pk),3)
+        self.assertEqual((len(sms.outbox),len(mail.outbox)),(1,2))
+        self.assertFalse(OTPDispatch.objects.filter(pk__in=[d.pk for d in dispatches]).exclude(status=OTPDispatch.SENT).exists())
+        # failed rows wait for drain_otp_outbox, later rows for their own task
+        self.assertEqual(OTPDispatch.objects.get(pk=retried.pk).status,OTPDispatch.PENDING)
+        self.assertEqual(OTPDispatch.objects.get(pk=later.pk).status,OTPDispatch.PENDING)
+        self.assertEqual(deliver_otp_dispatch(dispatches[0].pk),0)
+
+    def test_dispatch_is_written_with_the_otp(self):
+        with mock.patch("users.tasks.deliver_otp_dispatch.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                otp=issue_otp(self.user,OTPDispatch.SMS)
+            delay.assert_called_once_with(otp.dispatch.pk)
+            code=OTP.objects.get().security_code
+
+            # a request failing after the code was issued leaves neither the code nor its message
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertRaises(RuntimeError),transaction.atomic():
+                    issue_otp(self.user,OTPDispatch.SMS)
+                    raise RuntimeError()
+        self.assertEqual(callbacks,[])
+        self.assertEqual(OTPDispatch.objects.filter(otp__user=self.user).count(),1)
+        self.assertEqual(OTP.objects.get().security_code,code)
+
+    @override_settings(OTP_DISPATCH_MAX_ATTEMPTS=3)
+    def test_failed_sends_are_retried_until_max_attempts(self):
+        dispatch=self.queue()
+        with mock.patch("users.sms.backends.locmem.SMSBackend.send_messages",side_effect=ConnectionError("down")):
+            for attempt in range(1,4):
+                self.assertEqual(drain_otp_outbox(),0)
+                dispatch.refresh_from_db()
+                self.assertEqual(dispatch.attempts,attempt)
+                self.assertEqual(dispatch.status,OTPDispatch.PENDING if attempt<3 else OTPDispatch.FAILED)
+        self.assertEqual(dispatch.last_error,"down")
+
+        self.assertEqual(drain_otp_outbox(),0)
+        dispatch.refresh_from_db()
+        self.assertEqual(dispatch.attempts,3)
+
+    def test_claims_do_not_overlap(self):
+        dispatches=[self.queue() for _ in range(3)]
+        first=claim_dispatches(2)
+        second=claim_dispatches(2)
+        self.assertEqual([d.pk for d in first],[d.pk for d in dispatches[:2]])
+        self.assertEqual([d.pk for d in second],[dispatches[2].pk])
+        self.assertEqual({d.status for d in first+second},{OTPDispatch.SENDING})
+        self.assertEqual(claim_dispatches(2),[])
+
+    @override_settings(OTP_DISPATCH_LEASE_SECONDS=60)
+    def test_expired_leases_are_released(self):
+        stuck=self.queue(status=OTPDispatch.SENDING)
+        sending=self.queue(status=OTPDispatch.SENDING)
+        OTPDispatch.objects.filter(pk=stuck.pk).update(updated_at=timezone.now()-datetime.timedelta(seconds=61))
+
+        self.assertEqual(drain_otp_outbox(),1)
+        self.assertEqual(OTPDispatch.objects.get(pk=stuck.pk).status,OTPDispatch.SENT)
+        self.assertEqual(OTPDispatch.objects.get(pk=sending.pk).status,OTPDispatch.SENDING)
+        self.assertEqual(release_expired_leases(),0)
+
+    def test_interrupted_email_batch(self):
+        dispatches=[self.queue(OTPDispatch.EMAIL) for _ in range(3)]
+        error=BatchInterrupted(1,smtplib.SMTPServerDisconnected("gone"))
+        with mock.patch("users.tasks.send_otp_emails",side_effect=error):
+            self.assertEqual(deliver_dispatches(claim_dispatches(10)),1)
+
+        statuses=dict(OTPDispatch.objects.values_list("pk","status"))
+        self.assertEqual([statuses[d.pk] for d in dispatches],[OTPDispatch.SENT,OTPDispatch.PENDING,OTPDispatch.PENDING])
+
+
+@skipUnlessDBFeature("has_select_for_update_skip_locked")
+class OTPOutboxLockingTest(TransactionTestCase):
+    def test_rows_locked_by_another_worker_are_skipped(self):
+        user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+        otp=OTP.objects.create(user=user,security_code="123456",sent=timezone.now())
+        locked,other=[
+            OTPDispatch.objects.create(otp=otp,channel=OTPDispatch.SMS,recipient="+251911223344",body="{security_code}")
+            for _ in range(2)
+        ]
+        holding,release=threading.Event(),threading.Event()
+
+        def worker():
+            try:
+                with transaction.atomic():
+                    list(OTPDispatch.objects.select_for_update().filter(pk=locked.pk))
+                    holding.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        thread=threading.Thread(target=worker)
+        thread.start()
+        holding.wait(5)
+        try:
+            claimed=claim_dispatches(10)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual([dispatch.pk for dispatch in claimed],[other.pk])
+
+
+class PersistentMailerTest(SimpleTestCase):
+    def connection(self,*results):
+        connection=mock.Mock()
+        connection.send_messages.side_effect=list(results)
+        return connection
+
+    def test_connection_is_reused(self):
+        connection=self.connection(1,1,1)
+        mailer=PersistentMailer()
+        with mock.patch("users.mail.get_connection",return_value=connection) as get_connection:
+            self.assertEqual(mailer.send_messages(["a","b"]),2)
+            self.assertEqual(mailer.send_messages(["c"]),1)
+        get_connection.assert_called_once()
+        connection.open.assert_called_once()
+
+    def test_resumes_after_reconnect(self):
+        dropped=self.connection(1,smtplib.SMTPServerDisconnected("gone"))
+        fresh=self.connection(1,1)
+        mailer=PersistentMailer()
+        with mock.patch("users.mail.get_connection",side_effect=[dropped,fresh]):
+            self.assertEqual(mailer.send_messages(["a","b","c"]),3)
+
+        self.assertEqual([c.args[0] for c in dropped.send_messages.call_args_list],[["a"],["b"]])
+        self.assertEqual([c.args[0] for c in fresh.send_messages.call_args_list],[["b"],["c"]])
+        dropped.close.assert_called_once()
+
+    def test_gives_up_after_second_drop(self):
+        mailer=PersistentMailer()
+        connections=[
+            self.connection(1,smtplib.SMTPServerDisconnected("gone")),
+            self.connection(smtplib.SMTPServerDisconnected("gone again")),
+        ]
+        with mock.patch("users.mail.get_connection",side_effect=connections):
+            with self.assertRaises(BatchInterrupted) as raised:
+                mailer.send_messages(["a","b"])
+        self.assertEqual(raised.exception.sent,1)
+
+    def test_other_errors_report_progress(self):
+        mailer=PersistentMailer()
+        with mock.patch("users.mail.get_connection",return_value=self.connection(1,1,smtplib.SMTPRecipientsRefused({}))):
+            with self.assertRaises(BatchInterrupted) as raised:
+                mailer.send_messages(["a","b","c"])
+        self.assertEqual(raised.exception.sent,2)
+
+
+class SMSBackendTest(SimpleTestCase):
+    def setUp(self):
+        twilio.reset_client()
+        self.addCleanup(twilio.reset_client)
+
+    def test_twilio_client_is_reused(self):
+        with mock.patch("users.sms.backends.twilio.Client") as client:
+            connection=sms.get_connection("users.sms.backends.twilio.SMSBackend")
+            self.assertEqual(sms.send_mass_sms([("a","+251911223344",None),("b","+251911223355",None)],connection=connection),2)
+            sms.send_sms("c","+251911223344",connection=sms.get_connection("users.sms.backends.twilio.SMSBackend"))
+            self.assertEqual(client.call_count,1)
+            self.assertEqual(client.return_value.messages.create.call_count,3)
+
+            # a forked worker or new credentials get a client of their own
+            worker_process_init.send(sender=None)
+            twilio.get_client()
+            with override_settings(TWILIO_AUTH_TOKEN="rotated"):
+                twilio.get_client()
+            self.assertEqual(client.call_count,3)
+            self.assertEqual(client.call_args.args,(settings.TWILIO_ACCOUNT_SID,"rotated"))
+
+    def test_locmem_outbox(self):
+        sms.outbox=[]
+        connection=sms.get_connection("users.sms.backends.locmem.SMSBackend")
+        self.assertEqual(sms.send_mass_sms([("a","+251911223344",None),("b","+251911223355","+15005550000")],connection=connection),2)
+        self.assertEqual([(m.body,m.to,m.from_) for m in sms.outbox],[
+            ("a","+251911223344",settings.TWILIO_PHONE_NUMBER),
+            ("b","+251911223355","+15005550000"),
+        ])
+
+    def test_filebased_output(self):
+        directory=tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connection=sms.get_connection("users.sms.backends.filebased.SMSBackend",file_path=directory.name)
+        sms.send_sms("first","+251911223344",connection=connection)
+        sms.send_sms("second","+251911223355",connection=connection)
+
+        files=os.listdir(directory.name)
+        self.assertEqual(len(files),1)
+        with open(os.path.join(directory.name,files[0])) as f:
+            messages=f.read().split("-"*79+"\n")
+        self.assertEqual(messages,[
+            f"From: {settings.TWILIO_PHONE_NUMBER}\nTo: +251911223344\n\nfirst\n",
+            f"From: {settings.TWILIO_PHONE_NUMBER}\nTo: +251911223355\n\nsecond\n",
+            "",
+        ])
+
+
+class ProfileSignalTest(APITestCase):
+    def setUp(self):
+        self.user=User.objects.create(username="jane@example.com",email="jane@example.com")
+
+    def test_profile_created_with_user(self):
+        self.assertEqual(self.user.profile.bio,"")
+
+    def test_user_save_skips_unchanged_profile(self):
+        user=User.objects.select_related("profile").get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            user.save()
+
+    def test_user_save_persists_profile_changes(self):
+        user=User.objects.select_related("profile").get(pk=self.user.pk)
+        user.profile.bio="Hello"
+        user.save()
+        self.assertEqual(Profile.objects.get(user=user).bio,"Hello")
+
+
+class IdentifierAuthBackendTest(APITestCase):
+    password="Xk2!pQ9#rT"
+
+    def setUp(self):
+        for username,email,phone_number in (
+            ("jane@example.com","jane@example.com",None),
+            ("+251911223344",None,"+251911223344"),
+        ):
+            user=User(username=username,email=email,phone_number=phone_number)
+            user.set_password(self.password)
+            user.save()
+            OTP.objects.create(user=user,is_verified=True)
+
+    def test_login_with_email_or_phone_number_is_one_query(self):
+        for identifier in ("jane@example.com","0911223344","+251911223344"):
+            with self.assertNumQueries(1):
+                user=authenticate(username=identifier,password=self.password)
+                self.assertTrue(user.phone.is_verified)
+
+    def test_failed_login_is_at_most_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(authenticate(username="jane@example.com",password="wrong"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(authenticate(username="nobody@example.com",password=self.password))
+        with self.assertNumQueries(0):
+            self.assertIsNone(authenticate(username="not-a-number",password=self.password))
+
+    @override_settings(PASSWORD_PBKDF2_ITERATIONS=1000)
+    def test_benchmark_compares_with_the_legacy_backends(self):
+        out=StringIO()
+        call_command("bench_login_queries",repeat=1,stdout=out)
+        queries={(line[25:37].strip(),line[:24].strip()):int(line[37:45]) for line in out.getvalue().splitlines()[1:]}
+
+        self.assertEqual(queries["legacy","phone, right password"],2)
+        self.assertEqual(queries["identifier","phone, right password"],1)
+        self.assertEqual(queries["legacy","unknown phone"],2)
+        self.assertEqual(queries["identifier","unknown phone"],1)
+
+
+class PhoneNumberNormalizationTest(APITestCase):
+    def setUp(self):
+        phone._parse.cache_clear()
+        phone._to_e164.cache_clear()
+
+    def test_numbers_are_parsed_once(self):
+        with mock.patch("users.phone.PhoneNumber.from_string",wraps=PhoneNumber.from_string) as from_string:
+            for value in ("0911223344","0911223344"," 0911223344 "):
+                self.assertEqual(phone.to_e164(value),"+251911223344")
+            self.assertIs(phone.parse_phone_number("0911223344"),phone.parse_phone_number("0911223344"))
+        self.assertEqual(from_string.call_count,1)
+
+    def test_invalid_numbers(self):
+        for value in ("12345","not-a-number",""):
+            self.assertIsNone(phone.to_e164(value))
+
+    def test_identifier_uses_stored_e164(self):
+        User.objects.create(username="+251911223344",phone_number="0911223344")
+        user=User.objects.get()
+        phone.to_e164("+251911223344")
+        with mock.patch("users.phone.PhoneNumber.from_string") as from_string:
+            self.assertEqual(str(user),"+251911223344")
+        from_string.assert_not_called()
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=1000,CACHES=LOCMEM_CACHES)
+class AsyncUserLoginTest(APITestCase):
+    url=reverse("users:user_login_async")
+    password="Xk2!pQ9#rT"
+
+    def setUp(self):
+        cache.clear()
+        self.user=User(username="jane@example.com",email="jane@example.com")
+        self.user.set_password(self.password)
+        self.user.save()
+        OTP.objects.create(user=self.user,is_verified=True)
+
+    def login(self,password):
+        return self.client.post(self.url,{"email":"jane@example.com","password":password},format="json")
+
+    def test_login_returns_tokens(self):
+        response=self.login(self.password)
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertEqual(response.json()["user"]["id"],self.user.pk)
+        self.assertIn("access_token",response.json())
+
+    def test_wrong_password(self):
+        self.assertEqual(self.login("wrong").status_code,status.HTTP_400_BAD_REQUEST)
+
+    def test_rehashes_when_cost_changes(self):
+        with override_settings(PASSWORD_PBKDF2_ITERATIONS=2000):
+            self.login(self.password)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$2000$"))
+
+    def test_non_object_body_is_rejected(self):
+        for body in ("[]",'"x"',"1"):
+            response=self.client.post(self.url,body,content_type="application/json")
+            self.assertEqual(response.status_code,status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(PASSWORD_HASH_EXECUTOR="process",PASSWORD_HASH_WORKERS=1)
+    def test_process_pool_hashes_are_recorded(self):
+        labels={"algorithm":"pbkdf2_sha256"}
+        before=REGISTRY.get_sample_value("etrade_password_hash_duration_seconds_count",labels) or 0
+        self.assertEqual(self.login(self.password).status_code,status.HTTP_200_OK)
+        self.assertEqual(REGISTRY.get_sample_value("etrade_password_hash_duration_seconds_count",labels),before+1)
+
+    @override_settings(PASSWORD_HASH_WORKERS=1,PASSWORD_HASH_QUEUE_SIZE=0)
+    def test_full_hashing_queue_returns_503(self):
+        with mock.patch("users.hashing._pending",1):
+            response=self.login(self.password)
+        self.assertEqual(response.status_code,status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"],"1")
+
+
+@override_settings(CACHES=LOCMEM_CACHES,SMS_BACKEND="users.sms.backends.locmem.SMSBackend")
+class AsyncOTPViewTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        sms.outbox=[]
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+
+    def test_send_delivers_without_a_task(self):
+        with mock.patch("users.tasks.deliver_otp_dispatch.delay") as delay:
+            response=self.client.post(reverse("users:send_resend_sms_async"),{"phone_number":"+251911223344"},format="json")
+
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        delay.assert_not_called()
+        self.assertEqual(len(sms.outbox),1)
+        self.assertEqual(OTPDispatch.objects.get().status,OTPDispatch.SENT)
+
+    def test_verify(self):
+        self.client.post(reverse("users:send_resend_sms_async"),{"phone_number":"+251911223344"},format="json")
+        code=sms.outbox[0].body[-6:]
+
+        url=reverse("users:verify_phone_number_async")
+        response=self.client.post(url,{"phone_number":"+251911223344","otp":code},format="json")
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertTrue(OTP.objects.get().is_verified)
+
+    @override_settings(OTP_STORE="users.otp_store.HMACOTPStore")
+    def test_store_without_outbox(self):
+        self.client.post(reverse("users:send_resend_sms_async"),{"phone_number":"+251911223344"},format="json")
+        self.assertEqual(len(sms.outbox),1)
+        self.assertFalse(OTPDispatch.objects.exists())
+
+        url=reverse("users:verify_phone_number_async")
+        response=self.client.post(url,{"phone_number":"+251911223344","otp":sms.outbox[0].body[-6:]},format="json")
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+
+    def test_unknown_number_and_throttling(self):
+        url=reverse("users:send_resend_sms_async")
+        for _ in range(5):
+            response=self.client.post(url,{"phone_number":"+251911223355"},format="json")
+            self.assertEqual(response.status_code,status.HTTP_404_NOT_FOUND)
+
+        response=self.client.post(url,{"phone_number":"+251911223355"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreater(int(response["Retry-After"]),0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES,PASSWORD_PBKDF2_ITERATIONS=1000)
+class RateLimitTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_otp_send_is_limited_per_phone_number(self):
+        url=reverse("users:send_resend_sms")
+        for _ in range(5):
+            response=self.client.post(url,{"phone_number":"+251911223344"},format="json")
+            self.assertEqual(response.status_code,status.HTTP_404_NOT_FOUND)
+
+        response=self.client.post(url,{"phone_number":"+251911223344"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreater(int(response["Retry-After"]),0)
+
+        response=self.client.post(url,{"phone_number":"+251911223355"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_404_NOT_FOUND)
+
+    def test_spellings_of_one_identifier_share_a_limit(self):
+        url=reverse("users:send_resend_sms")
+        for number in ("+251911223344","+251 91 122 3344","0911223344","+251-911-223344","+251911223344"):
+            self.client.post(url,{"phone_number":number},format="json")
+        response=self.client.post(url,{"phone_number":" +251 911 223 344 "},format="json")
+        self.assertEqual(response.status_code,status.HTTP_429_TOO_MANY_REQUESTS)
+
+        self.assertEqual(
+            IdentifierRateThrottle.normalize(" Jane@Example.COM "),
+            IdentifierRateThrottle.normalize("jane@example.com"),
+        )
+
+    def test_non_object_bodies_are_rejected(self):
+        for name in ("user_login","send_resend_sms","send_resend_email","verify_phone_number","verify_otp"):
+            for body in ("[]",'["+251911223344"]','"x"'):
+                with self.subTest(name,body=body):
+                    response=self.client.post(reverse(f"users:{name}"),body,content_type="application/json")
+                    self.assertEqual(response.status_code,status.HTTP_400_BAD_REQUEST)
+
+    def test_forwarded_for_is_not_trusted_without_proxies(self):
+        url=reverse("users:user_login")
+        for i in range(60):
+            self.client.post(url,{"email":f"user{i}@example.com","password":"wrong"},format="json",HTTP_X_FORWARDED_FOR=f"10.0.0.{i}")
+
+        response=self.client.post(url,{"email":"other@example.com","password":"wrong"},format="json",HTTP_X_FORWARDED_FOR="10.0.1.1")
+        self.assertEqual(response.status_code,status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_login_is_limited_per_ip(self):
+        url=reverse("users:user_login")
+        for i in range(60):
+            self.client.post(url,{"email":f"user{i}@example.com","password":"wrong"},format="json")
+
+        response=self.client.post(url,{"email":"other@example.com","password":"wrong"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_429_TOO_MANY_REQUESTS)
+
+
+@override_settings(CACHES=LOCMEM_CACHES,OTP_STORE="users.otp_store.CacheOTPStore",OTP_MAX_ATTEMPTS=3)
+class CacheOTPStoreTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+
+    def issue(self,code="123456"):
+        with mock.patch.object(OTP,"generate_security_code",return_value=code):
+            otp=issue_otp(self.user,OTPDispatch.SMS)
+        return otp,code
+
+    def test_codes_are_not_written_to_the_otp_row(self):
+        otp,_=self.issue("111111")
+        otp,code=self.issue("222222")
+
+        self.assertEqual(OTP.objects.get().security_code,"")
+        otp.check_verification(code)
+        self.assertTrue(OTP.objects.get().is_verified)
+
+    def test_code_is_consumed(self):
+        otp,code=self.issue()
+        otp.check_verification(code,is_otp_for_password=True)
+        with self.assertRaises(NotAcceptable):
+            otp.check_verification(code,is_otp_for_password=True)
+
+    def test_code_is_dropped_after_max_attempts(self):
+        otp,code=self.issue()
+        wrong="".join(str((int(digit)+1)%10) for digit in code)
+        for _ in range(3):
+            with self.assertRaises(NotAcceptable):
+                otp.check_verification(wrong)
+        with self.assertRaises(NotAcceptable):
+            otp.check_verification(code)
+        self.assertFalse(OTP.objects.get().is_verified)
+
+    @override_settings(SMS_BACKEND="users.sms.backends.locmem.SMSBackend")
+    def test_code_is_sent_from_the_cache(self):
+        sms.outbox=[]
+        with mock.patch("users.tasks.send_derived_otp.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                otp,code=self.issue()
+        self.assertFalse(OTPDispatch.objects.exists())
+        self.assertNotIn(code,[str(arg) for arg in delay.call_args.args])
+
+        send_derived_otp(*delay.call_args.args)
+        self.assertEqual([message.body for message in sms.outbox],[f"Your activation code is {code}"])
+
+        # a code that was used before it was sent is not sent
+        with mock.patch("users.tasks.send_derived_otp.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                otp,code=self.issue("654321")
+        otp.check_verification(code)
+        with self.assertLogs("users.tasks","WARNING"):
+            self.assertEqual(send_derived_otp(*delay.call_args.args),0)
+        self.assertEqual(len(sms.outbox),1)
+
+    def test_resend_writes_only_sent(self):
+        self.issue()
+        with mock.patch("users.tasks.send_derived_otp.delay"),CaptureQueriesContext(connection) as queries:
+            response=self.client.post(reverse("users:send_resend_sms"),{"phone_number":"+251911223344"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+
+        writes=[query["sql"] for query in queries.captured_queries if not query["sql"].startswith("SELECT")]
+        self.assertEqual(len(writes),1)
+        self.assertTrue(writes[0].startswith('UPDATE "users_otp" SET'))
+        self.assertIn('"sent"',writes[0])
+
+    @override_settings(TOKEN_EXPIRE_MINUTES=0)
+    def test_expired_code(self):
+        otp,code=self.issue()
+        with self.assertRaises(NotAcceptable):
+            otp.check_verification(code)
+
+
+@override_settings(
+    OTP_STORE="users.otp_store.HMACOTPStore",
+    OTP_HMAC_STEP_SECONDS=60,
+    OTP_HMAC_DRIFT_STEPS=6,
+    SMS_BACKEND="users.sms.backends.locmem.SMSBackend",
+)
+class HMACOTPStoreTest(APITestCase):
+    def setUp(self):
+        sms.outbox=[]
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+
+    def issue(self,**kwargs):
+        otp=issue_otp(self.user,OTPDispatch.SMS,**kwargs)
+        return otp,otp.dispatch.text[-6:]
+
+    def test_codes_are_sent_without_the_outbox(self):
+        with mock.patch("users.tasks.send_derived_otp.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                otp,code=self.issue()
+        self.assertFalse(OTPDispatch.objects.exists())
+        # the worker derives the code again from the time step
+        self.assertNotIn(code,[str(arg) for arg in delay.call_args.args])
+
+        send_derived_otp(*delay.call_args.args)
+        self.assertEqual([message.body for message in sms.outbox],[f"Your activation code is {code}"])
+
+        with mock.patch("users.otp_store.time.time",return_value=time.time()+7*60),self.assertLogs("users.tasks","WARNING"):
+            self.assertEqual(send_derived_otp(*delay.call_args.args),0)
+        self.assertEqual(len(sms.outbox),1)
+
+    def test_code_is_recomputed_on_verify(self):
+        otp,code=self.issue()
+        self.assertEqual(OTP.objects.get().security_code,"")
+
+        with self.assertNumQueries(1):
+            otp.check_verification(code,channel=OTPDispatch.SMS)
+        self.assertTrue(OTP.objects.get().is_verified)
+
+    def test_code_is_bound_to_channel_and_purpose(self):
+        otp,code=self.issue()
+        for kwargs in ({"channel":OTPDispatch.EMAIL},{"channel":OTPDispatch.SMS,"is_otp_for_password":True}):
+            with self.assertRaises(NotAcceptable):
+                otp.check_verification(code,**kwargs)
+
+    @override_settings(CACHES=LOCMEM_CACHES,PURGE_CHUNK_PAUSE=0)
+    def test_resend_survives_the_purge(self):
+        otp,_=self.issue()
+        old=timezone.now()-datetime.timedelta(days=1)
+        OTP.objects.filter(pk=otp.pk).update(created_at=old,sent=old)
+
+        otp,code=self.issue()
+        self.assertEqual(purge_in_chunks("otps",expired_otps(),chunk_size=2),0)
+
+        response=self.client.post(
+            reverse("users:verify_phone_number"),
+            {"phone_number":"+251911223344","otp":code},
+            format="json",
+        )
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertTrue(OTP.objects.get().is_verified)
+
+    def test_drift_window(self):
+        with mock.patch("users.otp_store.time.time",return_value=6000):
+            otp,code=self.issue(is_otp_for_password=True)
+        with mock.patch("users.otp_store.time.time",return_value=6000+6*60):
+            otp.check_verification(code,is_otp_for_password=True,channel=OTPDispatch.SMS)
+        with mock.patch("users.otp_store.time.time",return_value=6000+7*60):
+            with self.assertRaises(NotAcceptable):
+                otp.check_verification(code,is_otp_for_password=True,channel=OTPDispatch.SMS)
+
+
+@override_settings(CACHES=LOCMEM_CACHES,PURGE_CHUNK_PAUSE=0)
+class PurgeStaleUsersTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        old=timezone.now()-datetime.timedelta(days=30)
+        self.users={}
+        for name,verified,last_login,date_joined in (
+            ("abandoned",False,None,old),
+            ("verified",True,None,old),
+            ("social",None,old,old),
+            ("recent",False,None,timezone.now()),
+        ):
+            user=User.objects.create(username=name,email=f"{name}@example.com",last_login=last_login,date_joined=date_joined)
+            if verified is not None:
+                OTP.objects.create(user=user,is_verified=verified,sent=old)
+            self.users[name]=user
+
+    def test_purge(self):
+        call_command("purge_stale_users",days=7,chunk_size=2,stdout=StringIO())
+
+        self.assertEqual(set(User.objects.values_list("username",flat=True)),{"verified","social","recent"})
+        self.assertEqual(list(OTP.objects.values_list("user__username",flat=True)),["verified"])
+        self.assertFalse(Profile.objects.filter(user_id=self.users["abandoned"].pk).exists())
+
+    def test_resumes_after_checkpoint(self):
+        cache.set("users:purge:users",self.users["abandoned"].pk)
+        purge_in_chunks("users",stale_accounts(7),chunk_size=2)
+        self.assertTrue(User.objects.filter(username="abandoned").exists())
+
+        purge_in_chunks("users",stale_accounts(7),chunk_size=2)
+        self.assertFalse(User.objects.filter(username="abandoned").exists())
+
+    def test_otps_without_sent(self):
+        old=timezone.now()-datetime.timedelta(days=1)
+        stale=OTP.objects.create(user=User.objects.create(username="stale"))
+        fresh=OTP.objects.create(user=User.objects.create(username="fresh"))
+        OTP.objects.filter(pk=stale.pk).update(created_at=old)
+
+        purge_in_chunks("otps",expired_otps(),chunk_size=2)
+        self.assertFalse(OTP.objects.filter(pk=stale.pk).exists())
+        self.assertTrue(OTP.objects.filter(pk=fresh.pk).exists())
+
+    def test_finished_dispatches(self):
+        otp=OTP.objects.get(user__username="verified")
+        old=timezone.now()-datetime.timedelta(days=2)
+        for status_ in (OTPDispatch.SENT,OTPDispatch.FAILED,OTPDispatch.PENDING,OTPDispatch.SENDING):
+            OTPDispatch.objects.create(otp=otp,channel=OTPDispatch.SMS,recipient="+251911223344",body="",status=status_)
+        recent=OTPDispatch.objects.create(otp=otp,channel=OTPDispatch.SMS,recipient="+251911223344",body="",status=OTPDispatch.SENT)
+        OTPDispatch.objects.exclude(pk=recent.pk).update(updated_at=old)
+
+        call_command("purge_stale_users",days=7,chunk_size=2,stdout=StringIO())
+
+        self.assertEqual(
+            set(OTPDispatch.objects.values_list("status",flat=True)),
+            {OTPDispatch.PENDING,OTPDispatch.SENDING,OTPDispatch.SENT},
+        )
+        self.assertTrue(OTPDispatch.objects.filter(pk=recent.pk).exists())
+
+    def test_verify_after_purge(self):
+        purge_in_chunks("otps",expired_otps(),chunk_size=2)
+        response=self.client.post(reverse("users:verify_otp"),{"email":"recent@example.com","otp":"123456"},format="json")
+        self.assertEqual(response.status_code,status.HTTP_406_NOT_ACCEPTABLE)
+
+
+class AuditQueryPlansTest(APITestCase):
+    def audit(self,**options):
+        out=StringIO()
+        call_command("audit_query_plans",stdout=out,**options)
+        return out.getvalue()
+
+    def test_seeded_queries_use_indexes(self):
+        output=self.audit(seed=300,batch_size=100)
+
+        self.assertIn("Every canonical query uses an index.",output)
+        for name in ("user by email","login lookup","expired unverified otps","pending otp dispatches"):
+            self.assertIn(f"ok    {name}",output)
+        self.assertNotIn("SCAN  ",output)
+        # the seed is rolled back
+        self.assertFalse(User.objects.exists())
+
+    def test_table_scan_fails(self):
+        scan=("user by first name",User.objects.filter(first_name="Jane"),None)
+        out,err=StringIO(),StringIO()
+        with mock.patch("users.management.commands.audit_query_plans.canonical_queries",return_value=[scan]):
+            with mock.patch("sys.stdout",out),mock.patch("sys.stderr",err),self.assertRaises(SystemExit) as exit:
+                audit_query_plans.Command().run_from_argv(["manage.py","audit_query_plans","--seed","10"])
+
+        self.assertEqual(exit.exception.code,1)
+        self.assertIn("SCAN  user by first name: users_user",out.getvalue())
+        self.assertIn("1 query fell back to a table scan: user by first name",err.getvalue())
+
+    def test_needs_a_user_to_query_for(self):
+        with self.assertRaisesMessage(CommandError,"pass --seed"):
+            self.audit()
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=1000)
+class ImportUsersTest(APITestCase):
+    password="Xk2!pQ9#rT"
+
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        User.objects.create(username="taken@example.com",email="taken@example.com")
+
+    def run_import(self,name,content,**options):
+        path=os.path.join(self.directory.name,name)
+        with open(path,"w") as f:
+            f.write(content)
+        call_command("import_users",path,workers=1,batch_size=2,stdout=StringIO(),**options)
+        with open(path+".rejects.jsonl") as f:
+            return [json.loads(line) for line in f]
+
+    def test_import_csv(self):
+        rejects=self.run_import(
+            "users.csv",
+            "email,phone_number,first_name,password,bio\n"
+            f"jane@example.com,0911223344,Jane,{self.password},Hi\n"
+            ",+251911223355,John,,\n"
+            "taken@example.com,,Taken,,\n"
+            "not-an-email,,Bad,,\n"
+            ",0911223344,Again,,\n",
+        )
+
+        self.assertEqual(sorted(reject["line"] for reject in rejects),[4,5,6])
+        self.assertNotIn("password",rejects[0]["row"])
+
+        user=authenticate(username="jane@example.com",password=self.password)
+        self.assertEqual(str(user.phone_number),"+251911223344")
+        self.assertEqual(user.username,"+251911223344")
+        self.assertEqual(user.profile.bio,"Hi")
+        self.assertTrue(user.phone.is_verified)
+        self.assertFalse(User.objects.get(username="+251911223355").has_usable_password())
+
+    def test_import_jsonl(self):
+        rejects=self.run_import(
+            "users.jsonl",
+            '{"email":"jane@example.com"}\n'
+            "not json\n"
+            '{"phone_number":251911223355}\n',
+            verified=False,
+        )
+
+        self.assertEqual([reject["line"] for reject in rejects],[2])
+        self.assertEqual(Profile.objects.filter(user__username__in=["jane@example.com","+251911223355"]).count(),2)
+        self.assertFalse(OTP.objects.exists())
+
+
+    @override_settings(CACHES=LOCMEM_CACHES,PURGE_CHUNK_PAUSE=0)
+    def test_imported_accounts_survive_the_purge(self):
+        self.run_import("users.csv","email,phone_number\njane@example.com,\n,0911223355\n")
+        User.objects.update(date_joined=timezone.now()-datetime.timedelta(days=30))
+
+        call_command("purge_stale_users",days=7,chunk_size=2,stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__in=["jane@example.com","+251911223355"]).count(),2)
+
+
+class UserExportTest(APITestCase):
+    url=reverse("users:user_export")
+
+    def setUp(self):
+        self.staff=User.objects.create(username="staff@example.com",email="staff@example.com",is_staff=True)
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+        for city in ("Addis Ababa","Adama"):
+            Address.objects.create(
+                user=self.user,
+                address_type=Address.SHIPPING,
+                country="ET",
+                city=city,
+                street_address="Bole Road",
+                apartment_address="12",
+            )
+
+    def test_ndjson(self):
+        self.client.force_authenticate(self.staff)
+        response=self.client.get(self.url)
+
+        records=[json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([record["username"] for record in records],["staff@example.com","+251911223344"])
+        self.assertEqual(records[1]["phone_number"],"+251911223344")
+        self.assertEqual([address["city"] for address in records[1]["addresses"]],["Addis Ababa","Adama"])
+        self.assertEqual(records[0]["addresses"],[])
+
+    def test_gzipped_csv(self):
+        self.client.force_authenticate(self.staff)
+        response=self.client.get(self.url,{"file_format":"csv","gzip":"1"})
+
+        rows=list(csv.DictReader(gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()))
+        self.assertEqual([row["address_city"] for row in rows],["","Addis Ababa","Adama"])
+
+    def test_staff_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(self.url).status_code,status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserResponseCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username="jane@example.com",email="jane@example.com")
+        self.client.force_authenticate(self.user)
+
+    def create_address(self,city):
+        return Address.objects.create(
+            user=self.user,
+            address_type=Address.SHIPPING,
+            country="ET",
+            city=city,
+            street_address="Bole Road",
+            apartment_address="12",
+        )
+
+    def test_repeated_get_is_served_from_cache(self):
+        url=reverse("users:user_detail")
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response=self.client.get(url)
+        self.assertEqual(response.data["email"],"jane@example.com")
+
+    def test_address_change_invalidates_cached_responses(self):
+        url=reverse("users:address-list")
+        self.create_address("Addis Ababa")
+        self.assertEqual(len(self.client.get(url).data["results"]),1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_address("Adama")
+        self.assertEqual(len(self.client.get(url).data["results"]),2)
+
+    def test_responses_are_not_shared_between_users(self):
+        url=reverse("users:user_detail")
+        self.client.get(url)
+
+        other=User.objects.create(username="john@example.com",email="john@example.com")
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(url).data["email"],"john@example.com")
+
+
+@override_settings(CACHES=LOCMEM_CACHES,USER_RESPONSE_CACHE_SECONDS=0)
+class CachedUserResolutionTest(APITestCase):
+    url=reverse("users:user_detail")
+
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username="+251911223344",phone_number="+251911223344")
+        token=RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_authenticated_reads_skip_the_user_query(self):
+        self.client.get(self.url)
+        # the user detail itself is one query for the user and one for addresses
+        with self.assertNumQueries(2):
+            response=self.client.get(self.url)
+        self.assertEqual(response.data["phone_number"],"+251911223344")
+
+    def test_deactivation_takes_effect_immediately(self):
+        self.client.get(self.url)
+        self.user.is_active=False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code,status.HTTP_401_UNAUTHORIZED)
+
+    def test_snapshot_is_invalidated_when_the_change_commits(self):
+        def deactivate(user):
+            user.is_active=False
+
+        def change_password(user):
+            user.set_password("Xk2!pQ9#rT")
+
+        for change,changed in (
+            (change_password,lambda user:user.get_session_auth_hash()!=session_hash),
+            (deactivate,lambda user:not user.is_active),
+        ):
+            session_hash=get_cached_user(self.user.pk).get_session_auth_hash()
+            with self.captureOnCommitCallbacks() as callbacks:
+                change(self.user)
+                self.user.save()
+            # until the commit other requests may still read the old row, the snapshot stays
+            with self.assertNumQueries(0):
+                self.assertFalse(changed(get_cached_user(self.user.pk)))
+
+            for callback in callbacks:
+                callback()
+            self.assertTrue(changed(get_cached_user(self.user.pk)))
+
+    def test_logout_drops_the_snapshot(self):
+        get_cached_user(self.user.pk)
+        user_logged_out.send(sender=User,request=None,user=self.user)
+        with self.assertNumQueries(1):
+            get_cached_user(self.user.pk)
+
+    def test_session_user(self):
+        self.user.set_password("Xk2!pQ9#rT")
+        self.user.save()
+        session_hash=self.user.get_session_auth_hash()
+        backend=IdentifierAuthBackend()
+        backend.get_user(self.user.pk)
+
+        with self.assertNumQueries(0):
+            user=backend.get_user(self.user.pk)
+            self.assertEqual(user.get_session_auth_hash(),session_hash)
+
+
+@override_settings(USER_RESPONSE_CACHE_SECONDS=0)
+class UserQueryCountTest(APITestCase):
+    """
+    Rendering the user and their addresses costs the same number of
+    queries whatever the number of addresses
+    """
+
+    def create_user(self,addresses):
+        user=User.objects.create(
+            username=f"user{addresses}@example.com",
+            email=f"user{addresses}@example.com",
+            first_name="Jane",
+            last_name="Doe",
+        )
+        Address.objects.bulk_create(
+            Address(
+                user=user,
+                address_type=Address.BILLING,
+                country="ET",
+                city="Addis Ababa",
+                street_address=f"Street {i}",
+                apartment_address="1",
+            )
+            for i in range(addresses)
+        )
+        self.client.force_authenticate(user)
+        return user
+
+    def test_user_detail_query_count(self):
+        for addresses in (0,10,1000):
+            with self.subTest(addresses=addresses):
+                self.create_user(addresses)
+                with self.assertNumQueries(2):
+                    response=self.client.get(reverse("users:user_detail"))
+                self.assertEqual(len(response.data["addresses"]),addresses)
+
+    def test_address_list_query_count(self):
+        for addresses in (0,10,1000):
+            with self.subTest(addresses=addresses):
+                self.create_user(addresses)
+                with self.assertNumQueries(1):
+                    response=self.client.get(reverse("users:address-list"))
+                self.assertEqual(len(response.data["results"]),min(addresses,20))
+                if addresses:
+                    self.assertEqual(response.data["results"][0]["user"],"Jane Doe")
+
+    def test_address_pages_cover_every_address_once(self):
+        # bulk_create gives every row the same created_at, the cursor must still move forward
+        user=self.create_user(45)
+        expected=list(user.addresses.order_by("-created_at","id").values_list("id",flat=True))
+
+        seen=[]
+        url=reverse("users:address-list")
+        while url:
+            with self.assertNumQueries(1):
+                response=self.client.get(url)
+            seen.extend(address["id"] for address in response.data["results"])
+            url=response.data["next"]
+        self.assertEqual(seen,expected)
+
+        response=self.client.get(response.data["previous"])
+        self.assertEqual([address["id"] for address in response.data["results"]],expected[20:40])
+
+
+@override_settings(CACHES=LOCMEM_CACHES,PASSWORD_PBKDF2_ITERATIONS=1000)
+class MetricsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def sample(self,name,**labels):
+        return REGISTRY.get_sample_value(name,labels) or 0
+
+    def test_requests_are_recorded_per_url_name(self):
+        before=self.sample("etrade_request_duration_seconds_count",view="users:send_resend_sms",method="POST",status="404")
+        queries=self.sample("etrade_request_db_queries_count",view="users:send_resend_sms")
+
+        self.client.post(reverse("users:send_resend_sms"),{"phone_number":"+251911223344"},format="json")
+
+        self.assertEqual(self.sample("etrade_request_duration_seconds_count",view="users:send_resend_sms",method="POST",status="404"),before+1)
+        self.assertEqual(self.sample("etrade_request_db_queries_count",view="users:send_resend_sms"),queries+1)
+        self.assertGreater(self.sample("etrade_request_db_queries_sum",view="users:send_resend_sms"),0)
+
+    def test_unknown_methods_share_a_label(self):
+        url=reverse("users:user_detail")
+        before=self.sample("etrade_request_duration_seconds_count",view="users:user_detail",method="other",status="401")
+        for method in ("X0ZZ","X1ZZ"):
+            self.client.generic(method,url)
+
+        self.assertEqual(self.sample("etrade_request_duration_seconds_count",view="users:user_detail",method="other",status="401"),before+2)
+        self.assertIsNone(REGISTRY.get_sample_value("etrade_request_duration_seconds_count",{"view":"users:user_detail","method":"X0ZZ","status":"401"}))
+
+    def test_hashing_and_scrape(self):
+        before=self.sample("etrade_password_hash_duration_seconds_count",algorithm="pbkdf2_sha256")
+        User().set_password("Xk2!pQ9#rT")
+        self.assertEqual(self.sample("etrade_password_hash_duration_seconds_count",algorithm="pbkdf2_sha256"),before+1)
+
+        response=self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertIn(b"etrade_password_hash_duration_seconds_bucket",response.content)
+
+    @override_settings(METRICS_ALLOWED_IPS=["10.0.0.5"],METRICS_TOKEN="s3cret")
+    def test_scrape_requires_an_allowed_address_or_the_token(self):
+        url=reverse("metrics")
+        self.assertEqual(self.client.get(url).status_code,status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get(url,HTTP_AUTHORIZATION="Bearer wrong").status_code,status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get(url,HTTP_AUTHORIZATION="Bearer s3cret").status_code,status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url,REMOTE_ADDR="10.0.0.5").status_code,status.HTTP_200_OK)
+
+    @override_settings(METRICS_ALLOWED_IPS=[],METRICS_TOKEN="")
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get(reverse("metrics"),HTTP_AUTHORIZATION="Bearer ").status_code,status.HTTP_403_FORBIDDEN)
+
+    def test_middlewares_follow_the_mode_of_the_chain(self):
+        async def get_response(request):
+            pass
+
+        for middleware in (MetricsMiddleware,SQLProfilingMiddleware):
+            self.assertTrue(middleware.sync_capable and middleware.async_capable)
+            with override_settings(SQL_PROFILE_SAMPLE_RATE=1.0):
+                self.assertTrue(asyncio.iscoroutinefunction(middleware(get_response)))
+                self.assertFalse(asyncio.iscoroutinefunction(middleware(lambda request:None)))
+
+    def test_worker_exporter(self):
+        with mock.patch("users.metrics.start_http_server") as start:
+            worker_init.send(sender=None)
+            start.assert_not_called()
+            with override_settings(CELERY_METRICS_PORT=9808):
+                worker_init.send(sender=None)
+        start.assert_called_once_with(9808,registry=REGISTRY)
+
+    async def test_async_views_are_recorded(self):
+        labels={"view":"users:user_login_async","method":"POST","status":"400"}
+        before=self.sample("etrade_request_duration_seconds_count",**labels)
+        queries=self.sample("etrade_request_db_queries_sum",view="users:user_login_async")
+
+        response=await self.async_client.post(
+            reverse("users:user_login_async"),
+            {"email":"nobody@example.com","password":"Xk2!pQ9#rT"},
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code,status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.sample("etrade_request_duration_seconds_count",**labels),before+1)
+        self.assertGreater(self.sample("etrade_request_db_queries_sum",view="users:user_login_async"),queries)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    SMS_BACKEND=bench_otp_sms.LATENCY_BACKEND,
+    REST_FRAMEWORK={**settings.REST_FRAMEWORK,"DEFAULT_THROTTLE_RATES":{}},
+)
+class BenchOTPSMSTest(TransactionTestCase):
+    def setUp(self):
+        bench_otp_sms.seed(4)
+
+    def test_both_deployments_send_through_the_views(self):
+        with mock.patch.object(bench_otp_sms.LatencySMSBackend,"send_messages",return_value=1) as send:
+            results,_=bench_otp_sms.run_wsgi([bench_otp_sms.phone(0),bench_otp_sms.phone(1)],1)
+        self.assertEqual([status_ for _,status_ in results],[200,200])
+        self.assertEqual(send.call_count,2)
+
+        with mock.patch.object(bench_otp_sms.LatencySMSBackend,"asend_messages",return_value=1) as asend:
+            results,_=asyncio.run(bench_otp_sms.run_asgi([bench_otp_sms.phone(2),bench_otp_sms.phone(3)],2))
+        self.assertEqual([status_ for _,status_ in results],[200,200])
+        self.assertEqual(asend.call_count,2)
+        self.assertEqual(OTP.objects.count(),4)
+
+
+class BenchmarkBaselineTest(SimpleTestCase):
+    def results(self,p95=100.0,throughput=50.0,queries=13,errors=0):
+        stats={"count":10,"p50_ms":p95/2,"p95_ms":p95,"p99_ms":p95,"queries":queries}
+        return {"flows":{"returning":{
+            **stats,
+            "errors":errors,
+            "throughput":throughput,
+            "steps":{"login":dict(stats)},
+        }}}
+
+    def test_within_threshold(self):
+        self.assertEqual(compare(self.results(),self.results(p95=115.0,throughput=45.0),0.2),[])
+
+    def test_regressions(self):
+        regressions=compare(self.results(),self.results(p95=130.0,throughput=30.0,queries=14,errors=1),0.2)
+        self.assertEqual(len(regressions),6)
+        self.assertIn("returning.login: 14 queries, baseline 13",regressions)
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([float(i) for i in range(1,101)]),(50.5,95.05,99.01))
+
+
+@override_settings(CACHES=LOCMEM_CACHES,SQL_PROFILE_SAMPLE_RATE=1.0,SQL_PROFILE_HEADERS=True)
+class SQLProfilingTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username="jane@example.com",email="jane@example.com")
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql('SELECT "id" FROM "users_user" WHERE "id" IN (%s, %s, %s) ORDER BY "id" ASC LIMIT 1'),
+            'SELECT "id" FROM "users_user" WHERE "id" IN (...)',
+        )
+        self.assertEqual(normalize_sql("INSERT INTO t (a) VALUES (%s), (%s), (%s)"),"INSERT INTO t (a) VALUES (%s), ...")
+
+    def test_duplicates_are_reported_with_call_sites(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path=os.path.join(directory,"sql.jsonl")
+            with override_settings(SQL_PROFILE_LOG=path):
+                response=self.client.post(reverse("users:send_resend_email"),{"email":"jane@example.com"},format="json")
+            with open(path) as f:
+                record=json.loads(f.readline())
+
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertEqual(int(response["X-SQL-Queries"]),record["queries"])
+        self.assertGreaterEqual(int(response["X-SQL-Duplicates"]),1)
+
+        self.assertEqual(record["view"],"users:send_resend_email")
+        user_lookup=next(group for group in record["duplicates"] if 'FROM "users_user"' in group["sql"])
+        sites=[site for site,_ in user_lookup["call_sites"]]
+        self.assertTrue(any(site.startswith("users/serializers.py") for site in sites))
+        self.assertTrue(any(site.startswith("users/views.py") for site in sites))
+        self.assertLessEqual(len(record["slowest"]),5)
+        self.assertTrue(record["slowest"][0]["stack"])
+
+    async def test_async_requests_are_profiled(self):
+        response=await self.async_client.post(
+            reverse("users:user_login_async"),
+            {"email":"jane@example.com","password":"wrong"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code,status.HTTP_400_BAD_REQUEST)
+        self.assertGreater(int(response["X-SQL-Queries"]),0)
+
+    @override_settings(SQL_PROFILE_SAMPLE_RATE=0)
+    def test_off_by_default(self):
+        response=self.client.get(reverse("users:address-list"))
+        self.assertNotIn("X-SQL-Queries",response)
+
+
+def image_upload(name="photo.jpg",size=(1600,1200),format="JPEG",color=(200,40,40)):
+    buffer=BytesIO()
+    Image.new("RGB",size,color).save(buffer,format=format)
+    return SimpleUploadedFile(name,buffer.getvalue(),content_type=f"image/{format.lower()}")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AvatarPipelineTest(APITestCase):
+    url=reverse("users:profile_detail")
+
+    def setUp(self):
+        cache.clear()
+        media=tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override=override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user=User.objects.create(username="jane@example.com",email="jane@example.com")
+        self.client.force_authenticate(self.user)
+
+    def authenticate(self):
+        # a request loads its own user and profile, the task's writes are not on self.user
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+
+    def upload(self,**kwargs):
+        self.authenticate()
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.patch(self.url,{"avatar":image_upload(**kwargs)},format="multipart")
+
+    def test_variants_are_made_off_request(self):
+        with mock.patch("users.serializers.process_avatar.delay") as delay:
+            response=self.upload()
+        self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertNotIn("avatar",response.data)
+        self.assertIsNone(response.data["avatar_variants"])
+        delay.assert_called_once_with(self.user.profile.pk)
+
+    def test_variant_urls(self):
+        self.upload()
+        self.authenticate()
+        response=self.client.get(self.url)
+
+        variants=response.data["avatar_variants"]
+        self.assertEqual(set(variants),{"thumbnail","medium"})
+        self.assertTrue(variants["thumbnail"]["webp"].startswith("http://testserver/media/avatar/variants/"))
+
+        profile=Profile.objects.get(user=self.user)
+        with get_storage().open(profile.avatar_variants["thumbnail"]["jpeg"]) as f, Image.open(f) as image:
+            self.assertEqual((image.format,image.size),("JPEG",(96,96)))
+        with get_storage().open(profile.avatar_variants["medium"]["webp"]) as f, Image.open(f) as image:
+            self.assertEqual((image.format,image.size),("WEBP",(512,512)))
+
+    def test_files_of_replaced_avatars_are_collected(self):
+        self.upload()
+        old=Profile.objects.get(user=self.user)
+        self.upload(name="other.png",format="PNG",size=(300,600),color=(20,40,200))
+
+        profile=Profile.objects.get(user=self.user)
+        self.assertEqual(profile.avatar_variants["source"],profile.avatar.name)
+        self.assertEqual(collect_avatar_garbage(grace_seconds=3600),[])
+
+        deleted=collect_avatar_garbage(grace_seconds=0)
+        self.assertIn(old.avatar.name,deleted)
+        self.assertIn(old.avatar_variants["thumbnail"]["webp"],deleted)
+        self.assertFalse(get_storage().exists(old.avatar.name))
+        self.assertTrue(get_storage().exists(profile.avatar.name))
+        self.assertTrue(get_storage().exists(profile.avatar_variants["thumbnail"]["webp"]))
+
+    def test_identical_uploads_share_a_file(self):
+        self.upload()
+        other=User.objects.create(username="john@example.com",email="john@example.com")
+        self.client.force_authenticate(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(self.url,{"avatar":image_upload(name="copy.JPG")},format="multipart")
+
+        mine,theirs=Profile.objects.get(user=self.user),Profile.objects.get(user=other)
+        self.assertEqual(mine.avatar.name,theirs.avatar.name)
+        self.assertRegex(mine.avatar.name,r"^avatar/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        self.assertEqual(mine.avatar_variants,theirs.avatar_variants)
+
+        # replacing one of them must not take the file from the other
+        self.upload(name="other.png",format="PNG",size=(300,600),color=(20,40,200))
+        collect_avatar_garbage(grace_seconds=0)
+        self.assertTrue(get_storage().exists(theirs.avatar.name))
+        self.assertTrue(get_storage().exists(theirs.avatar_variants["medium"]["jpeg"]))
+
+    @override_settings(AVATAR_MAX_UPLOAD_SIZE=1024)
+    def test_upload_size_limit(self):
+        response=self.client.patch(self.url,{"avatar":image_upload()},format="multipart")
+        self.assertEqual(response.status_code,status.HTTP_400_BAD_REQUEST)
+
+
+class MediaServingTest(SimpleTestCase):
+    def setUp(self):
+        media=tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override=override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.content=bytes(range(256))*4
+        self.name=get_storage().save("avatar/photo.webp",ContentFile(self.content))
+        self.url=f"/media/{self.name}"
+
+    def test_hashed_names_are_immutable(self):
+        response=self.client.get(self.url)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(b"".join(response.streaming_content),self.content)
+        self.assertEqual(response["ETag"],f'"{hashlib.sha256(self.content).hexdigest()}"')
+        self.assertEqual(response["Cache-Control"],"public, max-age=31536000, immutable")
+        self.assertEqual(response["Content-Type"],"image/webp")
+        self.assertEqual(response["Accept-Ranges"],"bytes")
+
+        response=self.client.get(self.url,HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code,304)
+        self.assertEqual(response["Cache-Control"],"public, max-age=31536000, immutable")
+
+    def test_ranges(self):
+        response=self.client.get(self.url,HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code,206)
+        self.assertEqual(response["Content-Range"],"bytes 10-19/1024")
+        self.assertEqual(b"".join(response.streaming_content),self.content[10:20])
+
+        response=self.client.get(self.url,HTTP_RANGE="bytes=-4")
+        self.assertEqual(b"".join(response.streaming_content),self.content[-4:])
+
+        response=self.client.get(self.url,HTTP_RANGE="bytes=2000-")
+        self.assertEqual(response.status_code,416)
+        self.assertEqual(response["Content-Range"],"bytes */1024")
+
+        # a stale If-Range gets the whole file
+        response=self.client.get(self.url,HTTP_RANGE="bytes=10-19",HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code,200)
+
+    def test_empty_file_ranges(self):
+        name=get_storage().save("avatar/empty.webp",ContentFile(b""))
+        for header in ("bytes=-4","bytes=0-"):
+            response=self.client.get(f"/media/{name}",HTTP_RANGE=header)
+            self.assertEqual(response.status_code,416)
+            self.assertEqual(response["Content-Range"],"bytes */0")
+
+    def test_legacy_names_are_revalidated(self):
+        with open(os.path.join(settings.MEDIA_ROOT,"avatar","legacy.jpg"),"wb") as f:
+            f.write(b"legacy")
+        response=self.client.get("/media/avatar/legacy.jpg")
+        self.assertEqual(response["Cache-Control"],"no-cache")
+        self.assertTrue(response["ETag"].startswith("W/"))
+
+    def test_paths_outside_media_root(self):
+        self.assertEqual(self.client.get("/media/../settings.py").status_code,404)
+        self.assertEqual(self.client.get("/media/avatar/missing.jpg").status_code,404)
@@ -0,0 +1,139 @@
+import math
+from collections.abc import Mapping
+
+from django.contrib.auth.base_user import BaseUserManager
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from .phone import to_e164
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    Limit the rate of requests with a sliding window counter.
+
+    The window is approximated from the hit counters of the current and the
+    previous fixed window, so every key costs two integers in the cache no
+    matter how many requests it gets. Counters are bumped with atomic cache
+    increments, which Redis and locmem both provide, so concurrent workers
+    never lose hits.
+
+    The rate comes from DEFAULT_THROTTLE_RATES under the view's
+    ``throttle_scope`` followed by ``scope_suffix``. Views without a rate
+    for that scope are not throttled.
+    """
+
+    cache_format="throttle_%(scope)s_%(ident)s"
+    scope_suffix=""
+
+    def __init__(self):
+        # the rate depends on the view, it is resolved in allow_request
+        pass
+
+    def get_ident_for(self,request):
+        """Return the value requests are counted by, or None to skip throttling"""
+        raise NotImplementedError(".get_ident_for() must be overridden")
+
+    def allow_request(self,request,view):
+        scope=getattr(view,"throttle_scope",None)
+        if not scope:
+            return True
+        return self.allow(scope,self.get_ident_for(request))
+
+    def allow(self,scope,ident):
+        """Count a hit for ident under scope and return whether it is within the rate"""
+
+        self.scope=scope+self.scope_suffix
+        self.rate=api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if self.rate is None or not ident:
+            return True
+        self.num_requests,self.duration=self.parse_rate(self.rate)
+
+        self.key=self.cache_format%{"scope":self.scope,"ident":ident}
+        return self.hit()
+
+    def _incr(self,key):
+        timeout=self.duration*2
+        self.cache.add(key,0,timeout)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            self.cache.add(key,1,timeout)
+            return 1
+
+    def hit(self):
+        self.now=self.timer()
+        window,offset=divmod(self.now,self.duration)
+
+        self.current=self._incr(f"{self.key}_{int(window)}")
+        self.previous=self.cache.get(f"{self.key}_{int(window)-1}",0)
+        self.elapsed=offset/self.duration
+
+        return self.previous*(1-self.elapsed)+self.current<=self.num_requests
+
+    def wait(self):
+        """Return the seconds until the estimated rate falls back under the limit"""
+
+        if self.current>self.num_requests:
+            # over the limit inside this window alone, it has to roll over first
+            remaining=(1-self.elapsed)+(1-self.num_requests/self.current)
+        else:
+            remaining=(1-(self.num_requests-self.current)/self.previous)-self.elapsed
+        return max(1,math.ceil(remaining*self.duration))
+
+
+class IdentifierRateThrottle(SlidingWindowRateThrottle):
+    """
+    Count requests per submitted email address or phone number
+    """
+
+    fields=("email","phone_number")
+
+    @staticmethod
+    def normalize(value):
+        """Return the key value is counted under, the same for every spelling of an address or number"""
+
+        value=str(value).strip()
+        if "@" in value:
+            # normalized as the user model stores it, and lowercased whole as email lookups ignore case
+            return BaseUserManager.normalize_email(value).lower()
+        return to_e164(value) or "".join(value.split()).lower()
+
+    def get_ident_for(self,request):
+        if not isinstance(request.data,Mapping):
+            # a JSON array or scalar body, the IP throttle still counts it and the view rejects it
+            return None
+        for field in self.fields:
+            value=request.data.get(field)
+            if value:
+                return self.normalize(value)
+        return None
+
+
+class IPRateThrottle(SlidingWindowRateThrottle):
+    """
+    Count requests per client IP address, using the ``<scope>_ip`` rate
+
+    X-Forwarded-For is only trusted for the NUM_PROXIES hops in front of
+    the app, set in REST_FRAMEWORK.
+    """
+
+    scope_suffix="_ip"
+
+    def get_ident_for(self,request):
+        return self.get_ident(request)
+
+
+def check_throttles(request,scope,identifier):
+    """
+    Apply the identifier and IP throttles of scope to a view that does not
+    go through DRF. Return the seconds to wait, or None if the request is allowed.
+    """
+    ip_throttle=IPRateThrottle()
+    throttles=(
+        (IdentifierRateThrottle(),IdentifierRateThrottle.normalize(identifier) if identifier else None),
+        (ip_throttle,ip_throttle.get_ident(request)),
+    )
+    waits=[throttle.wait() for throttle,ident in throttles if not throttle.allow(scope,ident)]
+    return max(waits) if waits else None
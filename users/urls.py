@@ -4,12 +4,19 @@ from rest_framework.routers import DefaultRouter
 from .views import(
     AddressViewSet,
     ProfileAPIView,
+    SendOrResendEmailOTPView,
     SendOrResendSMSAPIView,
     UserAPIView,
+    UserExportAPIView,
     UserLoginAPIView,
     UserRegistrationAPIView,
     VerifyPhoneNumberAPIView,
-    VerifyEmailAPIView
+    VerifyEmailAPIView,
+    async_send_email_otp,
+    async_send_sms,
+    async_user_login,
+    async_verify_email,
+    async_verify_phone_number,
 )
 
 app_name="users"
@@ -22,8 +29,15 @@ urlpatterns = [
     path("verify-otp/",VerifyEmailAPIView.as_view(),name="verify_otp"),
     path("verify-phone/",VerifyPhoneNumberAPIView.as_view(),name="verify_phone_number"),
     path("login/",UserLoginAPIView.as_view(),name="user_login"),
+    path("login/async/",async_user_login,name="user_login_async"),
     path("send-sms/",SendOrResendSMSAPIView.as_view(), name="send_resend_sms"),
+    path("send-sms/async/",async_send_sms,name="send_resend_sms_async"),
+    path("send-email/",SendOrResendEmailOTPView.as_view(),name="send_resend_email"),
+    path("send-email/async/",async_send_email_otp,name="send_resend_email_async"),
+    path("verify-phone/async/",async_verify_phone_number,name="verify_phone_number_async"),
+    path("verify-otp/async/",async_verify_email,name="verify_otp_async"),
     path("",UserAPIView.as_view(),name="user_detail"),
+    path("export/",UserExportAPIView.as_view(),name="user_export"),
     path("profile/",ProfileAPIView.as_view(),name="profile_detail"),
     path("profile/address/",include(router.urls))
 
@@ -1,21 +1,51 @@
+import json
+import mimetypes
+import os
+import re
+
 from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
 from allauth.socialaccount.providers.oauth2.client import OAuth2Client
+from asgiref.sync import sync_to_async
+from dj_rest_auth.jwt_auth import set_jwt_cookies
 from dj_rest_auth.registration.views import RegisterView, SocialLoginView
+from dj_rest_auth.serializers import JWTSerializer
+from dj_rest_auth.utils import jwt_encode
 from dj_rest_auth.views import LoginView
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth import login as django_login
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.utils.translation import gettext as _
 from rest_framework import permissions, status
+from rest_framework.exceptions import APIException, Throttled
 from rest_framework.generics import (GenericAPIView, RetrieveAPIView,
                                      RetrieveUpdateAPIView)
+from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
-from users.models import Address, OTP, Profile,User
+from users.backends.identifier_backend import IdentifierAuthBackend
+from users.cache import cache_per_user
+from users.exceptions import AccountNotVerifiedException
+from users.export import FORMATS, export_users
+from users.hashing import HashQueueFull, amake_password, averify_password
+from users.metrics import render as render_metrics, scrape_allowed
+from users.models import Address, OTPDispatch, Profile,User
+from users.pagination import AddressCursorPagination
 from users.permissions import IsUserAddressOwner, IsUserProfileOwner
 from users.serializers import (AddressReadOnlySerializer,
                                PhoneNumberSerializer, ProfileSerializer,
                                UserLoginSerializer, UserRegistrationSerializer,
                                UserSerializer, VerifyPhoneNumberSerializer,EmailSerializer,VerifyEmailSerializer)
+from users.services import issue_otp
+from users.storage import content_digest
+from users.tasks import adeliver_derived,adeliver_pending
+from users.throttling import IdentifierRateThrottle, IPRateThrottle, check_throttles
 
 
 
@@ -27,36 +57,21 @@ class UserRegistrationAPIView(RegisterView):
     serializer_class=UserRegistrationSerializer
     
     
-    def send_message(self,request,message,*args,**kwargs):
-        res=SendOrResendSMSAPIView.as_view()(request._request,*args,**kwargs)
-
-        if res.status_code==200:
-            return {"detail":message}
-        
-
     def create(self,request,*args,**kwargs):
         serializer=self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        # self.perform_create(serializer)
-        serializer.save(request)
-        # serializer.save(request)
-
-        headers=self.get_success_headers(serializer.data)
 
-        response_data=""
+        with transaction.atomic():
+            user=serializer.save(request)
 
-        email=request.data.get("email",None)
-        phone_number=request.data.get("phone_number",None)
-
-        if phone_number:
-            response_data=self.send_message(request,message=_("Verification SMS sent."),*args,**kwargs)
-        else:
-            res=SendOrResendEmailOTPView.as_view()(request._request,*args,**kwargs)
-
-            if res.status_code==200:
+            if user.phone_number:
+                issue_otp(user,OTPDispatch.SMS,created=True)
+                response_data={"detail":_("Verification SMS sent.")}
+            else:
+                issue_otp(user,OTPDispatch.EMAIL,created=True)
                 response_data={"detail":_("Verification e-mail sent.")}
-                
-        
+
+        headers=self.get_success_headers(serializer.data)
         return Response(response_data,status=status.HTTP_201_CREATED,headers=headers)
 
 
@@ -66,8 +81,94 @@ class UserLoginAPIView(LoginView):
     Authenticate existing users using (phone number or email) and password
     """
     serializer_class=UserLoginSerializer
+    throttle_classes=(IdentifierRateThrottle,IPRateThrottle)
+    throttle_scope="login"
     
 
+identifier_backend=IdentifierAuthBackend()
+
+
+def _invalid_login(message):
+    return JsonResponse({"non_field_errors":[message]},status=status.HTTP_400_BAD_REQUEST)
+
+
+def _login_response(request,user,password_changed):
+    if password_changed:
+        user.save(update_fields=["password"])
+
+    access_token,refresh_token=jwt_encode(user)
+    if getattr(settings,"REST_SESSION_LOGIN",True):
+        django_login(request,user,backend="users.backends.identifier_backend.IdentifierAuthBackend")
+
+    data=JWTSerializer(
+        instance={"user":user,"access_token":access_token,"refresh_token":refresh_token},
+        context={"request":request},
+    ).data
+    response=JsonResponse(data,status=status.HTTP_200_OK)
+    set_jwt_cookies(response,access_token,refresh_token)
+    return response
+
+
+async def async_user_login(request):
+    """
+    Authenticate existing users using (phone number or email) and password
+
+    Async counterpart of UserLoginAPIView for ASGI deployments. The password
+    hash is checked on the bounded hashing pool so the worker keeps serving
+    other requests meanwhile.
+    """
+    if request.method!="POST":
+        return HttpResponseNotAllowed(["POST"])
+    request.sensitive_post_parameters=("password",)
+
+    try:
+        data=json.loads(request.body or b"{}")
+    except ValueError:
+        data=None
+    if not isinstance(data,dict):
+        return JsonResponse({"detail":_("JSON parse error.")},status=status.HTTP_400_BAD_REQUEST)
+
+    identifier=data.get("email") or data.get("phone_number")
+    password=data.get("password")
+
+    if not (isinstance(identifier,str) and isinstance(password,str) and identifier and password):
+        return _invalid_login(_("Enter a phone number or an email and password."))
+
+    wait=await sync_to_async(check_throttles)(request,"login",identifier)
+    if wait is not None:
+        exc=Throttled(wait)
+        response=JsonResponse({"detail":exc.detail},status=exc.status_code)
+        response["Retry-After"]=str(wait)
+        return response
+
+    user=await sync_to_async(identifier_backend.get_user_by_identifier)(identifier)
+
+    try:
+        valid,must_update=await averify_password(password,user.password if user else None)
+        if valid and must_update:
+            user.password=await amake_password(password)
+    except HashQueueFull:
+        response=JsonResponse(
+            {"detail":_("Too many logins in progress, try again shortly.")},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+        response["Retry-After"]="1"
+        return response
+
+    if not valid or not identifier_backend.user_can_authenticate(user):
+        return _invalid_login(_("Invalid credentials. Authentication Failed."))
+
+    user_otp=getattr(user,"phone",None)
+    if user_otp is None or not user_otp.is_verified:
+        exc=AccountNotVerifiedException()
+        return JsonResponse({"detail":exc.detail},status=exc.status_code)
+
+    return await sync_to_async(_login_response)(request,user,must_update)
+
+# Django 4.0 view decorators are sync only, mark the view for CsrfViewMiddleware directly
+async_user_login.csrf_exempt=True
+
+
 class SendOrResendSMSAPIView(GenericAPIView):
     
     """
@@ -75,6 +176,8 @@ class SendOrResendSMSAPIView(GenericAPIView):
     """
     
     serializer_class=PhoneNumberSerializer
+    throttle_classes=(IdentifierRateThrottle,IPRateThrottle)
+    throttle_scope="otp_send"
     
     def post(self,request,*args,**kwargs):
         serializer=self.get_serializer(data=request.data)
@@ -85,16 +188,8 @@ class SendOrResendSMSAPIView(GenericAPIView):
         phone_number=str(serializer.validated_data["phone_number"])
 
         user=User.objects.filter(phone_number=phone_number).first()
-        
-        sms_verification=OTP.objects.filter(
-            user=user,is_verified=False
-        ).first()
-
-        
-        if sms_verification is None:
-            sms_verification=OTP(user=user)
 
-        sms_verification.send_confirmation()
+        issue_otp(user,OTPDispatch.SMS)
 
         return Response(status=status.HTTP_200_OK)
  
@@ -107,6 +202,8 @@ class SendOrResendEmailOTPView(GenericAPIView):
     """
     
     serializer_class=EmailSerializer
+    throttle_classes=(IdentifierRateThrottle,IPRateThrottle)
+    throttle_scope="otp_send"
     
     def post(self,request,*args,**kwargs):
         serializer=self.get_serializer(data=request.data)
@@ -116,32 +213,12 @@ class SendOrResendEmailOTPView(GenericAPIView):
                     
         email=str(serializer.validated_data["email"])
 
-        is_otp_for_password=str(serializer.validated_data["is_otp_for_password"])
+        is_otp_for_password=serializer.validated_data["is_otp_for_password"]
 
         user=User.objects.filter(email=email).first()
 
-        otp_code=None
-
-        if is_otp_for_password:
-            otp_code=OTP.objects.filter(user=user).first()
-            if otp_code is None:
-                otp_code=OTP(user=user)
-            otp_code.send_email_OTP(reciever_email=email)
-            
-            return Response(status=status.HTTP_200_OK)        
-            
-        
-        
-        otp_code=OTP.objects.filter(
-            user=user,is_verified=False
-        ).first()
-        
-        if otp_code is None:
-            otp_code=OTP(user=user)
-
-        otp_code.send_email_OTP(reciever_email=email)
+        issue_otp(user,OTPDispatch.EMAIL,is_otp_for_password=is_otp_for_password)
 
-        
         return Response(status=status.HTTP_200_OK)        
 
 class VerifyPhoneNumberAPIView(GenericAPIView):
@@ -150,6 +227,8 @@ class VerifyPhoneNumberAPIView(GenericAPIView):
     """
 
     serializer_class=VerifyPhoneNumberSerializer
+    throttle_classes=(IdentifierRateThrottle,IPRateThrottle)
+    throttle_scope="otp_verify"
     
     def post(self,request,*args,**kwargs):
         serializer=self.get_serializer(data=request.data)
@@ -166,6 +245,8 @@ class VerifyEmailAPIView(GenericAPIView):
     """
 
     serializer_class=VerifyEmailSerializer
+    throttle_classes=(IdentifierRateThrottle,IPRateThrottle)
+    throttle_scope="otp_verify"
     
     def post(self,request,*args,**kwargs):
         serializer=self.get_serializer(data=request.data)
@@ -177,6 +258,225 @@ class VerifyEmailAPIView(GenericAPIView):
         return Response(message,status=status.HTTP_200_OK)
 
 
+def _exception_response(exc):
+    response=JsonResponse({"detail":exc.detail},status=exc.status_code)
+    if getattr(exc,"wait",None) is not None:
+        response["Retry-After"]=str(exc.wait)
+    return response
+
+
+def _validate_otp_request(request,serializer_class,scope,identifier_field):
+    """
+    Throttle and validate an OTP request the way the DRF views above do.
+    Return (serializer, None) if it is valid, or (None, error response).
+    """
+    try:
+        data=json.loads(request.body or b"{}")
+    except ValueError:
+        data=None
+    if not isinstance(data,dict):
+        return None,JsonResponse({"detail":_("JSON parse error.")},status=status.HTTP_400_BAD_REQUEST)
+
+    wait=check_throttles(request,scope,data.get(identifier_field))
+    if wait is not None:
+        return None,_exception_response(Throttled(wait))
+
+    serializer=serializer_class(data=data)
+    try:
+        if not serializer.is_valid():
+            return None,JsonResponse(serializer.errors,status=status.HTTP_400_BAD_REQUEST)
+    except APIException as exc:
+        return None,_exception_response(exc)
+    return serializer,None
+
+
+def _issue_otp_for(validated_data,channel):
+    if channel==OTPDispatch.SMS:
+        user=User.objects.filter(phone_number=validated_data["phone_number"]).first()
+        return issue_otp(user,channel,enqueue=False)
+    user=User.objects.filter(email=validated_data["email"]).first()
+    return issue_otp(user,channel,is_otp_for_password=validated_data["is_otp_for_password"],enqueue=False)
+
+
+async def _async_send_otp(request,serializer_class,channel,identifier_field):
+    if request.method!="POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    serializer,response=await sync_to_async(_validate_otp_request)(request,serializer_class,"otp_send",identifier_field)
+    if response is not None:
+        return response
+
+    otp=await sync_to_async(_issue_otp_for)(serializer.validated_data,channel)
+    # delivered here instead of by a Celery task, the provider is awaited without holding a thread
+    if otp.dispatch.pk is None:
+        # the store has no outbox, nothing was written
+        await adeliver_derived(otp.dispatch)
+    else:
+        await adeliver_pending(OTPDispatch.objects.filter(otp=otp))
+    return HttpResponse(status=status.HTTP_200_OK)
+
+
+async def _async_verify_otp(request,serializer_class,identifier_field,message):
+    if request.method!="POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    serializer,response=await sync_to_async(_validate_otp_request)(request,serializer_class,"otp_verify",identifier_field)
+    if response is not None:
+        return response
+    return JsonResponse({"detail":message},status=status.HTTP_200_OK)
+
+
+async def async_send_sms(request):
+    """
+    Async counterpart of SendOrResendSMSAPIView for ASGI deployments
+    """
+    return await _async_send_otp(request,PhoneNumberSerializer,OTPDispatch.SMS,"phone_number")
+
+
+async def async_send_email_otp(request):
+    """
+    Async counterpart of SendOrResendEmailOTPView for ASGI deployments
+    """
+    return await _async_send_otp(request,EmailSerializer,OTPDispatch.EMAIL,"email")
+
+
+async def async_verify_phone_number(request):
+    """
+    Async counterpart of VerifyPhoneNumberAPIView for ASGI deployments
+    """
+    return await _async_verify_otp(request,VerifyPhoneNumberSerializer,"phone_number",_("Phone number successfully verified."))
+
+
+async def async_verify_email(request):
+    """
+    Async counterpart of VerifyEmailAPIView for ASGI deployments
+    """
+    return await _async_verify_otp(request,VerifyEmailSerializer,"email",_("Email successfully verified."))
+
+
+for view in (async_send_sms,async_send_email_otp,async_verify_phone_number,async_verify_email):
+    view.csrf_exempt=True
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint, open to METRICS_ALLOWED_IPS and to
+    requests carrying METRICS_TOKEN
+    """
+    if not scrape_allowed(request):
+        raise PermissionDenied
+    body,content_type=render_metrics()
+    return HttpResponse(body,content_type=content_type)
+
+
+_BYTE_RANGE=re.compile(r"^bytes=(\d*)-(\d*)$")
+IMMUTABLE_CACHE_CONTROL="public, max-age=31536000, immutable"
+
+
+def _byte_range(header,size):
+    """
+    Return the inclusive (first, last) byte positions of a single range
+    header, None to send the whole file, or False if it cannot be satisfied
+    """
+    match=_BYTE_RANGE.match(header.strip())
+    if not match or match.groups()==("",""):
+        # several ranges or another unit, the whole file is a valid answer
+        return None
+    first,last=match.groups()
+    if not first:
+        # nothing can be the last bytes of an empty file
+        if int(last)==0 or not size:
+            return False
+        return max(size-int(last),0),size-1
+    if int(first)>=size:
+        return False
+    if last and int(last)<int(first):
+        return None
+    return int(first),min(int(last),size-1) if last else size-1
+
+
+def _if_range_matches(request,etag,last_modified):
+    if_range=request.META.get("HTTP_IF_RANGE")
+    if if_range is None:
+        return True
+    # only a strong validator may be used to combine parts of a file
+    return (if_range==etag and not etag.startswith("W/")) or if_range==http_date(last_modified)
+
+
+def _read_range(f,length,chunk_size=64*1024):
+    try:
+        while length>0:
+            chunk=f.read(min(chunk_size,length))
+            if not chunk:
+                return
+            length-=len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def serve_media(request,path):
+    """
+    Serve a file from MEDIA_ROOT with ETag, If-None-Match and Range support
+
+    Content-addressed names never change content, they get their hash as a
+    strong ETag and may be cached forever. Other files are revalidated.
+    Only routed with SERVE_MEDIA, production leaves media to the web server.
+    """
+    if request.method not in ("GET","HEAD"):
+        return HttpResponseNotAllowed(["GET","HEAD"])
+    try:
+        full_path=safe_join(settings.MEDIA_ROOT,path)
+    except SuspiciousFileOperation:
+        raise Http404()
+    if not os.path.isfile(full_path):
+        raise Http404()
+
+    stat=os.stat(full_path)
+    last_modified=int(stat.st_mtime)
+    digest=content_digest(path)
+    if digest:
+        etag=f'"{digest}"'
+        cache_control=IMMUTABLE_CACHE_CONTROL
+    else:
+        etag=f'W/"{stat.st_size:x}-{last_modified:x}"'
+        cache_control="no-cache"
+    headers={"ETag":etag,"Cache-Control":cache_control,"Last-Modified":http_date(last_modified)}
+
+    response=get_conditional_response(request,etag=etag,last_modified=last_modified)
+    if response is None:
+        response=_media_response(request,full_path,stat.st_size,etag,last_modified)
+    for name,value in headers.items():
+        response[name]=value
+    return response
+
+
+def _media_response(request,full_path,size,etag,last_modified):
+    content_type=mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+    byte_range=None
+    if "HTTP_RANGE" in request.META and _if_range_matches(request,etag,last_modified):
+        byte_range=_byte_range(request.META["HTTP_RANGE"],size)
+        if byte_range is False:
+            response=HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"]=f"bytes */{size}"
+            return response
+
+    first,last=byte_range or (0,size-1)
+    length=last-first+1 if size else 0
+    if request.method=="HEAD":
+        response=HttpResponse(content_type=content_type,status=206 if byte_range else 200)
+    else:
+        f=open(full_path,"rb")
+        f.seek(first)
+        response=StreamingHttpResponse(_read_range(f,length),content_type=content_type,status=206 if byte_range else 200)
+    if byte_range:
+        response["Content-Range"]=f"bytes {first}-{last}/{size}"
+    response["Content-Length"]=str(length)
+    response["Accept-Ranges"]="bytes"
+    return response
+
+
 class GoogleLogin(SocialLoginView):
     """
     Social authentication with Google
@@ -195,6 +495,10 @@ class ProfileAPIView(RetrieveUpdateAPIView):
     serializer_class=ProfileSerializer
     permission_classes=(IsUserProfileOwner,)
 
+    @cache_per_user
+    def get(self,request,*args,**kwargs):
+        return super().get(request,*args,**kwargs)
+
     def get_object(self):
         return self.request.user.profile
     
@@ -208,9 +512,16 @@ class UserAPIView(RetrieveAPIView):
     serializer_class=UserSerializer
     permission_classes=(permissions.IsAuthenticated,)
 
+    @cache_per_user
+    def get(self,request,*args,**kwargs):
+        return super().get(request,*args,**kwargs)
     
     def get_object(self):
-        return self.request.user
+        return self.get_queryset().get(pk=self.request.user.pk)
+
+    def get_queryset(self):
+        # profile and addresses are nested in UserSerializer, load them with the user
+        return super().get_queryset().select_related("profile").prefetch_related("addresses")
 
 class AddressViewSet(ReadOnlyModelViewSet):
     """
@@ -220,10 +531,44 @@ class AddressViewSet(ReadOnlyModelViewSet):
     queryset=Address.objects.all()
     serializer_class=AddressReadOnlySerializer
     permission_classes=(IsUserAddressOwner,)
+    pagination_class=AddressCursorPagination
+
+    @cache_per_user
+    def list(self,request,*args,**kwargs):
+        return super().list(request,*args,**kwargs)
+
+    @cache_per_user
+    def retrieve(self,request,*args,**kwargs):
+        return super().retrieve(request,*args,**kwargs)
 
     def get_queryset(self):
         res=super().get_queryset()
         user=self.request.user
-        return res.filter(user=user)
+        return res.filter(user=user).select_related("user")
+
+        
+
+
+class UserExportAPIView(APIView):
+    """
+    Stream every user with profile and addresses, for staff only.
+
+    ?file_format=ndjson|csv picks the format (DRF reserves ?format for
+    renderers) and ?gzip=1 compresses the stream.
+    """
 
-        
\ No newline at end of file
+    permission_classes=(permissions.IsAdminUser,)
+
+    def get(self,request,*args,**kwargs):
+        file_format=request.query_params.get("file_format","ndjson")
+        if file_format not in FORMATS:
+            return Response({"detail":_("Unsupported export format.")},status=status.HTTP_400_BAD_REQUEST)
+        compress=request.query_params.get("gzip") in ("1","true")
+
+        response=StreamingHttpResponse(
+            export_users(file_format,compress=compress),
+            content_type="application/gzip" if compress else FORMATS[file_format],
+        )
+        filename=f"users.{file_format}"+(".gz" if compress else "")
+        response["Content-Disposition"]=f'attachment; filename="{filename}"'
+        return response